@@ -0,0 +1,190 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'from Luke'))
+
+from recordingIndex import scanExperiment, getRecordingPaths
+from openephysConcat import openephys_concat
+from ksSession import KSSession
+from visualization import binSpikes
+from spikeIndex import getUnitRows
+
+# Batch runner for the analysis pipeline over many session roots (D:\2024-01-03_ALC4_day1, ...). Every session runs in
+# its own worker process, so a failing or crashing session is recorded and the others continue. The disk-bound stages
+# (discovery, concatenation) run in a small pool (--io-workers) so sessions do not compete for the same disks, and the
+# compute stages (Kilosort output loading, binning, summary) in a pool sized to the cores (--cpu-workers).
+# Every finished session is written to a results manifest (JSON), also while the batch is still running.
+#
+# Usage: python batchRun.py "D:\2024-01-*" --tip-depth 1500 --dt 1 0.1 --manifest D:\batch_manifest.json
+
+ioStages = ('discover', 'concat')
+cpuStages = ('load', 'bin', 'summary')
+
+def runIOStages(root, options):
+
+    # discovery and concatenation of one session; returns the session's manifest entry
+    result = {'root': root, 'status': 'ok', 'stages': {}}
+    try:
+        if 'discover' in options['stages'] or 'concat' in options['stages']:
+            start = time.perf_counter()
+            manifest = scanExperiment(os.path.join(root, options['raw_dir']))
+            recordings = manifest['recordings']
+            result['stages']['discover'] = {'seconds': time.perf_counter() - start, 'recordings': len(recordings),
+                                            'duration': sum(recording['duration'] for recording in recordings)}
+
+        if 'concat' in options['stages']:
+            start = time.perf_counter()
+            sidecar = openephys_concat(getRecordingPaths(manifest), root)
+            result['stages']['concat'] = {'seconds': time.perf_counter() - start, 'complete': sidecar.get('complete', False)}
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    return result
+
+def runCPUStages(root, options):
+
+    # Kilosort output loading, binning and summary of one session; returns the stage results
+    result = {'status': 'ok', 'stages': {}}
+    try:
+        outPath = os.path.join(root, options['out_dir'])
+        os.makedirs(outPath, exist_ok=True)
+
+        start = time.perf_counter()
+        session = KSSession(os.path.join(root, options['ks_dir']), options['tip_depth'], options['sample_rate'])
+        goodTimes = session['goodTimes']
+        result['stages']['load'] = {'seconds': time.perf_counter() - start, 'goodUnits': len(session['goodIDs']),
+                                    'goodSpikes': len(goodTimes)}
+
+        if 'bin' in options['stages']:
+            start = time.perf_counter()
+            rosters = binSpikes(session, list(options['dt']))
+            files = []
+            for dt, roster in zip(options['dt'], rosters):
+                files.append(os.path.join(outPath, 'roster_dt{}.npy'.format(dt)))
+                np.save(files[-1], roster)
+            result['stages']['bin'] = {'seconds': time.perf_counter() - start, 'files': files}
+
+        if 'summary' in options['stages']:
+            start = time.perf_counter()
+            duration = float(np.max(goodTimes)) if len(goodTimes) else 0.
+            spikeCounts = np.bincount(getUnitRows(session['goodIDs'], session['goodSpikes']), minlength=len(session['goodIDs']))
+
+            # site depths (one per cluster) of the good units, in goodIDs order
+            clusterRows = getUnitRows(session['clusterIDs'], session['goodIDs'])
+            goodDepths = np.where(clusterRows >= 0, np.asarray(session['depths'], dtype=np.float64)[clusterRows], np.nan)
+            summary = {'goodIDs': np.asarray(session['goodIDs']).tolist(), 'spikeCounts': spikeCounts.tolist(),
+                       'meanRates': (spikeCounts/duration if duration else spikeCounts*0.).tolist(), 'duration': duration,
+                       'depths': [None if np.isnan(depth) else depth for depth in goodDepths.tolist()]}
+            with open(os.path.join(outPath, 'summary.json'), 'w') as f:
+                json.dump(summary, f)
+            result['stages']['summary'] = {'seconds': time.perf_counter() - start, 'file': os.path.join(outPath, 'summary.json')}
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    return result
+
+def runBatch(roots, options, ioWorkers=2, cpuWorkers=None, manifestPath='batch_manifest.json'):
+
+    # run the selected stages on every session root and write the results manifest
+
+    ### Inputs:
+    #1. `roots` - list of str, session folders
+    #2. `options` - dict of stage options (see the command line arguments)
+    #3. `ioWorkers` - int, sessions in the disk-bound stages at the same time
+    #4. `cpuWorkers` - int, sessions in the compute stages at the same time (default: number of cores)
+    #5. `manifestPath` - str, path of the results manifest
+
+    ### Output:
+    # Dict written to the manifest: `options`, `started`, `finished` and `sessions` (root -> status, stage results)
+    cpuWorkers = cpuWorkers or os.cpu_count()
+    batch = {'options': options, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'sessions': {}}
+    runCPU = any(stage in options['stages'] for stage in cpuStages)
+
+    with _newPool(ioWorkers) as ioPool, _newPool(cpuWorkers) as cpuPool:
+        pending = {ioPool.submit(runIOStages, root, options): ('io', root) for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                phase, root = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e: # the worker process itself died
+                    result = {'status': 'failed', 'error': 'Worker process failed: {!r}'.format(e), 'stages': {}}
+
+                if phase == 'io':
+                    batch['sessions'][root] = result
+                    if result['status'] == 'ok' and runCPU:
+                        try:
+                            pending[cpuPool.submit(runCPUStages, root, options)] = ('cpu', root)
+                            continue
+                        except Exception as e: # the pool broke after a worker died
+                            result.update(status='failed', error='Could not start the compute stages: {!r}'.format(e))
+                else:
+                    session = batch['sessions'][root]
+                    session['stages'].update(result['stages'])
+                    session['status'] = result['status']
+                    if 'error' in result:
+                        session['error'] = result['error']
+
+                print("{} {}".format(batch['sessions'][root]['status'], root))
+                _writeManifest(manifestPath, batch)
+
+    batch['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    _writeManifest(manifestPath, batch)
+    return batch
+
+def _newPool(maxWorkers):
+
+    # one process per session (3.11+), so memory is returned and state does not leak between sessions
+    try:
+        return ProcessPoolExecutor(max_workers=maxWorkers, max_tasks_per_child=1)
+    except TypeError:
+        return ProcessPoolExecutor(max_workers=maxWorkers)
+
+def _writeManifest(manifestPath, batch):
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(batch, f, indent=1)
+    os.replace(tmpPath, manifestPath)
+
+def _expandRoots(patterns):
+    roots = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        roots.extend(os.path.abspath(match) for match in matches if os.path.isdir(match))
+    return list(dict.fromkeys(roots))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the analysis pipeline over many sessions in parallel.')
+    parser.add_argument('roots', nargs='+', help='session folders or glob patterns')
+    parser.add_argument('--stages', nargs='+', default=list(ioStages + cpuStages), choices=ioStages + cpuStages)
+    parser.add_argument('--raw-dir', default='01-raw', help='OpenEphys experiment folders, relative to the session root')
+    parser.add_argument('--ks-dir', default='02-processed', help='Kilosort output, relative to the session root')
+    parser.add_argument('--out-dir', default='03-batch', help='results folder, relative to the session root')
+    parser.add_argument('--tip-depth', type=float, required=True, help='depth of the shank tip in microns (no default: 0 would put every site above the surface)')
+    parser.add_argument('--sample-rate', type=int, default=30000)
+    parser.add_argument('--dt', type=float, nargs='+', default=[1.], help='bin widths in s')
+    parser.add_argument('--io-workers', type=int, default=2)
+    parser.add_argument('--cpu-workers', type=int, default=None)
+    parser.add_argument('--manifest', default='batch_manifest.json')
+    args = parser.parse_args(argv)
+
+    roots = _expandRoots(args.roots)
+    if not roots:
+        parser.error('no session folders match {}'.format(args.roots))
+    options = {'stages': args.stages, 'raw_dir': args.raw_dir, 'ks_dir': args.ks_dir, 'out_dir': args.out_dir,
+               'tip_depth': args.tip_depth, 'sample_rate': args.sample_rate, 'dt': args.dt}
+    batch = runBatch(roots, options, args.io_workers, args.cpu_workers, args.manifest)
+    failed = [root for root, session in batch['sessions'].items() if session['status'] != 'ok']
+    print("{} of {} sessions done, manifest: {}".format(len(roots) - len(failed), len(roots), args.manifest))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+
+from visualization import importKS
+
+# Benchmark of importKS on synthetic Kilosort/Phy outputs of increasing size.
+# The time per spike should stay roughly constant (linear scaling with spike count).
+# Usage: python benchmark_importKS.py [nSpikes ...]
+
+def writeFakeKS(folderpath, nSpikes, nClusters=500, goodFraction=0.4, seed=0):
+
+    # write spike_clusters.npy, spike_times.npy and cluster_info.tsv with `nSpikes` spikes
+    rng = np.random.default_rng(seed)
+    clusterIDs = np.arange(nClusters)
+    spikeClusters = rng.integers(0, nClusters, nSpikes).astype(np.int32)
+    spikeTimes = np.sort(rng.integers(0, 30000*3600, nSpikes)).astype(np.uint64).reshape(-1, 1)
+    labels = np.where(rng.random(nClusters) < goodFraction, 'good', 'mua')
+
+    np.save(os.path.join(folderpath, 'spike_clusters.npy'), spikeClusters)
+    np.save(os.path.join(folderpath, 'spike_times.npy'), spikeTimes)
+    pd.DataFrame({'cluster_id': clusterIDs,
+                  'KSLabel': labels,
+                  'group': labels,
+                  'depth': rng.uniform(0, 3840, nClusters),
+                  'n_spikes': np.bincount(spikeClusters, minlength=nClusters)}).to_csv(os.path.join(folderpath, 'cluster_info.tsv'), sep='\t', index=False)
+
+def benchmark(spikeCounts, repeats=3):
+
+    print("{:>12} {:>10} {:>14}".format('nSpikes', 'time (s)', 'ns per spike'))
+    for nSpikes in spikeCounts:
+        with tempfile.TemporaryDirectory() as folderpath:
+            writeFakeKS(folderpath, nSpikes)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    importKS(folderpath, tipDepth=4000, buildIndex=False, geometry=False) # only the good-spike filtering
+                times.append(time.perf_counter() - start)
+        best = min(times)
+        print("{:>12} {:>10.3f} {:>14.1f}".format(nSpikes, best, best/nSpikes*1e9))
+
+if __name__ == '__main__':
+    spikeCounts = [int(n) for n in sys.argv[1:]] or [10**5, 10**6, 10**7]
+    benchmark(spikeCounts)
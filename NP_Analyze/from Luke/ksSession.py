@@ -0,0 +1,177 @@
+import os
+import numpy as np
+import pandas as pd
+from functools import cached_property
+
+from spikeIndex import getUnitRows, getSpikeIndex, getUnitSamples, sourceFiles
+from resultCache import ResultCache, cacheFolder, funcName
+from unitGeometry import computeUnitGeometry, clampDepths, layerBounds as defaultLayerBounds
+
+cacheVersion = 1 # bump when a cached column function or anything it calls (clampDepths, computeUnitGeometry, ...) changes
+
+class KSSession:
+
+    # lazy, memory-mapped view of a kilosort/phy2 output folder
+
+    ### Inputs:
+    #1. `folderpath` - str with path to kilosort output
+    #2. `tipDepth` - int/float, depth of the shank tip in microns (Reading of D axis given by sensapex micromanipulator)
+    #3. `sampleRate` - int sample rate in Hz (find in params.py if unknown)
+    #4. `useCache` - bool, keep `goodMask`, `depths` and the unit geometry in the result cache of the sort (see resultCache.py)
+    #5. `cacheBytes` - int, size cap of the result cache (least recently used entries are evicted)
+    #6. `layerBounds` - tuple of layer boundaries below the surface in microns (default: mouse S1, unitGeometry.layerBounds)
+    #7. `saveIndex` - bool, save a newly built spike index to <folderpath>/spike_index (False: a saved index is still
+    #   loaded, but the kilosort folder is never written to, e.g. on a read-only share)
+
+    ### Usage:
+    # The raw spike arrays are opened with mmap_mode='r' and only paged in when read. Every derived array
+    # (`goodSpikes`, `goodSamples`, `goodTimes`, ...) is computed on first access and cached, so a session
+    # costs almost no RAM until a column is used. `session['goodTimes']` works like `outDict['goodTimes']`,
+    # so a session can be passed to binSpikes/getNormRoster in place of the importKS dict.
+    # `unitPosXY`, `unitDepths`, `depthIndices` and `layers` of the good units come from the templates (unitGeometry.py).
+    # `unitSamples(unitID)`/`unitTimes(unitID)` return one unit's spikes as views of the memory-mapped spike index
+    # (spikeIndex.py), without building the global good-spike arrays. `session['spikeIndex']` is that index, so
+    # computePSTH/extractWaveforms on a session read it instead of the good-spike arrays.
+    # `cached(func, **params)` returns func(session, **params) from a disk cache in <folderpath>/result_cache keyed by
+    # the kilosort files, the function and its parameters, e.g. session.cached(getNormRoster, dt=1). Only func's own
+    # code is part of the key: pass a new `version` when something it calls changes, e.g. cached(func, version=2).
+
+    tipLength = 175 # the tip length of neuropixel 1.0 [unit: µm]
+
+    def __init__(self, folderpath, tipDepth, sampleRate=30000, useCache=False, cacheBytes=2*2**30, layerBounds=defaultLayerBounds,
+                 saveIndex=False):
+        self.folderpath = folderpath
+        self.saveIndex = saveIndex
+        self.tipDepth = tipDepth
+        self.sampleRate = sampleRate
+        self.layerBounds = tuple(layerBounds)
+        self.useCache = useCache
+        self.resultCache = ResultCache(os.path.join(folderpath, cacheFolder), cacheBytes)
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def keys(self):
+        return ('sampleRate', 'goodSpikes', 'goodSamples', 'goodTimes', 'clusterIDs', 'goodIDs', 'depths', 'nSpikes', 'labels',
+                'unitPosXY', 'unitDepths', 'depthIndices', 'layers', 'spikeIndex')
+
+    # raw kilosort output (memory-mapped, read-only)
+    @cached_property
+    def spikeClusters(self):
+        return np.load(os.path.join(self.folderpath, 'spike_clusters.npy'), mmap_mode='r').reshape(-1)
+
+    @cached_property
+    def spikeTimes(self):
+        return np.load(os.path.join(self.folderpath, 'spike_times.npy'), mmap_mode='r').reshape(-1)
+
+    @cached_property
+    def clusterInfo(self):
+        clusterInfo = pd.read_csv(os.path.join(self.folderpath, 'cluster_info.tsv'), sep='\t')
+
+        # apply label from manual curation
+        clusterInfo.loc[clusterInfo['group'] == 'good', 'KSLabel'] = 'good'
+        return clusterInfo
+
+    # unit table
+    @cached_property
+    def goodIDs(self):
+        idColumn = 'id' if 'id' in self.clusterInfo else 'cluster_id'
+        return np.array(self.clusterInfo[idColumn][self.clusterInfo['KSLabel'] == 'good'])
+
+    @cached_property
+    def clusterIDs(self):
+        return np.array(self.clusterInfo['cluster_id'])
+
+    @cached_property
+    def nSpikes(self):
+        return np.array(self.clusterInfo['n_spikes'])
+
+    @cached_property
+    def labels(self):
+        return np.array(self.clusterInfo['KSLabel'].fillna(''), dtype=str)
+
+    @cached_property
+    def depths(self):
+        return self.cached(_siteDepths, version=cacheVersion) if self.useCache else _siteDepths(self)
+
+    # unit geometry (positions, depth order and layers of the good units)
+    @cached_property
+    def geometry(self):
+        if self.useCache:
+            return self.cached(_unitGeometry, version=cacheVersion, bounds=self.layerBounds)
+        return _unitGeometry(self, self.layerBounds)
+
+    @property
+    def unitPosXY(self):
+        return self.geometry['unitPosXY']
+
+    @property
+    def unitDepths(self):
+        return self.geometry['unitDepths']
+
+    @property
+    def depthIndices(self):
+        return self.geometry['depthIndices']
+
+    @property
+    def layers(self):
+        return self.geometry['layers']
+
+    # derived spike arrays (computed once, on first access)
+    @cached_property
+    def goodMask(self):
+        return self.cached(_goodMask, version=cacheVersion) if self.useCache else _goodMask(self)
+
+    @cached_property
+    def goodSpikes(self):
+        return self.spikeClusters[self.goodMask]
+
+    @cached_property
+    def goodSamples(self):
+        return self.spikeTimes[self.goodMask].astype(np.int64)
+
+    @cached_property
+    def goodTimes(self):
+        return self.goodSamples/self.sampleRate
+
+    # per-unit access
+    @cached_property
+    def spikeIndex(self):
+        return getSpikeIndex(self.folderpath, self.goodIDs, self.spikeClusters, self.spikeTimes, save=self.saveIndex)
+
+    def unitSamples(self, unitID, start=None, stop=None):
+        return getUnitSamples(self.spikeIndex, unitID, start, stop)
+
+    def unitTimes(self, unitID, tStart=None, tStop=None):
+        start = None if tStart is None else int(np.ceil(tStart*self.sampleRate))
+        stop = None if tStop is None else int(np.ceil(tStop*self.sampleRate))
+        return self.unitSamples(unitID, start, stop)/self.sampleRate
+
+    def cached(self, func, version=None, **params):
+
+        # func(self, **params) from the result cache (computed and stored on the first call); `version` is bumped by
+        # the caller when a function called by func changes
+        sourcePaths = [os.path.join(self.folderpath, name) for name in sourceFiles]
+        key = dict(params, tipDepth=self.tipDepth, sampleRate=self.sampleRate)
+        return self.resultCache.getOrCompute(funcName(func, version), sourcePaths, key, lambda: func(self, **params))
+
+    def clearCache(self, *names):
+
+        # drop cached columns (all derived arrays if no names are given) to give their memory back
+        names = names or ('goodMask', 'goodSpikes', 'goodSamples', 'goodTimes')
+        for name in names:
+            self.__dict__.pop(name, None)
+
+def _siteDepths(session):
+    return clampDepths(session.tipDepth - session.tipLength - np.array(session.clusterInfo['depth']))
+
+def _unitGeometry(session, bounds):
+    return computeUnitGeometry(session.folderpath, session.goodIDs, session.tipDepth, session.tipLength, bounds, warn=False)
+
+def _goodMask(session):
+    return getUnitRows(session.goodIDs, session.spikeClusters) >= 0
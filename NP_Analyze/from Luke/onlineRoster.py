@@ -0,0 +1,212 @@
+import os
+import glob
+import time
+import socket
+import struct
+import numpy as np
+
+from spikeIndex import getUnitRows
+
+# Online counterpart of getNormRoster for checking responses during a recording. Spike batches (cluster IDs and
+# samples, e.g. from an online sorter) are binned into a growing [units x bins] count matrix as they arrive. A bin is
+# final once the newest spike is `lagBins` bins past it; final bins are merged into per-unit running mean/variance
+# accumulators (Welford, combined per block of bins as in Chan et al.), so the baseline is never recomputed over the
+# whole session. A late spike in a final bin updates the count and corrects the accumulators exactly.
+# Every batch costs O(batch + newly final bins), and getDeltaFR() returns the current delta firing rate matrix.
+# Batches can come from a folder of chunk files (watchChunks) or a local socket (receiveChunks/sendChunk).
+
+class OnlineRoster:
+
+    # running spike count roster and per-unit baseline statistics
+
+    ### Inputs:
+    #1. `unitIDs` - ndarray of unit IDs, one row per unit (spikes of other clusters are ignored)
+    #2. `dt` - float bin width in s
+    #3. `sampleRate` - int sample rate in Hz
+    #4. `baselineStop` - float, only bins before this time (in s) enter the baseline (None: all final bins), e.g. the
+    #   end of the spontaneous period
+    #5. `lagBins` - int, bins behind the newest spike that may still receive spikes before they are final
+
+    ### Usage:
+    # roster = OnlineRoster(goodIDs, dt=1)
+    # for clusters, samples in watchChunks(folder): roster.addSpikes(clusters, samples); deltaFR = roster.getDeltaFR()
+
+    def __init__(self, unitIDs, dt=1, sampleRate=30000, baselineStop=None, lagBins=1):
+        self.unitIDs = np.asarray(unitIDs).reshape(-1)
+        self.dt = dt
+        self.sampleRate = sampleRate
+        self.binSamples = dt*sampleRate
+        self.baselineBins = None if baselineStop is None else int(np.ceil(baselineStop/dt))
+        self.lagBins = lagBins
+
+        self.counts = np.zeros((len(self.unitIDs), 1024), dtype=np.int32)
+        self.numBins = 0 # bins up to the newest spike (or advance())
+        self.finalBins = 0 # bins merged into the baseline
+
+        # Welford accumulators of the baseline bins (same number of bins for every unit)
+        self.baselineCount = 0
+        self.baselineMean = np.zeros(len(self.unitIDs))
+        self.baselineM2 = np.zeros(len(self.unitIDs))
+
+    def addSpikes(self, spikeClusters, spikeSamples):
+
+        # add a batch of spikes (cluster ID and sample of every spike, in any order)
+        rows = getUnitRows(self.unitIDs, spikeClusters)
+        cols = np.floor(np.asarray(spikeSamples, dtype=np.float64).reshape(-1)/self.binSamples).astype(np.int64)
+        keep = (rows >= 0) & (cols >= 0)
+        rows, cols = rows[keep], cols[keep]
+        if len(cols) == 0:
+            return
+
+        self._grow(int(cols.max()) + 1)
+        cells, increments = np.unique(rows*self.counts.shape[1] + cols, return_counts=True)
+        cellRows, cellCols = cells//self.counts.shape[1], cells % self.counts.shape[1]
+
+        # late spikes in bins already in the baseline: correct the accumulators for the changed counts
+        late = cellCols < min(self.finalBins, self._baselineLimit())
+        if np.any(late):
+            self._correctBaseline(cellRows[late], self.counts[cellRows[late], cellCols[late]], increments[late])
+
+        self.counts[cellRows, cellCols] += increments.astype(self.counts.dtype)
+        self.advance(int(cols.max()) + 1, inBins=True)
+
+    def advance(self, position, inBins=False):
+
+        # the recording reached `position` (sample, or bin with `inBins`): finalize the bins `lagBins` behind it
+        numBins = int(position) if inBins else int(np.floor(position/self.binSamples)) + 1
+        self._grow(numBins)
+        self.numBins = max(self.numBins, numBins)
+
+        finalBins = max(self.numBins - self.lagBins, self.finalBins)
+        first, last = self.finalBins, min(finalBins, self._baselineLimit())
+        if last > first:
+            self._mergeBlock(self.counts[:, first:last].astype(np.float64))
+        self.finalBins = finalBins
+
+    @property
+    def baseline(self):
+        return self.baselineMean.copy()
+
+    @property
+    def baselineStd(self):
+        return np.sqrt(self.baselineM2/self.baselineCount) if self.baselineCount else np.zeros(len(self.unitIDs))
+
+    def getRoster(self):
+
+        # [units x bins] spike counts so far (view)
+        return self.counts[:, :self.numBins]
+
+    def getDeltaFR(self, zScore=False):
+
+        # [units x bins] counts minus the running baseline mean (divided by the baseline std with `zScore`), as getNormRoster
+        deltaFR = self.getRoster() - self.baselineMean[:, np.newaxis]
+        if zScore:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                deltaFR = deltaFR/self.baselineStd[:, np.newaxis]
+        return deltaFR
+
+    def _baselineLimit(self):
+        return self.counts.shape[1] if self.baselineBins is None else self.baselineBins
+
+    def _grow(self, numBins):
+
+        # double the capacity of the count matrix when needed (amortized O(1) per bin)
+        if numBins <= self.counts.shape[1]:
+            return
+        counts = np.zeros((self.counts.shape[0], max(numBins, 2*self.counts.shape[1])), dtype=self.counts.dtype)
+        counts[:, :self.counts.shape[1]] = self.counts
+        self.counts = counts
+
+    def _mergeBlock(self, block):
+
+        # combine the accumulators with the statistics of a block of bins (parallel Welford update)
+        blockCount = block.shape[1]
+        blockMean = block.mean(axis=1)
+        blockM2 = ((block - blockMean[:, np.newaxis])**2).sum(axis=1)
+        total = self.baselineCount + blockCount
+        delta = blockMean - self.baselineMean
+        self.baselineMean = self.baselineMean + delta*blockCount/total
+        self.baselineM2 = self.baselineM2 + blockM2 + delta**2*self.baselineCount*blockCount/total
+        self.baselineCount = total
+
+    def _correctBaseline(self, rows, oldCounts, increments):
+
+        # exact update of mean and M2 when values of rows change from oldCounts to oldCounts + increments
+        # (the number of bins stays the same): M2 changes by sum(new^2 - old^2) - n*(newMean^2 - oldMean^2)
+        n = self.baselineCount
+        oldCounts = oldCounts.astype(np.float64)
+        newCounts = oldCounts + increments
+        meanShift = np.bincount(rows, weights=increments, minlength=len(self.unitIDs))/n
+        squareShift = np.bincount(rows, weights=newCounts**2 - oldCounts**2, minlength=len(self.unitIDs))
+        newMean = self.baselineMean + meanShift
+        self.baselineM2 = np.maximum(self.baselineM2 + squareShift - n*(newMean**2 - self.baselineMean**2), 0.)
+        self.baselineMean = newMean
+
+def watchChunks(folderpath, pattern='chunk_*.npz', pollInterval=1., timeout=None):
+
+    # yield (spikeClusters, spikeSamples) of every chunk file in `folderpath` as it appears (in name order)
+
+    ### Inputs:
+    #1. `folderpath` - str, folder the chunks are written to (.npz with `clusters` and `samples`, see writeChunk)
+    #2. `pattern` - str, glob pattern of the chunk files
+    #3. `pollInterval` - float, s between checks for new files
+    #4. `timeout` - float, stop after this many s without a new chunk (None: run until interrupted)
+    seen = set()
+    lastChunk = time.monotonic()
+    while True:
+        newPaths = sorted(set(glob.glob(os.path.join(folderpath, pattern))) - seen)
+        for path in newPaths:
+            seen.add(path)
+            with np.load(path) as chunk:
+                yield chunk['clusters'], chunk['samples']
+            lastChunk = time.monotonic()
+        if not newPaths:
+            if timeout is not None and time.monotonic() - lastChunk > timeout:
+                return
+            time.sleep(pollInterval)
+
+def writeChunk(folderpath, chunkIndex, spikeClusters, spikeSamples):
+
+    # write a chunk for watchChunks (renamed into place, so a half-written file is never read)
+    path = os.path.join(folderpath, 'chunk_{:06d}.npz'.format(chunkIndex))
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, clusters=np.asarray(spikeClusters, dtype=np.int64), samples=np.asarray(spikeSamples, dtype=np.int64))
+    os.replace(path + '.tmp', path)
+    return path
+
+_header = struct.Struct('<Q') # number of spikes in the message
+
+def sendChunk(sock, spikeClusters, spikeSamples):
+
+    # send a batch of spikes to receiveChunks (int64 clusters, then int64 samples)
+    clusters = np.asarray(spikeClusters, dtype='<i8').reshape(-1)
+    samples = np.asarray(spikeSamples, dtype='<i8').reshape(-1)
+    sock.sendall(_header.pack(len(clusters)) + clusters.tobytes() + samples.tobytes())
+
+def receiveChunks(host='127.0.0.1', port=5555, timeout=None):
+
+    # yield (spikeClusters, spikeSamples) of every batch sent by one client (stand-in for an online sorter's stream)
+    with socket.create_server((host, port)) as server:
+        server.settimeout(timeout)
+        connection, _ = server.accept()
+        with connection:
+            connection.settimeout(timeout)
+            while True:
+                header = _receiveAll(connection, _header.size)
+                if header is None:
+                    return
+                numSpikes = _header.unpack(header)[0]
+                payload = _receiveAll(connection, 16*numSpikes)
+                if payload is None:
+                    return
+                values = np.frombuffer(payload, dtype='<i8')
+                yield values[:numSpikes], values[numSpikes:]
+
+def _receiveAll(connection, numBytes):
+    data = bytearray()
+    while len(data) < numBytes:
+        block = connection.recv(numBytes - len(data))
+        if not block:
+            return None
+        data.extend(block)
+    return bytes(data)
@@ -0,0 +1,119 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Permutation test of stimulus-evoked firing changes for all units at once. The statistic of every unit is the mean
+# rate in the active bins minus the mean rate in the spontaneous bins of a binned [units x bins] roster. A batch of
+# label shuffles is a [shuffles x bins] weight matrix (+1/nActive on active bins, -1/nSpontaneous on the others), so the
+# null statistics of all units for the whole batch are one matrix product. The shuffles are drawn in fixed blocks of
+# seedBlock shuffles, each from its own child of one SeedSequence, and batches are made of whole blocks, so the null
+# distribution is the same whatever the batch size or the number of worker processes.
+
+seedBlock = 100 # shuffles drawn from one child seed
+
+def getEpochLabels(numBins, dt, epochs):
+
+    # label and epoch number of every bin from (tStart, tStop, label) epochs in s (bins outside all epochs get -1)
+
+    ### Inputs:
+    #1. `numBins` - int, number of bins of the roster
+    #2. `dt` - float bin width in s
+    #3. `epochs` - list of (tStart, tStop, label), e.g. [(0, 180, 0), (180, 360, 1), (540, 720, 0), (720, 900, 1)]
+
+    ### Output:
+    # (labels, epochIDs) ndarrays of length `numBins`
+    labels = np.full(numBins, -1, dtype=np.int64)
+    epochIDs = np.full(numBins, -1, dtype=np.int64)
+    for epochID, (tStart, tStop, label) in enumerate(epochs):
+        first, last = int(np.round(tStart/dt)), min(int(np.round(tStop/dt)), numBins)
+        labels[first:last] = label
+        epochIDs[first:last] = epochID
+    return labels, epochIDs
+
+def permutationTest(roster, labels, epochIDs=None, nShuffles=10000, seed=0, alternative='two-sided', batchSize=500, nWorkers=1, keepNull=True):
+
+    # per-unit p-values of mean(active bins) - mean(spontaneous bins) against shuffled labels
+
+    ### Inputs:
+    #1. `roster` - ndarray [units x bins] (e.g. binSpikes/getNormRoster)
+    #2. `labels` - ndarray (bins,) of 1 (active), 0 (spontaneous) or -1 (not used)
+    #3. `epochIDs` - ndarray (bins,) of epoch numbers; whole epochs are shuffled (keeps the autocorrelation of the bins
+    #   within an epoch). Default: every bin is shuffled on its own
+    #4. `nShuffles` - int, number of label shuffles
+    #5. `seed` - int, seed of the shuffles (same result for any `nWorkers`/`batchSize` split of the same seed)
+    #6. `alternative` - 'two-sided', 'greater' (active > spontaneous) or 'less'
+    #7. `batchSize` - int, shuffles per matrix product (rounded down to whole blocks of seedBlock shuffles)
+    #8. `nWorkers` - int, worker processes (1: run in this process)
+    #9. `keepNull` - bool, return the null distributions
+
+    ### Output: Dict with keys
+    #1. `observed` - ndarray (units,) of the observed statistic
+    #2. `pValues` - ndarray (units,) of permutation p-values ((1 + #null at least as extreme)/(1 + nShuffles))
+    #3. `null` - ndarray [units x nShuffles] of the null statistics (only if `keepNull`)
+
+    roster = np.asarray(roster, dtype=np.float64)
+    labels = np.asarray(labels).reshape(-1)
+    used = labels >= 0
+    roster, labels = roster[:, used], labels[used]
+    if epochIDs is None:
+        epochIDs = np.arange(len(labels))
+    else:
+        epochIDs = np.unique(np.asarray(epochIDs).reshape(-1)[used], return_inverse=True)[1]
+
+    # label of every epoch (all bins of an epoch must share it)
+    epochLabels = np.zeros(epochIDs.max() + 1 if len(epochIDs) else 0, dtype=np.int64)
+    epochLabels[epochIDs] = labels
+    if np.any(epochLabels[epochIDs] != labels):
+        raise ValueError("Every epoch must have a single label.")
+    if not (np.any(labels == 1) and np.any(labels == 0)):
+        raise ValueError("Both active (1) and spontaneous (0) bins are needed.")
+
+    observed = roster @ _weights(labels[np.newaxis, :])[0]
+
+    # one child seed per block of shuffles, independent of how the blocks are batched and distributed
+    blockSizes = [min(seedBlock, nShuffles - first) for first in range(0, nShuffles, seedBlock)]
+    blocks = list(zip(np.random.SeedSequence(seed).spawn(len(blockSizes)), blockSizes))
+    blocksPerBatch = max(batchSize//seedBlock, 1)
+    tasks = [blocks[first:first + blocksPerBatch] for first in range(0, len(blocks), blocksPerBatch)]
+    if nWorkers > 1:
+        with ProcessPoolExecutor(max_workers=nWorkers, initializer=_initWorker, initargs=(roster, epochLabels, epochIDs)) as executor:
+            nulls = list(executor.map(_workerBatch, tasks))
+    else:
+        nulls = [_nullBatch(roster, epochLabels, epochIDs, task) for task in tasks]
+    null = np.concatenate(nulls, axis=1) if nulls else np.zeros((roster.shape[0], 0))
+
+    # null values within rounding of the observed one count as at least as extreme: a shuffle that repeats the observed
+    # arrangement gives the same statistic only up to the summation order of the matrix product
+    tolerance = 1e-9*np.abs(roster).mean(axis=1)
+    if alternative == 'greater':
+        extreme = null >= (observed - tolerance)[:, np.newaxis]
+    elif alternative == 'less':
+        extreme = null <= (observed + tolerance)[:, np.newaxis]
+    else:
+        extreme = np.abs(null) >= (np.abs(observed) - tolerance)[:, np.newaxis]
+
+    result = {}
+    result['observed'] = observed
+    result['pValues'] = (1 + extreme.sum(axis=1))/(1 + nShuffles)
+    if keepNull:
+        result['null'] = null
+    return result
+
+def _weights(labels):
+
+    # [shuffles x bins] weights: +1/nActive on active bins, -1/nSpontaneous on spontaneous bins
+    active = labels == 1
+    nActive = active.sum(axis=1, keepdims=True)
+    return np.where(active, 1/nActive, -1/(labels.shape[1] - nActive))
+
+def _nullBatch(roster, epochLabels, epochIDs, blocks):
+    shuffledEpochs = np.concatenate([np.random.default_rng(blockSeed).permuted(np.tile(epochLabels, (size, 1)), axis=1)
+                                     for blockSeed, size in blocks])
+    return roster @ _weights(shuffledEpochs[:, epochIDs]).T
+
+_worker = {}
+
+def _initWorker(roster, epochLabels, epochIDs):
+    _worker.update(roster=roster, epochLabels=epochLabels, epochIDs=epochIDs)
+
+def _workerBatch(task):
+    return _nullBatch(_worker['roster'], _worker['epochLabels'], _worker['epochIDs'], task)
@@ -0,0 +1,103 @@
+import numpy as np
+
+from spikeIndex import buildSpikeIndex
+
+# Peri-stimulus spike counts of all good units around all events in one vectorized pass per chunk of units.
+# The spikes of a chunk are taken from the per-unit spike index (sorted by unit, then time) as one sorted key array
+# (unit row * keyStride + sample), so the window of every (unit, trial) pair is found with two searchsorted calls and
+# every spike that falls in a window is binned with a single bincount.
+
+keyStride = np.int64(1) << 40 # larger than any spike sample (~10 years at 30 kHz)
+
+def getTrainOnsetTimes(settings, offset=0):
+
+    # onset (in s) of every laser train of a pulsedLaser.py / physiologicalLaser.py session
+
+    ### Inputs:
+    #1. `settings` - dict of the session settings (uses `trial_buffer`, `train_duration`, `rest_duration`, `trial_repeats`)
+    #2. `offset` - float, time (in s) of the first DAQ output sample in the recording (e.g. the first sync rising edge)
+
+    ### Output:
+    # ndarray of train onset times (in s), same onsets as waveformBuilder.getTrainOnsets
+    trial_duration = (2 * settings['trial_buffer']) + (settings['trial_repeats'] * (settings['train_duration'] + settings['rest_duration'])) - settings['rest_duration']
+    return np.arange((settings['trial_buffer']), (trial_duration), ((settings['train_duration'] + settings['rest_duration']))) + offset
+
+def computePSTH(outDict, eventTimes, window=(-0.5, 1.), binSize=0.01, unitIDs=None, unitChunk=64, dtype=np.int32):
+
+    # spike counts of every unit in every trial and bin around the events
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession); uses `spikeIndex` if present
+    #2. `eventTimes` - ndarray of event times (in s), one trial per event
+    #3. `window` - (start, stop) in s relative to each event
+    #4. `binSize` - float bin width in s
+    #5. `unitIDs` - ndarray of units to include (default: `goodIDs`), rows of the output in this order
+    #6. `unitChunk` - int, units processed per pass (bounds the memory of the intermediate arrays)
+    #7. `dtype` - dtype of the counts
+
+    ### Output: Dict with keys
+    #1. `counts` - ndarray [units x trials x bins]
+    #2. `edges` - ndarray of bin edges (in s, relative to the events)
+    #3. `unitIDs` - ndarray of unit IDs, one per row of `counts`
+    #4. `eventTimes` - ndarray of event times, one per trial of `counts`
+
+    sampleRate = outDict['sampleRate']
+    unitIDs = np.asarray(outDict['goodIDs'] if unitIDs is None else unitIDs).reshape(-1)
+    eventTimes = np.asarray(eventTimes, dtype=np.float64).reshape(-1)
+    numBins = int(round((window[1] - window[0])/binSize))
+    edges = window[0] + np.arange(numBins + 1)*binSize
+
+    if 'spikeIndex' in outDict:
+        spikeIndex = outDict['spikeIndex']
+    else:
+        spikeIndex = buildSpikeIndex(outDict['goodIDs'], outDict['goodSpikes'], outDict['goodSamples'])
+    indexRows = np.searchsorted(spikeIndex['unitIDs'], unitIDs)
+    indexRows = np.minimum(indexRows, len(spikeIndex['unitIDs']) - 1)
+    if len(unitIDs) and np.any(spikeIndex['unitIDs'][indexRows] != unitIDs):
+        raise KeyError("Units {} are not in the spike index.".format(unitIDs[spikeIndex['unitIDs'][indexRows] != unitIDs]))
+
+    # window of every trial in samples, [start, stop) as in getUnitTimes
+    starts = np.ceil((eventTimes + window[0])*sampleRate).astype(np.int64)
+    stops = np.ceil((eventTimes + edges[-1])*sampleRate).astype(np.int64)
+
+    counts = np.zeros((len(unitIDs), len(eventTimes), numBins), dtype=dtype)
+    for first in range(0, len(unitIDs), unitChunk):
+        chunkRows = indexRows[first:first + unitChunk]
+        counts[first:first + len(chunkRows)] = _chunkCounts(spikeIndex, chunkRows, eventTimes, starts, stops, window[0], binSize, numBins, sampleRate)
+
+    psth = {}
+    psth['counts'] = counts
+    psth['edges'] = edges
+    psth['unitIDs'] = unitIDs
+    psth['eventTimes'] = eventTimes
+    return psth
+
+def _chunkCounts(spikeIndex, chunkRows, eventTimes, starts, stops, windowStart, binSize, numBins, sampleRate):
+
+    # sorted keys of the chunk's spikes: unit position in the chunk * keyStride + sample
+    offsets = np.asarray(spikeIndex['offsets'])
+    lengths = offsets[chunkRows + 1] - offsets[chunkRows]
+    spikePositions = np.repeat(offsets[chunkRows] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    samples = np.asarray(spikeIndex['samples'][spikePositions], dtype=np.int64)
+    keys = np.repeat(np.arange(len(chunkRows), dtype=np.int64)*keyStride, lengths) + samples
+
+    # first and last spike of every (unit, trial) window
+    unitKeys = (np.arange(len(chunkRows), dtype=np.int64)*keyStride)[:, np.newaxis]
+    lo = np.searchsorted(keys, (unitKeys + starts[np.newaxis, :]).reshape(-1), side='left')
+    hi = np.searchsorted(keys, (unitKeys + stops[np.newaxis, :]).reshape(-1), side='left')
+
+    # every spike in every window (a spike in overlapping windows is counted in each), binned relative to its event
+    windowLengths = hi - lo
+    inWindow = np.repeat(lo - (np.cumsum(windowLengths) - windowLengths), windowLengths) + np.arange(windowLengths.sum())
+    pair = np.repeat(np.arange(len(lo)), windowLengths)
+    relative = samples[inWindow]/sampleRate - eventTimes[pair % len(eventTimes)]
+    bins = np.floor((relative - windowStart)/binSize).astype(np.int64)
+    valid = (bins >= 0) & (bins < numBins)
+
+    counts = np.bincount(pair[valid]*numBins + bins[valid], minlength=len(lo)*numBins)
+    return counts.reshape(len(chunkRows), len(eventTimes), numBins)
+
+def getPSTHRate(psth):
+
+    # trial-averaged firing rate (in Hz) of every unit and bin, [units x bins]
+    return psth['counts'].mean(axis=1)/np.diff(psth['edges'])[np.newaxis, :]
@@ -0,0 +1,185 @@
+import numpy as np
+
+from spikeIndex import getUnitRows
+
+# Multi-resolution spike count pyramid for drawing rasters and firing rate heatmaps of long sessions.
+# The spikes of all good units are binned once per level (e.g. 1 ms -> 10 ms -> 100 ms -> 1 s); a level is a dense
+# [units x bins] array when it is small and a column-sliceable sparse (CSC) matrix otherwise, so no level holds more
+# entries than there are spikes. A view of [tStart, tStop) is read from the finest level that has at most one bin per
+# screen pixel (summing neighbouring bins of the coarsest level if needed), so drawing costs
+# units x pixels whatever the number of spikes, and zooming re-reads only the visible columns.
+# Building the pyramid is one pass over the spikes per level; with a KSSession it can be kept in the result cache,
+# e.g. session.cached(buildRasterPyramid, baseBin=0.001).
+
+def buildRasterPyramid(outDict, baseBin=0.001, factors=(10, 10, 10), denseBytes=2**26):
+
+    # bin the spikes of all good units at every resolution
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession); uses `goodIDs`, `goodSpikes`, `goodSamples`, `sampleRate`
+    #2. `baseBin` - float, finest bin width in s (rounded to whole samples)
+    #3. `factors` - tuple of ints, bin width ratio of each level to the previous one
+    #4. `denseBytes` - int, levels up to this size are stored as dense arrays, larger ones as sparse matrices
+
+    ### Output: Dict with keys
+    #1. `levels` - list of [units x bins] count matrices (ndarray or scipy.sparse.csc_matrix), finest first
+    #2. `binSizes` - ndarray of the bin width (in s) of every level
+    #3. `unitIDs` - ndarray of unit IDs, one per row (order of `goodIDs`)
+    #4. `meanRates` - ndarray of the mean firing rate (in Hz) of every unit over the session
+    #5. `duration` - float, time (in s) covered by the levels
+
+    sampleRate = outDict['sampleRate']
+    unitIDs = np.asarray(outDict['goodIDs']).reshape(-1)
+    rows = getUnitRows(unitIDs, outDict['goodSpikes'])
+    samples = np.asarray(outDict['goodSamples']).reshape(-1)
+    keep = rows >= 0
+    rows, samples = rows[keep], samples[keep]
+
+    baseSamples = max(int(round(baseBin*sampleRate)), 1)
+    cols = samples//baseSamples
+    numBins = int(cols.max()) + 1 if len(cols) else 0
+
+    pyramid = {}
+    pyramid['levels'] = []
+    pyramid['binSizes'] = baseSamples*np.cumprod((1,) + tuple(factors))/sampleRate
+    for levelFactor in np.cumprod((1,) + tuple(factors)):
+        levelBins = -(-numBins//int(levelFactor))
+        pyramid['levels'].append(_levelMatrix(rows, cols//levelFactor, len(unitIDs), levelBins, denseBytes))
+    pyramid['unitIDs'] = unitIDs
+    pyramid['duration'] = numBins*baseSamples/sampleRate
+    duration = pyramid['duration'] or 1.
+    pyramid['meanRates'] = np.bincount(rows, minlength=len(unitIDs))/duration
+    return pyramid
+
+def getRasterView(pyramid, tStart=None, tStop=None, pixelWidth=1000, rows=None):
+
+    # spike counts of [tStart, tStop) with at most `pixelWidth` bins
+
+    ### Inputs:
+    #1. `pyramid` - dict returned by buildRasterPyramid
+    #2. `tStart`, `tStop` - floats, visible time range in s (default: the whole session)
+    #3. `pixelWidth` - int, number of screen pixels across the time range
+    #4. `rows` - ndarray of rows (unit order) to include, e.g. sorted by depth (default: all units)
+
+    ### Output: Dict with keys
+    #1. `counts` - ndarray [units x bins] of spike counts
+    #2. `edges` - ndarray of bin edges (in s)
+    #3. `binSize` - float bin width (in s)
+    #4. `level` - int, pyramid level the view was read from
+
+    tStart = 0. if tStart is None else max(float(tStart), 0.)
+    tStop = pyramid['duration'] if tStop is None else min(float(tStop), pyramid['duration'])
+    tStop = max(tStop, tStart)
+    pixelWidth = max(int(pixelWidth), 1)
+
+    # finest level with at most one bin per pixel (the coarsest otherwise)
+    binSizes = pyramid['binSizes']
+    numVisible = np.ceil((tStop - tStart)/binSizes)
+    fits = np.flatnonzero(numVisible <= pixelWidth)
+    level = int(fits[0]) if len(fits) else len(binSizes) - 1
+    binSize = binSizes[level]
+
+    counts = pyramid['levels'][level]
+    first = int(np.floor(tStart/binSize))
+    last = max(min(int(np.ceil(tStop/binSize)), counts.shape[1]), first)
+    counts = counts[:, first:last]
+    if rows is not None:
+        counts = counts[np.asarray(rows)]
+    if not isinstance(counts, np.ndarray):
+        counts = counts.toarray()
+
+    # still wider than the screen: sum neighbouring bins
+    group = -(-counts.shape[1]//pixelWidth)
+    if group > 1:
+        padded = np.zeros((counts.shape[0], -(-counts.shape[1]//group)*group), dtype=counts.dtype)
+        padded[:, :counts.shape[1]] = counts
+        counts = padded.reshape(counts.shape[0], -1, group).sum(axis=2)
+        binSize = binSize*group
+
+    view = {}
+    view['counts'] = counts
+    view['edges'] = first*binSizes[level] + np.arange(counts.shape[1] + 1)*binSize
+    view['binSize'] = binSize
+    view['level'] = level
+    return view
+
+def plotRaster(ax, pyramid, tStart=None, tStop=None, rows=None, follow=True, **imshowKwargs):
+
+    # population raster (spike counts per unit and bin) that is re-read from the pyramid when the x range changes
+
+    ### Inputs:
+    #1. `ax` - matplotlib Axes to draw in
+    #2. `pyramid` - dict returned by buildRasterPyramid
+    #3. `tStart`, `tStop` - floats, initial time range in s (default: the whole session)
+    #4. `rows` - ndarray of rows (unit order) to include (default: all units)
+    #5. `follow` - bool, redraw from the pyramid after zooming or panning
+    #6. `imshowKwargs` - passed to ax.imshow (e.g. cmap, vmax)
+
+    ### Output:
+    # the AxesImage
+    imshowKwargs.setdefault('cmap', 'Greys')
+    imshowKwargs.setdefault('origin', 'lower')
+    return _showView(ax, pyramid, tStart, tStop, rows, follow, lambda view: view['counts'], imshowKwargs)
+
+def plotHeatmap(ax, pyramid, tStart=None, tStop=None, rows=None, follow=True, **imshowKwargs):
+
+    # firing rate change (bin rate - mean rate of the unit, in Hz) of every unit, as the NormFire heatmap
+
+    ### Inputs:
+    #1. - #5. as plotRaster
+    #6. `imshowKwargs` - passed to ax.imshow (default: 'RdBu_r' with limits symmetric around 0 from the first view)
+
+    ### Output:
+    # the AxesImage
+    meanRates = pyramid['meanRates'] if rows is None else pyramid['meanRates'][np.asarray(rows)]
+
+    def deltaRate(view):
+        return view['counts']/view['binSize'] - meanRates[:, np.newaxis]
+
+    imshowKwargs.setdefault('cmap', 'RdBu_r')
+    if 'vmin' not in imshowKwargs and 'vmax' not in imshowKwargs:
+        pixelWidth = ax.get_window_extent().width
+        limit = np.max(np.abs(deltaRate(getRasterView(pyramid, tStart, tStop, pixelWidth, rows))), initial=0.) or 1.
+        imshowKwargs.update(vmin=-limit, vmax=limit)
+    return _showView(ax, pyramid, tStart, tStop, rows, follow, deltaRate, imshowKwargs)
+
+def _showView(ax, pyramid, tStart, tStop, rows, follow, transform, imshowKwargs):
+    numRows = len(pyramid['unitIDs']) if rows is None else len(rows)
+    view = getRasterView(pyramid, tStart, tStop, ax.get_window_extent().width, rows)
+    imshowKwargs.setdefault('interpolation', 'none')
+    imshowKwargs.setdefault('aspect', 'auto')
+    image = ax.imshow(transform(view), extent=(view['edges'][0], view['edges'][-1], -0.5, numRows - 0.5), **imshowKwargs)
+    if imshowKwargs.get('origin', 'upper') == 'upper':
+        ax.set_ylim(numRows - 0.5, -0.5)
+    ax.set_xlim(view['edges'][0], view['edges'][-1])
+    ax.set_autoscalex_on(False)
+
+    if follow:
+        updating = [False]
+
+        def update(ax):
+            if updating[0]:
+                return
+            updating[0] = True
+            try:
+                tStart, tStop = sorted(ax.get_xlim())
+                view = getRasterView(pyramid, tStart, tStop, ax.get_window_extent().width, rows)
+                image.set_data(transform(view))
+                image.set_extent((view['edges'][0], view['edges'][-1]) + tuple(image.get_extent()[2:]))
+                ax.set_xlim(tStart, tStop)
+            finally:
+                updating[0] = False
+
+        ax.callbacks.connect('xlim_changed', update)
+    return image
+
+def _levelMatrix(rows, cols, numRows, numCols, denseBytes):
+
+    # [units x bins] counts of one level, dense if small enough
+    if numRows*numCols*4 <= denseBytes:
+        counts = np.bincount(rows*numCols + cols, minlength=numRows*numCols).reshape(numRows, numCols)
+        dtype = np.uint16 if counts.size == 0 or counts.max() <= np.iinfo(np.uint16).max else np.int32
+        return counts.astype(dtype)
+
+    from scipy.sparse import csc_matrix
+    return csc_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(numRows, numCols))
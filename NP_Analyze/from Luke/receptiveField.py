@@ -0,0 +1,106 @@
+import numpy as np
+
+from psth import computePSTH
+
+# Receptive-field maps of acquireRecField.py grid scans. The script shuffles the meshgrid of mirror (x, y) voltages
+# with a fixed seed, tiles it `trial_repeats` times and pulses the laser in the middle of every region's dwell, so the
+# whole schedule (which grid position was stimulated when) is reconstructed from the settings alone. The spikes of all
+# units after every pulse are counted in one computePSTH pass and scattered back onto the grid.
+
+def getRecFieldSchedule(settings, seed=89786, positions=None):
+
+    # the stimulation schedule of an acquireRecField.py session
+
+    ### Inputs:
+    #1. `settings` - dict of the session settings (uses `Fs`, `xV`, `yV`, `stepV`, `time_per_region`, `trial_repeats`)
+    #2. `seed` - int, seed of the np.random.shuffle in acquireRecField.py
+    #3. `positions` - ndarray (regions x 2) of the (x, y) of every region, e.g. the saved acRecField_<date>_positions.npy
+    #   or getPositionsFromAO(ao_data, ...); the schedule is then read from it instead of re-shuffled
+
+    ### Output: Dict with keys
+    #1. `x`, `y` - ndarrays of the grid voltages along each mirror axis
+    #2. `gridIndex` - ndarray (regions,) of the grid position (x index * len(y) + y index) of every region
+    #3. `repeat` - ndarray (regions,) of the repeat every region belongs to
+    #4. `onsets` - ndarray (regions,) of laser pulse onsets (in s from the first output sample)
+
+    # same grid as acquireRecField.py (including the float np.arange end points)
+    x = np.arange(settings['xV'] - 0.5, settings['xV'] + 0.5, settings['stepV'])
+    y = np.arange(settings['yV'] - 0.5, settings['yV'] + 0.5, settings['stepV'])
+    numGrid = len(x)*len(y)
+
+    if positions is None:
+        # shuffling the grid indices with the same seed gives the same permutation as shuffling the combinations
+        order = np.arange(numGrid)
+        np.random.RandomState(seed).shuffle(order)
+        gridIndex = np.tile(order, settings['trial_repeats'])
+    else:
+        positions = np.asarray(positions, dtype=np.float64)
+        xIndex = np.clip(np.round((positions[:, 0] - x[0])/settings['stepV']).astype(np.int64), 0, len(x) - 1)
+        yIndex = np.clip(np.round((positions[:, 1] - y[0])/settings['stepV']).astype(np.int64), 0, len(y) - 1)
+        gridIndex = xIndex*len(y) + yIndex
+
+    # laser onset of every region, as waveformBuilder.regionPulses (laser_duration of 0.0001 s in acquireRecField.py)
+    samplesPerRegion = int(settings['Fs'] * settings['time_per_region'])
+    laserSamples = int(settings['Fs'] * 0.0001)
+    regionEnds = (np.arange(len(gridIndex)) + 1) * samplesPerRegion
+    onsets = ((regionEnds - (samplesPerRegion / 2)).astype(np.int64) - laserSamples)/settings['Fs']
+
+    schedule = {}
+    schedule['x'] = x
+    schedule['y'] = y
+    schedule['gridIndex'] = gridIndex
+    schedule['repeat'] = np.arange(len(gridIndex))//numGrid
+    schedule['onsets'] = onsets
+    return schedule
+
+def getPositionsFromAO(ao_data, settings):
+
+    # (x, y) of every region read from a saved ao_data (the mirror command in the middle of each dwell)
+    samplesPerRegion = int(settings['Fs'] * settings['time_per_region'])
+    numRegions = ao_data.shape[1]//samplesPerRegion
+    return np.asarray(ao_data)[:, np.arange(numRegions)*samplesPerRegion + samplesPerRegion//2].T
+
+def computeRFMaps(outDict, schedule, window=(0., 0.015), offset=0, unitIDs=None, unitChunk=64):
+
+    # spike counts after every laser pulse and the receptive-field map of every unit
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession)
+    #2. `schedule` - dict returned by getRecFieldSchedule
+    #3. `window` - (start, stop) in s relative to each pulse onset in which spikes are counted
+    #4. `offset` - float, time (in s) of the first DAQ output sample in the recording (e.g. the first sync rising edge)
+    #5. `unitIDs` - ndarray of units to include (default: `goodIDs`)
+    #6. `unitChunk` - int, units processed per pass (see computePSTH)
+
+    ### Output: Dict with keys
+    #1. `counts` - ndarray [units x grid positions x repeats] of spike counts (0 where a position was not visited)
+    #2. `maps` - ndarray [units x len(x) x len(y)] of the mean firing rate (in Hz) in the window at every position
+    #3. `visits` - ndarray [len(x) x len(y)] of the number of pulses at every position
+    #4. `x`, `y`, `unitIDs` - axes of the maps and units of the rows
+
+    x, y = schedule['x'], schedule['y']
+    numGrid = len(x)*len(y)
+    numRepeats = int(schedule['repeat'].max()) + 1 if len(schedule['repeat']) else 0
+
+    # one window (one bin) per pulse for all units
+    psth = computePSTH(outDict, schedule['onsets'] + offset, window=window, binSize=window[1] - window[0],
+                       unitIDs=unitIDs, unitChunk=unitChunk)
+    regionCounts = psth['counts'][:, :, 0]
+
+    counts = np.zeros((regionCounts.shape[0], numGrid, numRepeats), dtype=regionCounts.dtype)
+    counts[:, schedule['gridIndex'], schedule['repeat']] = regionCounts
+    visits = np.bincount(schedule['gridIndex'], minlength=numGrid)
+    spikeSums = np.zeros((regionCounts.shape[0], numGrid))
+    np.add.at(spikeSums.T, schedule['gridIndex'], regionCounts.T)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rates = spikeSums/visits[np.newaxis, :]/(window[1] - window[0])
+
+    rfMaps = {}
+    rfMaps['counts'] = counts
+    rfMaps['maps'] = rates.reshape(-1, len(x), len(y))
+    rfMaps['visits'] = visits.reshape(len(x), len(y))
+    rfMaps['x'] = x
+    rfMaps['y'] = y
+    rfMaps['unitIDs'] = psth['unitIDs']
+    return rfMaps
@@ -0,0 +1,149 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+
+# Content-addressed disk cache for derived analysis arrays (rosters, masks, depths, clustering inputs).
+# An entry is keyed by a hash of the function (name, bytecode and an explicit version), its parameters and the identity
+# of the files it was computed from (size and mtime, or a hash of the contents), so a re-sort (new spike_times.npy) or
+# an edited function simply misses. Only the bytecode of the cached function itself is hashed: a change in a function
+# it calls (binSpikes, importKS, computeUnitGeometry, ...) is not seen, so bump the `version` of the callers then.
+# Parameters must be JSON values, ndarrays, numpy scalars, tuples or sets; anything else raises a TypeError (its repr
+# could hold a memory address, making a key that never hits).
+# Entries are single files named by their key; a hit refreshes the file's mtime and the oldest entries are evicted
+# once the folder exceeds `maxBytes` (LRU), so several processes can share a cache folder without a shared index.
+
+cacheFolder = 'result_cache'
+
+class ResultCache:
+
+    def __init__(self, cacheDir, maxBytes=2*2**30, contentHash=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.contentHash = contentHash
+        self.hits = 0
+        self.misses = 0
+
+    def makeKey(self, name, sourcePaths, params):
+
+        # sha256 of the function name, the source file identities and the parameters
+        identity = {'name': name, 'sources': [fileIdentity(path, self.contentHash) for path in sourcePaths],
+                    'params': params}
+        return hashlib.sha256(json.dumps(identity, sort_keys=True, default=_canonical).encode()).hexdigest()
+
+    def get(self, key):
+
+        # cached value of `key`, or None
+        for extension, load in (('.npy', np.load), ('.pkl', _loadPickle)):
+            path = os.path.join(self.cacheDir, key + extension)
+            try:
+                value = load(path)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                continue
+            try:
+                os.utime(path) # most recently used
+            except OSError:
+                pass
+            return value
+        return None
+
+    def put(self, key, value):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        isArray = isinstance(value, np.ndarray) and value.dtype != object
+        path = os.path.join(self.cacheDir, key + ('.npy' if isArray else '.pkl'))
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            if isArray:
+                np.save(f, value)
+            else:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, path)
+        self.evict()
+
+    def getOrCompute(self, name, sourcePaths, params, compute):
+
+        # cached result of compute() for these sources and parameters (computed and stored on a miss)
+
+        ### Inputs:
+        #1. `name` - str identifying the computation (see funcName; include its version)
+        #2. `sourcePaths` - list of str, files the result is derived from
+        #3. `params` - dict of parameters (JSON-serializable; ndarrays are hashed; TypeError for other objects)
+        #4. `compute` - function without arguments returning the result
+
+        ### Output:
+        # the result (ndarrays are returned as loaded from the cache on a hit)
+        key = self.makeKey(name, sourcePaths, params)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        try:
+            self.put(key, value)
+        except (OSError, pickle.PicklingError, TypeError) as e:
+            print("Warning: could not cache {} ({}).".format(name, e))
+        return value
+
+    def evict(self):
+
+        # delete least recently used entries until the cache fits in maxBytes
+        try:
+            with os.scandir(self.cacheDir) as entries:
+                files = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in entries
+                         if entry.is_file() and not entry.name.endswith('.tmp')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        try:
+            with os.scandir(self.cacheDir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+def funcName(func, version=None):
+
+    # module, name, a hash of the bytecode of `func` and `version`, so editing the function invalidates its entries.
+    # Functions called by `func` are not hashed: bump `version` when one of them changes.
+    code = getattr(func, '__code__', None)
+    codeHash = hashlib.sha256(code.co_code + repr(code.co_consts).encode()).hexdigest()[:16] if code else ''
+    name = '{}.{}:{}'.format(func.__module__, getattr(func, '__qualname__', repr(func)), codeHash)
+    return name if version is None else '{}:v{}'.format(name, version)
+
+def fileIdentity(path, contentHash=False):
+
+    # [size, mtime] of a file, or [size, sha256 of its contents] with `contentHash`
+    stat = os.stat(path)
+    if not contentHash:
+        return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**24), b''):
+            digest.update(block)
+    return [os.path.basename(path), stat.st_size, digest.hexdigest()]
+
+def _canonical(value):
+    if isinstance(value, np.ndarray):
+        return [str(value.dtype), value.shape, hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (tuple, set)):
+        return sorted(value) if isinstance(value, set) else list(value)
+    raise TypeError("Cache parameter of type {} cannot be part of a cache key.".format(type(value).__name__))
+
+def _loadPickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
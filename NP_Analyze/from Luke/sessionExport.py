@@ -0,0 +1,218 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+from spikeIndex import getUnitRows
+
+# Columnar export of sessions for queries across animals. Every session is written as two tables, partitioned by
+# session (hive layout: <root>/spikes/session=<name>/, <root>/units/session=<name>/):
+#   spikes - unit, sample, epoch (one row per good spike, in time order)
+#   units  - unit, good, label, siteDepth, nSpikes, unitDepth, posX, posY, layer (one row per cluster)
+# with one fixed schema per table (spikesSchema, unitsSchema: uint32 units/samples/spike counts, int8 epochs/layers,
+# float32 depths, string labels), so every session has the same column types. Samples past the uint32 range (~40 h at
+# 30 kHz) are written as int64 instead (wideColumns); readSessions reads `sample` as int64, a safe widening of both.
+# With pyarrow the tables are Parquet files and readSessions pushes column selection and filters down to the files
+# (only matching sessions and row groups are read). Without pyarrow every column is a .npy file in the partition
+# folder (labels as fixed-width unicode, loaded without pickle); only the selected columns are memory-mapped and the
+# filters are applied after loading.
+
+spikesTable = 'spikes'
+unitsTable = 'units'
+spikesSchema = {'unit': np.uint32, 'sample': np.uint32, 'epoch': np.int8}
+unitsSchema = {'unit': np.uint32, 'good': np.bool_, 'label': np.str_, 'siteDepth': np.float32, 'nSpikes': np.uint32,
+               'unitDepth': np.float32, 'posX': np.float32, 'posY': np.float32, 'layer': np.int8}
+wideColumns = {'sample': np.int64} # checked fallback for values outside the schema dtype
+
+def getSpikeColumns(outDict, epochs=None):
+
+    # compact columns of the spikes table
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession); uses `goodIDs`, `goodSpikes`, `goodSamples`, `sampleRate`
+    #2. `epochs` - list of (tStart, tStop, label) in s (e.g. [(0, 180, 0), (180, 360, 1)]); spikes outside get -1
+
+    ### Output:
+    # Dict of ndarrays: `unit`, `sample`, `epoch`
+
+    spikes = np.asarray(outDict['goodSpikes']).reshape(-1)
+    samples = np.asarray(outDict['goodSamples']).reshape(-1)
+    keep = getUnitRows(outDict['goodIDs'], spikes) >= 0
+    spikes, samples = spikes[keep], samples[keep]
+
+    epoch = np.full(len(samples), -1, dtype=np.int64)
+    for tStart, tStop, label in (epochs or []):
+        epoch[(samples >= tStart*outDict['sampleRate']) & (samples < tStop*outDict['sampleRate'])] = label
+
+    columns = {}
+    columns['unit'] = spikes
+    columns['sample'] = samples
+    columns['epoch'] = epoch
+    return _applySchema(columns, spikesSchema)
+
+def getUnitColumns(outDict):
+
+    # compact columns of the unit table (geometry columns are NaN / -1 for units without them)
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession); uses `clusterIDs`, `goodIDs`, `labels`, `depths`,
+    #   `nSpikes` and `unitPosXY`, `unitDepths`, `layers` if present
+
+    ### Output:
+    # Dict of ndarrays: `unit`, `good`, `label`, `siteDepth`, `nSpikes`, `unitDepth`, `posX`, `posY`, `layer`
+
+    clusterIDs = np.asarray(outDict['clusterIDs']).reshape(-1)
+    goodRows = getUnitRows(outDict['goodIDs'], clusterIDs)
+    isGood = goodRows >= 0
+
+    columns = {}
+    columns['unit'] = clusterIDs
+    columns['good'] = isGood
+    columns['label'] = outDict['labels'] # KSLabel after the manual curation, as in importKS
+    columns['siteDepth'] = np.asarray(outDict['depths'], dtype=np.float32)
+    columns['nSpikes'] = np.asarray(outDict['nSpikes'])
+
+    # per good unit geometry, scattered onto the cluster rows
+    goodValues = {'unitDepth': outDict['unitDepths'] if 'unitDepths' in outDict else None,
+                  'posX': outDict['unitPosXY'][0] if 'unitPosXY' in outDict else None,
+                  'posY': outDict['unitPosXY'][1] if 'unitPosXY' in outDict else None}
+    for name, values in goodValues.items():
+        columns[name] = np.full(len(clusterIDs), np.nan, dtype=np.float32)
+        if values is not None:
+            columns[name][isGood] = np.asarray(values)[goodRows[isGood]]
+    columns['layer'] = np.full(len(clusterIDs), -1, dtype=np.int8)
+    if 'layers' in outDict:
+        columns['layer'][isGood] = np.asarray(outDict['layers'])[goodRows[isGood]]
+    return _applySchema(columns, unitsSchema)
+
+def exportSession(outDict, rootPath, sessionName, epochs=None, rowGroupSize=2**20):
+
+    # write the spikes and unit tables of one session under `rootPath` (replacing a previous export of the session)
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (or a KSSession)
+    #2. `rootPath` - str, folder of the exported sessions
+    #3. `sessionName` - str, partition value of the session (e.g. '2024-01-03_ALC4_day1')
+    #4. `epochs` - list of (tStart, tStop, label) in s, see getSpikeColumns
+    #5. `rowGroupSize` - int, rows per Parquet row group (the unit of filter pushdown)
+
+    ### Output:
+    # Dict of the written partition folders (`spikes`, `units`)
+    written = {}
+    for table, columns in ((spikesTable, getSpikeColumns(outDict, epochs)), (unitsTable, getUnitColumns(outDict))):
+        written[table] = _writePartition(os.path.join(rootPath, table, 'session={}'.format(sessionName)), columns, rowGroupSize)
+    return written
+
+def readSessions(rootPath, table=spikesTable, columns=None, filters=None, sessions=None):
+
+    # read exported sessions into a DataFrame, reading only the selected columns and sessions
+
+    ### Inputs:
+    #1. `rootPath` - str, folder of the exported sessions
+    #2. `table` - 'spikes' or 'units'
+    #3. `columns` - list of column names (default: all); 'session' is the partition column
+    #4. `filters` - list of (column, op, value) conditions joined by and, op in ==, !=, <, <=, >, >=, in
+    #   e.g. [('good', '==', True), ('layer', '==', 2)]
+    #5. `sessions` - list of session names to read (default: all)
+
+    ### Output:
+    # pandas DataFrame (with a `session` column unless `columns` leaves it out)
+    filters = list(filters or [])
+    if sessions is not None:
+        filters.append(('session', 'in', list(sessions)))
+
+    try:
+        import pyarrow.dataset as ds
+    except ImportError:
+        return _readNpyPartitions(os.path.join(rootPath, table), columns, filters)
+
+    import pyarrow as pa
+    schema = pa.schema([(name, _arrowType(wideColumns.get(name, dtype))) for name, dtype in _schemas[table].items()] + [('session', pa.string())])
+    dataset = ds.dataset(os.path.join(rootPath, table), schema=schema, format='parquet', partitioning='hive')
+    expression = None
+    for column, op, value in filters:
+        condition = _arrowCondition(ds.field(column), op, value)
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+_schemas = {spikesTable: spikesSchema, unitsTable: unitsSchema}
+
+def _arrowType(dtype):
+    import pyarrow as pa
+    return pa.string() if dtype is np.str_ else pa.from_numpy_dtype(dtype)
+
+def _applySchema(columns, schema):
+
+    # cast every column to its schema dtype; integer values outside its range use the wideColumns dtype or raise
+    for name, dtype in schema.items():
+        values = np.asarray(columns[name])
+        if np.issubdtype(dtype, np.integer) and values.size:
+            low, high = int(values.min()), int(values.max())
+            if low < np.iinfo(dtype).min or high > np.iinfo(dtype).max:
+                if name not in wideColumns:
+                    raise ValueError("Column '{}' has values in [{}, {}], outside the {} range of the schema.".format(name, low, high, np.dtype(dtype).name))
+                print("Warning: column '{}' does not fit {}, writing it as {}.".format(name, np.dtype(dtype).name, np.dtype(wideColumns[name]).name))
+                dtype = wideColumns[name]
+        columns[name] = values.astype(dtype)
+    return columns
+
+def _writePartition(partitionPath, columns, rowGroupSize):
+    os.makedirs(partitionPath, exist_ok=True)
+    for path in glob.glob(os.path.join(partitionPath, '*')):
+        os.remove(path)
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        for name, values in columns.items():
+            np.save(os.path.join(partitionPath, name + '.npy'), values)
+        return partitionPath
+
+    tablePath = os.path.join(partitionPath, 'part-0.parquet')
+    pq.write_table(pa.table(columns), tablePath + '.tmp', row_group_size=rowGroupSize, compression='zstd')
+    os.replace(tablePath + '.tmp', tablePath)
+    return partitionPath
+
+def _readNpyPartitions(tablePath, columns, filters):
+
+    # filters on the session are applied to the folder names before anything is loaded
+    sessionFilters = [condition for condition in filters if condition[0] == 'session']
+    columnFilters = [condition for condition in filters if condition[0] != 'session']
+    frames = []
+    for partitionPath in sorted(glob.glob(os.path.join(tablePath, 'session=*'))):
+        session = os.path.basename(partitionPath)[len('session='):]
+        if not all(_npyCondition(np.array([session]), op, value)[0] for _, op, value in sessionFilters):
+            continue
+
+        names = columns or sorted(os.path.basename(path)[:-4] for path in glob.glob(os.path.join(partitionPath, '*.npy')))
+        needed = [name for name in dict.fromkeys(list(names) + [column for column, _, _ in columnFilters]) if name != 'session']
+        data = {name: np.load(os.path.join(partitionPath, name + '.npy'), mmap_mode='r') for name in needed}
+        if data:
+            numRows = len(next(iter(data.values())))
+        else:
+            # only `session` requested: the rows are counted from any column of the partition
+            anyColumn = sorted(glob.glob(os.path.join(partitionPath, '*.npy')))
+            numRows = len(np.load(anyColumn[0], mmap_mode='r')) if anyColumn else 0
+        keep = np.ones(numRows, dtype=bool)
+        for column, op, value in columnFilters:
+            keep &= _npyCondition(data[column], op, value)
+
+        frame = pd.DataFrame({name: np.asarray(data[name][keep], dtype=wideColumns.get(name)) for name in names if name != 'session'},
+                             index=pd.RangeIndex(int(keep.sum())))
+        if 'session' in names or columns is None:
+            frame['session'] = session
+        frames.append(frame if columns is None else frame[list(columns)])
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+def _npyCondition(values, op, value):
+    if op == 'in':
+        return np.isin(values, list(value))
+    return {'==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal,
+            '>': np.greater, '>=': np.greater_equal}[op](values, value)
+
+def _arrowCondition(field, op, value):
+    if op == 'in':
+        return field.isin(list(value))
+    return {'==': field == value, '!=': field != value, '<': field < value, '<=': field <= value,
+            '>': field > value, '>=': field >= value}[op]
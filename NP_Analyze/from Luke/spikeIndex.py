@@ -0,0 +1,146 @@
+import os
+import json
+import numpy as np
+
+# per-unit spike index (CSR layout): the spikes of all units sorted by unit, plus an offsets array so that the
+# spikes of unit row r are samples[offsets[r]:offsets[r+1]]. Saved to <kilosort folder>/spike_index/ so it is
+# built only once per sort, and memory-mapped on load.
+
+indexFolder = 'spike_index'
+sourceFiles = ('spike_times.npy', 'spike_clusters.npy', 'cluster_info.tsv')
+
+def getUnitRows(goodIDs, spikeClusters):
+
+    # map the cluster ID of every spike to the row of its unit in `goodIDs` with one lookup table
+
+    ### Inputs:
+    #1. `goodIDs` - ndarray of unit IDs, one row per unit
+    #2. `spikeClusters` - ndarray of cluster IDs (one per spike)
+
+    ### Output:
+    # ndarray (int64) of row indices, -1 for spikes whose cluster is not in `goodIDs`
+
+    goodIDs = np.asarray(goodIDs).reshape(-1).astype(np.int64)
+    spikeClusters = np.asarray(spikeClusters).reshape(-1).astype(np.int64)
+    if len(spikeClusters) == 0 or len(goodIDs) == 0:
+        return np.full(len(spikeClusters), -1, dtype=np.int64)
+
+    maxID = max(int(spikeClusters.max()), int(goodIDs.max()))
+    lookup = np.full(maxID + 1, -1, dtype=np.int64)
+    lookup[goodIDs] = np.arange(len(goodIDs))
+    return lookup[spikeClusters]
+
+def buildSpikeIndex(unitIDs, spikeClusters, spikeSamples):
+
+    # stable sort of the spikes by unit and the offsets of every unit in the sorted array
+
+    ### Inputs:
+    #1. `unitIDs` - ndarray of unit IDs to index (e.g. `goodIDs`), one row per unit
+    #2. `spikeClusters` - ndarray of cluster IDs (one per spike)
+    #3. `spikeSamples` - ndarray of spike samples (one per spike), spikes of other clusters are dropped
+
+    ### Output: Dict with keys
+    #1. `unitIDs` - ndarray of indexed unit IDs (sorted, one row per unit)
+    #2. `offsets` - ndarray (int64, len(unitIDs)+1), spikes of row r are [offsets[r], offsets[r+1])
+    #3. `samples` - ndarray (int64) of spike samples grouped by unit, in time order within each unit
+    #4. `order` - ndarray (int64) with the position of every indexed spike in the input arrays
+
+    unitIDs = np.unique(np.asarray(unitIDs).reshape(-1))
+    spikeSamples = np.asarray(spikeSamples).reshape(-1)
+    rows = getUnitRows(unitIDs, spikeClusters)
+    order = np.flatnonzero(rows >= 0)
+    rows = rows[order]
+
+    # kilosort spike times are already sorted, so a stable sort by unit keeps time order within each unit
+    if np.all(np.diff(spikeSamples[order]) >= 0):
+        order = order[np.argsort(rows, kind='stable')]
+    else:
+        order = order[np.lexsort((spikeSamples[order], rows))]
+
+    spikeIndex = {}
+    spikeIndex['unitIDs'] = unitIDs
+    spikeIndex['offsets'] = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(unitIDs))))).astype(np.int64)
+    spikeIndex['samples'] = spikeSamples[order].astype(np.int64)
+    spikeIndex['order'] = order.astype(np.int64)
+    return spikeIndex
+
+def getUnitSamples(spikeIndex, unitID, start=None, stop=None):
+
+    # view (no copy) of the spike samples of one unit, optionally restricted to samples in [start, stop)
+
+    idRow = np.searchsorted(spikeIndex['unitIDs'], unitID)
+    if idRow == len(spikeIndex['unitIDs']) or spikeIndex['unitIDs'][idRow] != unitID:
+        raise KeyError("Unit {} is not in the spike index.".format(unitID))
+    first, last = spikeIndex['offsets'][idRow], spikeIndex['offsets'][idRow + 1]
+    unitSamples = spikeIndex['samples'][first:last]
+
+    if start is not None:
+        unitSamples = unitSamples[np.searchsorted(unitSamples, start, side='left'):]
+    if stop is not None:
+        unitSamples = unitSamples[:np.searchsorted(unitSamples, stop, side='left')]
+    return unitSamples
+
+def getUnitTimes(outDict, unitID, tStart=None, tStop=None):
+
+    # spike times (in s) of one unit, optionally restricted to [tStart, tStop)
+    sampleRate = outDict['sampleRate']
+    start = None if tStart is None else int(np.ceil(tStart*sampleRate))
+    stop = None if tStop is None else int(np.ceil(tStop*sampleRate))
+    return getUnitSamples(outDict['spikeIndex'], unitID, start, stop)/sampleRate
+
+def _sourceIdentity(folderpath):
+    identity = {}
+    for name in sourceFiles:
+        stat = os.stat(os.path.join(folderpath, name))
+        identity[name] = [stat.st_size, stat.st_mtime_ns]
+    return identity
+
+def saveSpikeIndex(spikeIndex, folderpath):
+
+    # write the index to <folderpath>/spike_index/ together with the identity of the kilosort files it was built from.
+    # source.json is removed before the arrays are replaced and written last, so an interrupted rewrite leaves no
+    # index that loadSpikeIndex accepts
+    savePath = os.path.join(folderpath, indexFolder)
+    os.makedirs(savePath, exist_ok=True)
+    sourcePath = os.path.join(savePath, 'source.json')
+    if os.path.exists(sourcePath):
+        os.remove(sourcePath)
+    for key in ('unitIDs', 'offsets', 'samples', 'order'):
+        with open(os.path.join(savePath, key + '.npy.tmp'), 'wb') as f:
+            np.save(f, spikeIndex[key])
+        os.replace(os.path.join(savePath, key + '.npy.tmp'), os.path.join(savePath, key + '.npy'))
+    with open(sourcePath + '.tmp', 'w') as f:
+        json.dump(_sourceIdentity(folderpath), f)
+    os.replace(sourcePath + '.tmp', sourcePath)
+
+def loadSpikeIndex(folderpath, unitIDs=None):
+
+    # memory-map a saved index, returns None if there is none or if the kilosort output (or `unitIDs`) changed since
+    savePath = os.path.join(folderpath, indexFolder)
+    try:
+        with open(os.path.join(savePath, 'source.json')) as f:
+            identity = json.load(f)
+        if identity != _sourceIdentity(folderpath):
+            return None
+        spikeIndex = {key: np.load(os.path.join(savePath, key + '.npy'), mmap_mode='r') for key in ('unitIDs', 'offsets', 'samples', 'order')}
+    except (OSError, ValueError):
+        return None
+
+    if unitIDs is not None and not np.array_equal(spikeIndex['unitIDs'], np.unique(unitIDs)):
+        return None
+    return spikeIndex
+
+def getSpikeIndex(folderpath, unitIDs, spikeClusters, spikeSamples, save=True):
+
+    # load the saved index of this sort, or build it (and save it next to the kilosort output)
+    spikeIndex = loadSpikeIndex(folderpath, unitIDs)
+    if spikeIndex is not None:
+        return spikeIndex
+
+    spikeIndex = buildSpikeIndex(unitIDs, spikeClusters, spikeSamples)
+    if save:
+        try:
+            saveSpikeIndex(spikeIndex, folderpath)
+        except OSError as e:
+            print("Warning: could not save the spike index ({}).".format(e))
+    return spikeIndex
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import numpy as np
+
+from benchmark_importKS import writeFakeKS
+from ksSession import KSSession
+from visualization import importKS
+from spikeIndex import indexFolder
+
+# Checks that a KSSession works in place of the importKS dict, lazily and without writing to the kilosort folder.
+# Usage: python -m pytest test_ksSession.py
+
+def test_sessionMatchesImportKS():
+    with tempfile.TemporaryDirectory() as folderpath:
+        writeFakeKS(folderpath, 20000, nClusters=50)
+        session = KSSession(folderpath, tipDepth=4000)
+        outDict = importKS(folderpath, 4000, buildIndex=False, geometry=False)
+        for key in ('sampleRate', 'goodSpikes', 'goodSamples', 'goodTimes', 'clusterIDs', 'goodIDs', 'depths', 'nSpikes', 'labels'):
+            assert np.array_equal(session[key], outDict[key]), key
+
+def test_spikeIndexKey():
+    with tempfile.TemporaryDirectory() as folderpath:
+        writeFakeKS(folderpath, 20000, nClusters=50)
+        session = KSSession(folderpath, tipDepth=4000)
+        assert 'spikeIndex' in session
+        assert session['spikeIndex'] is session.spikeIndex
+
+        # per-unit spikes come from the index alone, which is not written next to the sort
+        outDict = importKS(folderpath, 4000, buildIndex=False, geometry=False)
+        for unitID in outDict['goodIDs']:
+            assert np.array_equal(session.unitSamples(unitID), outDict['goodSamples'][outDict['goodSpikes'] == unitID])
+        for name in ('goodMask', 'goodSpikes', 'goodSamples', 'goodTimes'):
+            assert name not in session.__dict__
+        assert not os.path.exists(os.path.join(folderpath, indexFolder))
+
+def test_savedIndex():
+    with tempfile.TemporaryDirectory() as folderpath:
+        writeFakeKS(folderpath, 20000, nClusters=50)
+        built = KSSession(folderpath, tipDepth=4000, saveIndex=True).spikeIndex
+        assert os.path.exists(os.path.join(folderpath, indexFolder))
+        loaded = KSSession(folderpath, tipDepth=4000).spikeIndex
+        assert isinstance(loaded['samples'], np.memmap)
+        for key in ('unitIDs', 'offsets', 'samples', 'order'):
+            assert np.array_equal(built[key], loaded[key])
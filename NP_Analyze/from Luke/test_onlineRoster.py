@@ -0,0 +1,63 @@
+import numpy as np
+
+from onlineRoster import OnlineRoster
+
+# Checks that the running baseline of OnlineRoster matches np.mean/np.std of the final baseline bins after every
+# batch, including late spikes that land in bins already merged into the baseline.
+# Usage: python -m pytest test_onlineRoster.py
+
+unitIDs = np.array([3, 7, 11, 20])
+sampleRate = 1000
+
+def makeBatches(seed, numBatches=40, binsPerBatch=5, dt=0.5):
+
+    # spikes in time order, batch by batch, each batch also carrying late spikes anywhere in the past (cluster 5 is
+    # not a unit and must be ignored)
+    rng = np.random.default_rng(seed)
+    binSamples = int(dt*sampleRate)
+    batches = []
+    for batch in range(numBatches):
+        stop = (batch + 1)*binsPerBatch*binSamples
+        samples = rng.integers(batch*binsPerBatch*binSamples, stop, 300)
+        late = rng.integers(0, stop, 30)
+        clusters = rng.choice(np.append(unitIDs, 5), len(samples) + len(late))
+        batches.append((clusters, rng.permutation(np.concatenate((samples, late)))))
+    return batches
+
+def checkBaseline(roster, limit):
+    baselineBins = roster.getRoster()[:, :min(roster.finalBins, limit)]
+    assert roster.baselineCount == baselineBins.shape[1]
+    if baselineBins.shape[1]:
+        assert np.allclose(roster.baseline, np.mean(baselineBins, axis=1))
+        assert np.allclose(roster.baselineStd, np.sqrt(np.var(baselineBins, axis=1)))
+
+def test_baselineMatchesNumpy():
+    roster = OnlineRoster(unitIDs, dt=0.5, sampleRate=sampleRate, lagBins=3)
+    allClusters, allSamples = [], []
+    for clusters, samples in makeBatches(0):
+        roster.addSpikes(clusters, samples)
+        checkBaseline(roster, np.inf)
+        allClusters.append(clusters)
+        allSamples.append(samples)
+
+    # the roster is the histogram of every spike so far
+    allClusters, allSamples = np.concatenate(allClusters), np.concatenate(allSamples)
+    edges = np.arange(roster.numBins + 1)*roster.binSamples
+    for row, unitID in enumerate(unitIDs):
+        assert np.array_equal(roster.getRoster()[row], np.histogram(allSamples[allClusters == unitID], edges)[0])
+
+    # once the recording moves on, every spike bin is in the baseline
+    numBins = roster.numBins
+    roster.advance(numBins + roster.lagBins, inBins=True)
+    checkBaseline(roster, np.inf)
+    assert roster.baselineCount == numBins
+    counts = roster.getRoster()[:, :numBins]
+    zScore = (counts - counts.mean(axis=1, keepdims=True))/counts.std(axis=1, keepdims=True)
+    assert np.allclose(roster.getDeltaFR(zScore=True)[:, :numBins], zScore)
+
+def test_baselineStop():
+    roster = OnlineRoster(unitIDs, dt=0.5, sampleRate=sampleRate, baselineStop=30, lagBins=1)
+    for clusters, samples in makeBatches(1):
+        roster.addSpikes(clusters, samples)
+        checkBaseline(roster, 60)
+    assert roster.baselineCount == 60
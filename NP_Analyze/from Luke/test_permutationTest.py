@@ -0,0 +1,55 @@
+import numpy as np
+
+from permutationTest import getEpochLabels, permutationTest
+
+# Checks that permutation p-values are reproducible for a fixed seed, whatever the batch size or number of workers,
+# and that whole epochs are shuffled.
+# Usage: python -m pytest test_permutationTest.py
+
+def makeRoster(seed=0, numUnits=40, numBins=240, dt=1):
+
+    # alternating 30 s spontaneous/active epochs; the first 10 units fire more in the active epochs
+    rng = np.random.default_rng(seed)
+    epochs = [(start, start + 30, (start//30) % 2) for start in range(0, numBins*dt, 30)]
+    labels, epochIDs = getEpochLabels(numBins, dt, epochs)
+    rates = np.full((numUnits, numBins), 5.)
+    rates[:10, labels == 1] = 8.
+    return rng.poisson(rates).astype(np.float64), labels, epochIDs
+
+def test_fixedSeed():
+    roster, labels, epochIDs = makeRoster()
+    first = permutationTest(roster, labels, nShuffles=1000, seed=7)
+    second = permutationTest(roster, labels, nShuffles=1000, seed=7)
+    assert np.array_equal(first['pValues'], second['pValues'])
+    assert np.array_equal(first['null'], second['null'])
+    assert not np.array_equal(first['null'], permutationTest(roster, labels, nShuffles=1000, seed=8)['null'])
+
+    # responsive units are found, the others are not
+    assert np.all(first['pValues'][:10] < 0.01)
+    assert np.mean(first['pValues'][10:] < 0.05) < 0.3
+
+def test_batchingInvariance():
+    roster, labels, epochIDs = makeRoster(1)
+    reference = permutationTest(roster, labels, epochIDs, nShuffles=1050, seed=3, alternative='greater')
+    for batchSize, nWorkers in ((1, 1), (300, 1), (5000, 1), (200, 2)):
+        result = permutationTest(roster, labels, epochIDs, nShuffles=1050, seed=3, alternative='greater',
+                                 batchSize=batchSize, nWorkers=nWorkers)
+        assert np.array_equal(result['pValues'], reference['pValues']), (batchSize, nWorkers)
+        assert np.allclose(result['null'], reference['null'], rtol=0, atol=1e-12), (batchSize, nWorkers)
+
+def test_repeatedArrangement():
+    # a shuffle equal to the observed epoch labels is counted as extreme for every unit, whatever the rounding
+    roster, labels, epochIDs = makeRoster(3, numBins=120)
+    roster = roster + np.random.default_rng(0).random(roster.shape)/3
+    result = permutationTest(roster, labels, epochIDs, nShuffles=500, seed=0)
+    repeats = np.all(np.isclose(result['null'], result['observed'][:, np.newaxis], rtol=0, atol=1e-9), axis=0).sum()
+    assert repeats > 0
+    assert np.all(result['pValues'] >= (1 + repeats)/(1 + 500))
+
+def test_epochShuffles():
+    # whole epochs are shuffled: every null statistic is one of the epoch label arrangements
+    roster, labels, epochIDs = makeRoster(2, numBins=120)
+    result = permutationTest(roster, labels, epochIDs, nShuffles=200, seed=0)
+    arrangements = [np.array(order) for order in np.ndindex(*(2,)*4) if sum(order) == 2]
+    possible = np.array([roster @ np.where(np.repeat(order, 30) == 1, 1/60, -1/60) for order in arrangements])
+    assert np.all(np.min(np.abs(result['null'].T[:, np.newaxis, :] - possible[np.newaxis]), axis=1).max(axis=1) < 1e-9)
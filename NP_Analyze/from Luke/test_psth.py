@@ -0,0 +1,48 @@
+import tempfile
+import numpy as np
+
+from benchmark_importKS import writeFakeKS
+from ksSession import KSSession
+from visualization import importKS
+from psth import computePSTH
+
+# Checks computePSTH against a naive per-trial histogram and its use of a session's spike index.
+# Usage: python -m pytest test_psth.py
+
+def test_psthMatchesHistogram():
+    rng = np.random.default_rng(0)
+    sampleRate = 30000
+    goodIDs = np.array([2, 3, 5, 8, 13, 21, 34, 55, 89, 144])
+    goodSpikes = rng.choice(goodIDs, 50000)
+    goodSamples = np.sort(rng.integers(0, 60*sampleRate, 50000))
+    outDict = {'sampleRate': sampleRate, 'goodIDs': goodIDs, 'goodSpikes': goodSpikes, 'goodSamples': goodSamples,
+               'goodTimes': goodSamples/sampleRate}
+
+    # events closer together than the window, so windows overlap and spikes count in several trials
+    eventTimes = np.sort(rng.uniform(1, 58, 40))
+    eventTimes[5] = eventTimes[4] + 0.3
+    window, binSize = (-0.5, 1.), 0.05
+    unitIDs = goodIDs[::-1][:7]
+    psth = computePSTH(outDict, eventTimes, window, binSize, unitIDs=unitIDs, unitChunk=3)
+
+    edges = window[0] + np.arange(int(round((window[1] - window[0])/binSize)) + 1)*binSize
+    assert np.allclose(psth['edges'], edges)
+    for row, unitID in enumerate(unitIDs):
+        unitTimes = outDict['goodTimes'][goodSpikes == unitID]
+        for trial, eventTime in enumerate(eventTimes):
+            expected = np.histogram(unitTimes - eventTime, edges)[0]
+            assert np.array_equal(psth['counts'][row, trial], expected), (unitID, trial)
+
+def test_psthFromSpikeIndex():
+    with tempfile.TemporaryDirectory() as folderpath:
+        writeFakeKS(folderpath, 20000, nClusters=50)
+        session = KSSession(folderpath, tipDepth=4000)
+        eventTimes = np.arange(10, 3000, 100.)
+        psth = computePSTH(session, eventTimes, window=(-0.5, 1), binSize=0.05)
+
+        # the counts come from the spike index alone
+        for name in ('goodMask', 'goodSpikes', 'goodSamples', 'goodTimes'):
+            assert name not in session.__dict__
+
+        outDict = importKS(folderpath, 4000, buildIndex=False, geometry=False)
+        assert np.array_equal(psth['counts'], computePSTH(outDict, eventTimes, window=(-0.5, 1), binSize=0.05)['counts'])
@@ -0,0 +1,122 @@
+import numpy as np
+
+# Exact k-means of 1-D unit features (firing rate changes, site depths). In 1-D the optimal clusters are contiguous
+# runs of the sorted values, so the partition minimizing the within-cluster sum of squares is found exactly by dynamic
+# programming over the sorted data (as Ckmeans.1d.dp), instead of KMeans restarts that may stop in a local optimum.
+# Each DP layer uses the monotonicity of the optimal split points (divide and conquer, O(n log n) per layer, so
+# O(k n log n) in total rather than the O(k n) of Ckmeans' SMAWK), with every recursion level evaluated as one
+# vectorized batch. kmeans1DBatch solves many sessions at once: their values are sorted together, share one prefix
+# sum, and every recursion level covers all sessions (~3x faster than a loop of kmeans1D for thousands of sets of
+# ~50 units; for a few large sets the loop is as fast). Labels are numbered by increasing centroid, so the same kind of
+# cluster gets the same label across splits and sessions.
+
+def kmeans1D(values, k):
+
+    # optimal partition of `values` into `k` clusters
+
+    ### Inputs:
+    #1. `values` - 1-D ndarray of features (one per unit)
+    #2. `k` - int, number of clusters
+
+    ### Output: Dict with keys
+    #1. `labels` - ndarray (int64) of cluster labels in the input order, 0 = lowest centroid ... k-1 = highest
+    #2. `centers` - ndarray of the k centroids (increasing)
+    #3. `inertia` - float, within-cluster sum of squares
+    #4. `breaks` - ndarray of the k-1 upper bounds between consecutive clusters (max value of each lower cluster)
+
+    return kmeans1DBatch([values], k)[0]
+
+def kmeans1DBatch(valueSets, k):
+
+    # kmeans1D of every array in `valueSets` (e.g. one feature vector per session), solved together
+
+    ### Inputs:
+    #1. `valueSets` - list of 1-D ndarrays of features
+    #2. `k` - int, number of clusters of every set
+
+    ### Output:
+    # List of kmeans1D result dicts, one per set
+
+    valueSets = [np.asarray(values, dtype=np.float64).reshape(-1) for values in valueSets]
+    lengths = np.array([len(values) for values in valueSets], dtype=np.int64)
+    for n in lengths:
+        if k < 1 or n < k:
+            raise ValueError("Cannot split {} values into {} clusters.".format(n, k))
+    if not len(valueSets):
+        return []
+
+    # all sets sorted at once (by set, then value); set s occupies x[starts[s]..ends[s]]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    setOf = np.repeat(np.arange(len(valueSets)), lengths)
+    allValues = np.concatenate(valueSets)
+    order = np.lexsort((allValues, setOf))
+    x = allValues[order]
+    prefix1 = np.concatenate(([0.], np.cumsum(x)))
+    prefix2 = np.concatenate(([0.], np.cumsum(x*x)))
+
+    def cost(first, last):
+        # sum of squares of x[first..last] (inclusive, within one set) around its mean
+        count = last - first + 1
+        sum1 = prefix1[last + 1] - prefix1[first]
+        return np.maximum(prefix2[last + 1] - prefix2[first] - sum1*sum1/count, 0.)
+
+    # layer 1: one cluster over the set's values up to i; layer j: best split whose last cluster starts at splits[j][i]
+    best = cost(starts[setOf], np.arange(len(x)))
+    splits = []
+    for layer in range(1, k):
+        best, split = _dpLayer(best, cost, starts + layer, ends)
+        splits.append(split)
+
+    # walk the splits back from the last value of every set, marking where each cluster starts
+    marks = np.zeros(len(x), dtype=np.int64)
+    last = ends
+    for layer in range(k - 1, 0, -1):
+        first = splits[layer - 1][last]
+        marks[first] += 1
+        last = first - 1
+    marks[starts[1:]] -= k - 1
+    sortedLabels = np.cumsum(marks)
+
+    labels = np.empty(len(x), dtype=np.int64)
+    labels[order] = sortedLabels
+    counts = np.bincount(setOf*k + sortedLabels, minlength=len(valueSets)*k).reshape(-1, k)
+    centers = np.bincount(setOf*k + sortedLabels, weights=x, minlength=len(valueSets)*k).reshape(-1, k)/counts
+
+    results = []
+    for s in range(len(valueSets)):
+        classify = {}
+        classify['labels'] = labels[starts[s]:ends[s] + 1]
+        classify['centers'] = centers[s]
+        classify['inertia'] = float(best[ends[s]])
+        classify['breaks'] = x[starts[s] + np.cumsum(counts[s])[:-1] - 1]
+        results.append(classify)
+    return results
+
+def _dpLayer(previous, cost, lo, hi):
+
+    # best[i] = min over first in [lo, i] of previous[first - 1] + cost(first, i), for every i in [lo, hi] of every set.
+    # The optimal `first` is non-decreasing in i, so each i is solved between the optima of its neighbours; the
+    # (i, candidate first) pairs of one recursion level of all sets are evaluated together
+    best = np.full(len(previous), np.inf)
+    split = np.zeros(len(previous), dtype=np.int64)
+    optLo, optHi = lo.copy(), hi.copy()
+
+    while len(lo):
+        mid = (lo + hi)//2
+        lengths = np.minimum(optHi, mid) - optLo + 1
+        task = np.repeat(np.arange(len(mid)), lengths)
+        first = np.repeat(optLo - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        total = previous[first - 1] + cost(first, mid[task])
+
+        # smallest total of every task (ties: smallest first, lexsort is stable)
+        ranked = np.lexsort((total, task))
+        pick = ranked[np.cumsum(lengths) - lengths]
+        best[mid] = total[pick]
+        split[mid] = first[pick]
+
+        left = lo <= mid - 1
+        right = mid + 1 <= hi
+        lo, hi, optLo, optHi = (np.concatenate((lo[left], mid[right] + 1)), np.concatenate((mid[left] - 1, hi[right])),
+                                np.concatenate((optLo[left], split[mid][right])), np.concatenate((split[mid][left], optHi[right])))
+    return best, split
@@ -0,0 +1,126 @@
+import os
+import numpy as np
+
+from spikeIndex import getUnitRows
+
+# Positions, depths and cortical layers of all units at once from the Kilosort templates.
+# The position of a template is the amplitude-weighted center of mass of the channel positions of its largest
+# channels (peak-to-peak amplitude of the unwhitened template). Units curated in phy can hold spikes of several
+# templates, so the position of a unit is the spike-count-weighted mean of its templates' positions, with the counts
+# of every (unit, template) pair taken from one bincount over the spikes. Depths are measured from the brain surface
+# like the site depths of importKS (tipDepth - tipLength - y) and layers are assigned from configurable boundaries.
+
+tipLength = 175 # the tip length of neuropixel 1.0 [unit: µm]
+layerBounds = (120, 400, 550, 850) # lower bounds of L1, L2/3, L4, L5 below the surface (mouse S1) [unit: µm]
+layerNames = ('L1', 'L2/3', 'L4', 'L5', 'L6')
+
+def getTemplatePositions(folderpath, nChannels=12, templateChunk=64):
+
+    # (x, y) center of mass of every Kilosort template
+
+    ### Inputs:
+    #1. `folderpath` - str with path to kilosort output (templates.npy, channel_positions.npy, whitening_mat_inv.npy)
+    #2. `nChannels` - int, number of largest-amplitude channels in the center of mass
+    #3. `templateChunk` - int, templates unwhitened per pass
+
+    ### Output:
+    # ndarray [templates x 2] of template positions (in µm, probe coordinates)
+
+    templates = np.load(os.path.join(folderpath, 'templates.npy'), mmap_mode='r')
+    channelPositions = np.load(os.path.join(folderpath, 'channel_positions.npy'))
+    whiteningInv = os.path.join(folderpath, 'whitening_mat_inv.npy')
+    whiteningInv = np.load(whiteningInv) if os.path.exists(whiteningInv) else None
+
+    amplitudes = np.empty((templates.shape[0], templates.shape[2]), dtype=np.float64)
+    for first in range(0, templates.shape[0], templateChunk):
+        chunk = np.asarray(templates[first:first + templateChunk], dtype=np.float64)
+        if whiteningInv is not None:
+            chunk = chunk @ whiteningInv
+        amplitudes[first:first + templateChunk] = np.ptp(chunk, axis=1)
+
+    nChannels = min(nChannels, amplitudes.shape[1])
+    top = np.argpartition(-amplitudes, nChannels - 1, axis=1)[:, :nChannels]
+    weights = np.take_along_axis(amplitudes, top, axis=1)
+    totals = weights.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.
+    return np.einsum('tc,tcd->td', weights, channelPositions[top])/totals
+
+def getUnitPositions(folderpath, unitIDs, templatePositions=None):
+
+    # (x, y) of every unit as the spike-count-weighted mean of the positions of its templates
+
+    ### Inputs:
+    #1. `folderpath` - str with path to kilosort output (spike_templates.npy, spike_clusters.npy)
+    #2. `unitIDs` - ndarray of unit IDs (e.g. `goodIDs`)
+    #3. `templatePositions` - ndarray [templates x 2] (default: getTemplatePositions(folderpath))
+
+    ### Output:
+    # ndarray [units x 2] of unit positions (NaN for units without spikes)
+
+    if templatePositions is None:
+        templatePositions = getTemplatePositions(folderpath)
+    unitIDs = np.asarray(unitIDs).reshape(-1)
+    numTemplates = len(templatePositions)
+
+    spikeClusters = np.load(os.path.join(folderpath, 'spike_clusters.npy'), mmap_mode='r').reshape(-1)
+    spikeTemplatesPath = os.path.join(folderpath, 'spike_templates.npy')
+    if not os.path.exists(spikeTemplatesPath):
+        # without curation every cluster is its own template
+        positions = np.full((len(unitIDs), 2), np.nan)
+        hasTemplate = (unitIDs >= 0) & (unitIDs < numTemplates)
+        positions[hasTemplate] = templatePositions[unitIDs[hasTemplate]]
+        return positions
+
+    spikeTemplates = np.load(spikeTemplatesPath, mmap_mode='r').reshape(-1)
+    rows = getUnitRows(unitIDs, spikeClusters)
+    keep = rows >= 0
+    pairs = rows[keep]*numTemplates + np.asarray(spikeTemplates[keep], dtype=np.int64)
+    counts = np.bincount(pairs, minlength=len(unitIDs)*numTemplates).reshape(len(unitIDs), numTemplates)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (counts @ templatePositions)/counts.sum(axis=1, keepdims=True)
+
+def getLayers(depths, bounds=layerBounds):
+
+    # layer index (into layerNames) of every depth: depths below bounds[i] and above bounds[i + 1] are layer i + 1
+    # (-1 for unknown depths)
+    depths = np.asarray(depths, dtype=np.float64)
+    layers = np.searchsorted(np.asarray(bounds), depths, side='right')
+    layers[np.isnan(depths)] = -1
+    return layers
+
+def clampDepths(siteDepth, warn=True):
+
+    # depths above the surface (negative) set to 0 (`warn`: print a warning if there are any)
+    siteDepth = np.asarray(siteDepth, dtype=np.float64)
+    if warn and np.any(siteDepth < 0):
+        print("Warning: Negative depth value found, changing to 0.")
+    return np.maximum(siteDepth, 0)
+
+def computeUnitGeometry(folderpath, unitIDs, tipDepth, tipLength=tipLength, bounds=layerBounds, nChannels=12, warn=True):
+
+    # positions, depths, depth order and layers of the units
+
+    ### Inputs:
+    #1. `folderpath` - str with path to kilosort output
+    #2. `unitIDs` - ndarray of unit IDs (e.g. `goodIDs`)
+    #3. `tipDepth` - int/float, depth of the shank tip in microns (Reading of D axis given by sensapex micromanipulator)
+    #4. `tipLength` - float, length of the tip below the deepest site in microns
+    #5. `bounds` - tuple of layer boundaries below the surface in microns (see layerBounds)
+    #6. `nChannels` - int, channels in the template center of mass
+    #7. `warn` - bool, warn about negative depths (False when the site depths of the same sort were already checked)
+
+    ### Output: Dict with keys
+    #1. `unitPosXY` - tuple of two ndarrays, (X center of mass, Y center of mass) in probe coordinates
+    #2. `unitDepths` - ndarray of unit depths below the surface (center of mass, negative depths set to 0)
+    #3. `depthIndices` - ndarray of indices into `unitIDs` from the shallowest to the deepest unit
+    #4. `layers` - ndarray of layer indices into layerNames (len(bounds) + 1 names) of every unit, -1 if unknown
+
+    positions = getUnitPositions(folderpath, unitIDs, getTemplatePositions(folderpath, nChannels))
+    unitDepths = clampDepths(tipDepth - tipLength - positions[:, 1], warn)
+
+    geometry = {}
+    geometry['unitPosXY'] = (positions[:, 0], positions[:, 1])
+    geometry['unitDepths'] = unitDepths
+    geometry['depthIndices'] = np.argsort(unitDepths, kind='stable')
+    geometry['layers'] = getLayers(unitDepths, bounds)
+    return geometry
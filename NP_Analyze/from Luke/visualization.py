@@ -2,7 +2,10 @@ import math
 import numpy as np
 import pandas as pd
 
-def importKS(folderpath,tipDepth,sampleRate=30000):
+from spikeIndex import getUnitRows, getSpikeIndex
+from unitGeometry import computeUnitGeometry, clampDepths, layerBounds as defaultLayerBounds
+
+def importKS(folderpath,tipDepth,sampleRate=30000,buildIndex=True,geometry=False,layerBounds=defaultLayerBounds):
     
     # import kilosort/phy2 outputs
 
@@ -10,6 +13,10 @@ def importKS(folderpath,tipDepth,sampleRate=30000):
     #1. `folderpath` - str with path to kilosort output
     #2. `tipDepth` - int/float, depth of the shank tip in microns (Reading of D axis given by sensapex micromanipulator)
     #3. `sampleRate` - int sample rate in Hz (find in params.py if unknown)
+    #4. `buildIndex` - bool, load (or build and save to `folderpath`/spike_index) the per-unit spike index
+    #5. `geometry` - bool, compute the unit positions, depth order and layers from the templates (see unitGeometry.py;
+    #   off by default, it reads templates.npy)
+    #6. `layerBounds` - tuple of layer boundaries below the surface in microns (default: mouse S1, unitGeometry.layerBounds)
         
     ### Output: Dict with keys
     #1. `sampleRate` - int sample rate in Hz (same as input)
@@ -20,12 +27,13 @@ def importKS(folderpath,tipDepth,sampleRate=30000):
     #6. `goodIDs` - ndarray of all units included in goodSpikes
     #7. `depths` - ndarray of recording site depth, order match with `clusterID` (counting the depth of shank)
     #8. `nSpikes` - ndarray of number of spikes 
-
-    ### Not yet implemented
-    #1. `unitPosXY` - tuple of two ndarrays, (X center of mass, Y center of mass)
-    #2. `depthIndices` - index of good units in the order of their depth
-    #3. `layers` - the cortical layer to which the depth corresponds
-    #4. 'waveforms of unit at its best site'
+    #9. `labels` - ndarray (str) of the KSLabel of every cluster after the manual curation ('good', 'mua', ...; '' if none)
+    #10. `spikeIndex` - dict, per-unit spike index of the good units (see spikeIndex.py; only if `buildIndex`)
+    #11. `unitPosXY` - tuple of two ndarrays, (X center of mass, Y center of mass) of the good units (only if `geometry`)
+    #12. `unitDepths` - ndarray of depths of the good units (template center of mass, only if `geometry`)
+    #13. `depthIndices` - index of good units in the order of their depth (only if `geometry`)
+    #14. `layers` - ndarray of the cortical layer (index into unitGeometry.layerNames) of every good unit (only if `geometry`)
+    # (mean waveforms and best sites of the units: extractWaveforms in waveforms.py)
      
     # parameters
     tipLength = 175 # the tip length of neuropixel 1.0 [unit: µm]
@@ -44,23 +52,31 @@ def importKS(folderpath,tipDepth,sampleRate=30000):
     except KeyError:
         goodIDs = np.array(clusterInfo['cluster_id'][clusterInfo['KSLabel'] == 'good'])
     
-    # compute the depth
-        siteDepth = tipDepth - tipLength - np.array(clusterInfo['depth'])
-        if any(depth < 0 for depth in siteDepth):
-            print("Warning: Negative depth value found, changing to 0.")
-            siteDepth = [0 if depth < 0 else depth for depth in siteDepth]
+    # compute the depth (negative depths are reported here only: the unit depths lie between the sites)
+    siteDepth = clampDepths(tipDepth - tipLength - np.array(clusterInfo['depth']))
+
+    # map every spike to its good unit once (-1 for spikes of other clusters)
+    spikeClusters = spikeClusters.reshape(-1)
+    isGood = getUnitRows(goodIDs, spikeClusters) >= 0
 
     # write the output
     outDict = {}
     outDict['sampleRate'] = sampleRate
-    outDict['goodSpikes'] = spikeClusters[np.array([n in goodIDs for n in spikeClusters])]
-    outDict['goodSamples'] = np.int64(spikeTimes[np.array([n in goodIDs for n in spikeClusters])].reshape(-1))
+    outDict['goodSpikes'] = spikeClusters[isGood]
+    outDict['goodSamples'] = np.int64(spikeTimes.reshape(-1)[isGood])
     outDict['goodTimes'] = outDict['goodSamples']/sampleRate
     outDict['clusterIDs'] = np.array(clusterInfo['cluster_id']) ## to get a list of cluster ids
     outDict['goodIDs'] = goodIDs
     outDict['depths'] =  siteDepth
     outDict['nSpikes'] = np.array(clusterInfo['n_spikes']) ## to get number of spikes 
-    #outDict['depthIndices'] = np.argsort(clusterInfo['depth']) ## to get an index to use for sorting by depth
+    outDict['labels'] = np.array(clusterInfo['KSLabel'].fillna(''), dtype=str) ## curated label of every cluster
+    if geometry:
+        try:
+            outDict.update(computeUnitGeometry(folderpath, goodIDs, tipDepth, tipLength, layerBounds, warn=False)) ## unitPosXY, unitDepths, depthIndices, layers
+        except FileNotFoundError as e:
+            print("Warning: no unit geometry ({}).".format(e))
+    if buildIndex:
+        outDict['spikeIndex'] = getSpikeIndex(folderpath, goodIDs, spikeClusters, spikeTimes) ## spikes of each good unit via getUnitSamples/getUnitTimes
 
     # print the number of good neurons
     print("Number of neurons pass the quality check: {}".format(len(goodIDs)))
@@ -70,17 +86,71 @@ def importKS(folderpath,tipDepth,sampleRate=30000):
     
     return outDict
  
-def getNormRoster(outDict, dt = 1):
+def binSpikes(outDict, dt = 1, edges = None, sparse = False, dtype = np.int32):
+
+    # count the spikes of every good unit per time bin in a single vectorized pass
+
+    ### Inputs:
+    #1. `outDict` - dict returned by importKS (uses `goodIDs`, `goodSpikes`, `goodTimes`)
+    #2. `dt` - float bin width in s, or a list of bin widths to get one roster per width from the same spike pass
+    #3. `edges` - ndarray of bin edges in s (overrides `dt`), spikes outside [edges[0], edges[-1]) are dropped
+    #4. `sparse` - bool, return scipy.sparse CSR matrices instead of dense arrays
+    #5. `dtype` - dtype of the counts (default int32)
+
+    ### Output:
+    # [units x bins] spike count matrix with rows in the order of `goodIDs` (a list of them if `dt` is a list)
 
-    # 
-    maxTime = int(np.ceil(np.max(outDict['goodTimes'])/dt))
+    rows = getUnitRows(outDict['goodIDs'], outDict['goodSpikes'])
+    times = np.asarray(outDict['goodTimes']).reshape(-1)
+    keep = rows >= 0
+    rows, times = rows[keep], times[keep]
     numGoodID = len(outDict['goodIDs'])
-    roster = np.zeros([numGoodID,maxTime]) 
 
-    for i in range(len(outDict['goodSpikes'])):
-        xIdx = np.where(outDict['goodIDs'] == outDict['goodSpikes'][i])
-        yIdx =  np.floor(outDict['goodTimes'][i]/dt).astype(int)
-        roster[xIdx, yIdx] += 1
+    if edges is not None:
+        edges = np.asarray(edges, dtype=np.float64)
+        cols = np.searchsorted(edges, times, side='right') - 1
+        inRange = (cols >= 0) & (cols < len(edges) - 1)
+        return _countMatrix(rows[inRange], cols[inRange], numGoodID, len(edges) - 1, sparse, dtype)
+
+    rosters = []
+    for step in np.atleast_1d(dt):
+        cols = np.floor(times/step).astype(np.int64)
+        numBins = int(np.ceil(np.max(times)/step)) if len(times) else 0
+        numBins = max(numBins, int(cols.max()) + 1 if len(cols) else 0) # a spike exactly on the last edge gets its own bin
+        rosters.append(_countMatrix(rows, cols, numGoodID, numBins, sparse, dtype))
+
+    return rosters if np.ndim(dt) else rosters[0]
+
+def _countMatrix(rows, cols, numRows, numCols, sparse, dtype, blockCells=2**22):
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        counts = csr_matrix((np.ones(len(rows), dtype=dtype), (rows, cols)), shape=(numRows, numCols))
+        counts.sum_duplicates()
+        return counts
+
+    # counted one block of columns at a time straight into the `dtype` matrix, so the int64 bincount buffer holds at
+    # most `blockCells` cells instead of the whole roster (spikes in time order are split into blocks without a sort)
+    counts = np.zeros((numRows, numCols), dtype=dtype)
+    if len(cols) and np.any(np.diff(cols) < 0):
+        order = np.argsort(cols, kind='stable')
+        rows, cols = rows[order], cols[order]
+    blockCols = max(blockCells//max(numRows, 1), 1)
+    blockStarts = np.arange(0, numCols, blockCols)
+    bounds = np.searchsorted(cols, np.append(blockStarts, numCols), side='left')
+    for block, firstCol in enumerate(blockStarts):
+        first, last = bounds[block], bounds[block + 1]
+        if first == last:
+            continue
+        width = min(blockCols, numCols - firstCol)
+        blockCounts = np.bincount(rows[first:last]*width + (cols[first:last] - firstCol), minlength=numRows*width)
+        counts[:, firstCol:firstCol + width] = blockCounts.reshape(numRows, width)
+    return counts
+
+def getNormRoster(outDict, dt = 1):
+
+    # bin the spikes of all good units
+    roster = binSpikes(outDict, dt, dtype=np.float64)
 
     # compute delta firing rate
     baseline = np.mean(roster, axis = 1)[:, np.newaxis]
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from spikeIndex import buildSpikeIndex
+
+# Mean spike waveforms of the good units read straight from the interleaved int16 binary (combined_trial.DAT).
+# Up to `maxSpikes` spikes are drawn per unit (seeded), and the snippet requests of all units are sorted by sample,
+# i.e. by file offset. Neighbouring requests are merged into blocks of about `blockSamples` samples, and every block
+# is read as one contiguous slice of the memory-mapped file. The blocks are read in file order by a small thread pool
+# (a bounded number in flight), so the disk sees near-sequential reads instead of one seek per spike. Each block's
+# snippets are added to per-unit sums as it arrives, so memory holds the sums and a few blocks, not the snippets.
+# Requests more than `maxGap` samples apart start a new block, so sparse spikes do not read the whole file.
+
+def extractWaveforms(datPath, outDict, nChannels=385, channels=None, window=(-30, 60), maxSpikes=500, unitIDs=None,
+                     seed=0, centered=True, bitVolts=0.195, blockSamples=2**15, maxGap=2**12, nThreads=4):
+
+    # mean waveform of every unit on every channel and its best channel
+
+    ### Inputs:
+    #1. `datPath` - str, path to the int16 binary the spikes were sorted from (e.g. combined_trial.DAT)
+    #2. `outDict` - dict returned by importKS (or a KSSession); uses `spikeIndex` if present
+    #3. `nChannels` - int, number of interleaved channels (385 for Neuropixels AP + sync)
+    #4. `channels` - ndarray of channels to read (default: all but the last, the sync channel)
+    #5. `window` - (first, last) sample of the snippet relative to the spike sample, last excluded
+    #6. `maxSpikes` - int, largest number of spikes averaged per unit (random subset, None: all spikes)
+    #7. `unitIDs` - ndarray of units to include (default: `goodIDs`)
+    #8. `seed` - int, seed of the spike subsets
+    #9. `centered` - bool, subtract the mean of every snippet on every channel (removes offsets and slow drift)
+    #10. `bitVolts` - float, µV per int16 step (0.195 for Neuropixels 1.0 AP); 1 keeps raw units
+    #11. `blockSamples` - int, span (in samples) of the requests read as one contiguous block
+    #12. `maxGap` - int, largest gap (in samples) between requests read through rather than skipped
+    #13. `nThreads` - int, number of reader threads
+
+    ### Output: Dict with keys
+    #1. `mean` - ndarray (float32) [units x window samples x channels] of mean waveforms
+    #2. `bestChannels` - ndarray of the channel with the largest peak-to-peak mean waveform of every unit
+    #3. `bestWaveforms` - ndarray (float32) [units x window samples], mean waveform on the best channel
+    #4. `peakToPeak` - ndarray (float32) [units x channels] of peak-to-peak amplitudes of the mean waveforms
+    #5. `nSpikes` - ndarray of the number of spikes averaged for every unit
+    #6. `unitIDs`, `channels`, `window` - units of the rows, channels of the columns and the snippet window
+
+    fileSamples = os.path.getsize(datPath)//(2*nChannels)
+    data = np.memmap(datPath, dtype=np.int16, mode='r', shape=(fileSamples, nChannels))
+    channels = np.arange(nChannels - 1) if channels is None else np.asarray(channels).reshape(-1)
+    unitIDs = np.asarray(outDict['goodIDs'] if unitIDs is None else unitIDs).reshape(-1)
+    numSamples = window[1] - window[0]
+
+    # spike subsets of all units, as (sample, unit row) requests sorted by file offset
+    samples, rows = _drawSpikes(outDict, unitIDs, maxSpikes, seed)
+    inFile = (samples + window[0] >= 0) & (samples + window[1] <= fileSamples)
+    samples, rows = samples[inFile], rows[inFile]
+    order = np.argsort(samples, kind='stable')
+    samples, rows = samples[order], rows[order]
+
+    sums = np.zeros((len(unitIDs), numSamples, len(channels)), dtype=np.float64)
+    counts = np.bincount(rows, minlength=len(unitIDs))
+
+    def readBlock(block):
+        first, last = block
+        blockFirst = samples[first] + window[0]
+        blockData = np.array(data[blockFirst:samples[last - 1] + window[1]])
+        snippetRows = (samples[first:last] - samples[first])[:, np.newaxis] + np.arange(numSamples)
+        snippets = blockData[snippetRows[:, :, np.newaxis], channels].astype(np.float32)
+        if centered:
+            snippets -= snippets.mean(axis=1, keepdims=True)
+        return first, last, snippets
+
+    def addBlock(result):
+        first, last, snippets = result
+        blockRows = rows[first:last]
+        byUnit = np.argsort(blockRows, kind='stable')
+        unitStarts = np.flatnonzero(np.diff(blockRows[byUnit], prepend=-1))
+        sums[blockRows[byUnit][unitStarts]] += np.add.reduceat(snippets[byUnit], unitStarts, axis=0, dtype=np.float64)
+
+    # blocks are read in file order, with at most 2 * nThreads blocks read ahead
+    blocks = _planBlocks(samples, blockSamples, maxGap)
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        pending = []
+        for block in blocks:
+            pending.append(executor.submit(readBlock, block))
+            if len(pending) >= 2*nThreads:
+                addBlock(pending.pop(0).result())
+        for future in pending:
+            addBlock(future.result())
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums*bitVolts/counts[:, np.newaxis, np.newaxis]).astype(np.float32)
+    peakToPeak = np.ptp(mean, axis=1) if numSamples else np.zeros((len(unitIDs), len(channels)), dtype=np.float32)
+    bestColumns = np.argmax(np.nan_to_num(peakToPeak, nan=-1.), axis=1) if len(channels) else np.zeros(len(unitIDs), dtype=np.int64)
+
+    waveforms = {}
+    waveforms['mean'] = mean
+    waveforms['bestChannels'] = channels[bestColumns] if len(channels) else bestColumns
+    waveforms['bestWaveforms'] = mean[np.arange(len(unitIDs)), :, bestColumns] if len(channels) else mean[:, :, 0]
+    waveforms['peakToPeak'] = peakToPeak
+    waveforms['nSpikes'] = counts
+    waveforms['unitIDs'] = unitIDs
+    waveforms['channels'] = channels
+    waveforms['window'] = window
+    return waveforms
+
+def _drawSpikes(outDict, unitIDs, maxSpikes, seed):
+
+    # up to maxSpikes random spike samples of every unit (all of them for units with fewer spikes)
+    if 'spikeIndex' in outDict:
+        spikeIndex = outDict['spikeIndex']
+    else:
+        spikeIndex = buildSpikeIndex(outDict['goodIDs'], outDict['goodSpikes'], outDict['goodSamples'])
+    indexRows = np.minimum(np.searchsorted(spikeIndex['unitIDs'], unitIDs), len(spikeIndex['unitIDs']) - 1)
+    if len(unitIDs) and np.any(spikeIndex['unitIDs'][indexRows] != unitIDs):
+        raise KeyError("Units {} are not in the spike index.".format(unitIDs[spikeIndex['unitIDs'][indexRows] != unitIDs]))
+
+    rng = np.random.default_rng(seed)
+    samples, rows = [], []
+    for row, indexRow in enumerate(indexRows):
+        first, last = spikeIndex['offsets'][indexRow], spikeIndex['offsets'][indexRow + 1]
+        picks = np.arange(first, last)
+        if maxSpikes is not None and len(picks) > maxSpikes:
+            picks = np.sort(rng.choice(picks, maxSpikes, replace=False))
+        samples.append(np.asarray(spikeIndex['samples'][picks], dtype=np.int64))
+        rows.append(np.full(len(picks), row, dtype=np.int64))
+    if not samples:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(samples), np.concatenate(rows)
+
+def _planBlocks(samples, blockSamples, maxGap):
+
+    # (first, last) ranges of the sorted requests read as one block: a new block starts after a gap of more than
+    # maxGap samples or every blockSamples samples within a run of close requests
+    if len(samples) == 0:
+        return []
+    newRun = np.concatenate(([True], np.diff(samples) > maxGap))
+    runStarts = samples[newRun][np.cumsum(newRun) - 1]
+    part = (samples - runStarts)//blockSamples
+    starts = np.flatnonzero(newRun | np.concatenate(([True], np.diff(part) != 0)))
+    return list(zip(starts.tolist(), np.append(starts[1:], len(samples)).tolist()))
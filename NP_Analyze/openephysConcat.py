@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import queue
+import errno
+import threading
+import numpy as np
+
+# Streaming concatenation of OpenEphys continuous.dat files into a single combined_trial.DAT.
+# Files are copied in fixed-size chunks (zero-copy copy_file_range/sendfile where the OS supports it, otherwise a
+# reader thread and the writer overlap on rotating buffers). A sidecar (combined_trial.json) lists every recording
+# with its sample offset in the combined file; it is also what allows an interrupted concatenation to resume.
+
+combinedName = 'combined_trial.DAT'
+sidecarName = 'combined_trial.json'
+bytesPerSample = 2 # int16
+
+def openephys_concat(recording_filepaths, save_path, nChannels=385, chunkBytes=64*2**20, resume=True):
+
+    # concatenate the continuous.dat files in `recording_filepaths` (in order) into `save_path`/combined_trial.DAT
+
+    ### Inputs:
+    #1. `recording_filepaths` - list of str, paths to continuous.dat files (in recording order)
+    #2. `save_path` - str, folder for combined_trial.DAT and its sidecar combined_trial.json
+    #3. `nChannels` - int, number of channels interleaved in each file (385 for Neuropixels AP + sync)
+    #4. `chunkBytes` - int, size of each copy transfer in bytes
+    #5. `resume` - bool, continue a partially written combined_trial.DAT made from the same recordings
+
+    ### Output:
+    # Dict written to the sidecar: `nChannels`, `complete` and `recordings` (list of dicts with `path`, `nBytes`,
+    # `nSamples`, `byteOffset` and `sampleOffset` of every recording in the combined file)
+
+    outPath = os.path.join(save_path, combinedName)
+    sidecarPath = os.path.join(save_path, sidecarName)
+    sidecar = _planConcat(recording_filepaths, nChannels)
+    totalBytes = sum(recording['nBytes'] for recording in sidecar['recordings'])
+
+    startByte = _resumePoint(outPath, sidecarPath, sidecar) if resume else 0
+    if startByte == totalBytes and _readSidecar(sidecarPath).get('complete'):
+        print('Concatenation already complete.')
+        return _readSidecar(sidecarPath)
+    if startByte:
+        print('Resuming concatenation at {:.2f} GB.'.format(startByte/1e9))
+    _writeSidecar(sidecarPath, sidecar)
+
+    outFd = os.open(outPath, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+    try:
+        os.ftruncate(outFd, startByte)
+        os.lseek(outFd, startByte, os.SEEK_SET)
+        progress = _Progress(totalBytes, startByte)
+
+        for recording in sidecar['recordings']:
+            recordingEnd = recording['byteOffset'] + recording['nBytes']
+            if recordingEnd <= startByte:
+                continue
+            firstByte = max(0, startByte - recording['byteOffset'])
+            _copyRange(recording['path'], outFd, firstByte, recording['nBytes'], chunkBytes, progress)
+
+            # make every finished recording durable so it is a safe resume point, and drop it from the page cache
+            os.fsync(outFd)
+            _dropCache(outFd)
+    finally:
+        os.close(outFd)
+
+    sidecar['complete'] = True
+    _writeSidecar(sidecarPath, sidecar)
+    print('\nConcatenation complete.')
+    return sidecar
+
+def loadConcatOffsets(save_path):
+
+    # read the sidecar of a combined_trial.DAT
+    return _readSidecar(os.path.join(save_path, sidecarName))
+
+def globalToRecording(sidecar, samples):
+
+    # map sample indices of combined_trial.DAT back to (recording index, sample index within that recording)
+    sampleOffsets = np.array([recording['sampleOffset'] for recording in sidecar['recordings']], dtype=np.int64)
+    samples = np.asarray(samples, dtype=np.int64)
+    recordingIdx = np.searchsorted(sampleOffsets, samples, side='right') - 1
+    return recordingIdx, samples - sampleOffsets[recordingIdx]
+
+def _planConcat(recording_filepaths, nChannels):
+    frameBytes = nChannels*bytesPerSample
+    recordings = []
+    byteOffset = 0
+    for path in recording_filepaths:
+        nBytes = os.path.getsize(path)
+        if nBytes % frameBytes:
+            print("Warning: '{}' is not a whole number of {}-channel samples.".format(path, nChannels))
+        recordings.append({'path': os.path.abspath(path),
+                           'nBytes': nBytes,
+                           'nSamples': nBytes//frameBytes,
+                           'byteOffset': byteOffset,
+                           'sampleOffset': byteOffset//frameBytes})
+        byteOffset += nBytes
+    return {'fileName': combinedName, 'nChannels': nChannels, 'complete': False, 'recordings': recordings}
+
+def _readSidecar(sidecarPath):
+    try:
+        with open(sidecarPath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _writeSidecar(sidecarPath, sidecar):
+    tmpPath = sidecarPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(sidecar, f, indent=1)
+    os.replace(tmpPath, sidecarPath)
+
+def _resumePoint(outPath, sidecarPath, sidecar):
+
+    # resume only if the existing output was made from the same recordings (same paths and sizes)
+    previous = _readSidecar(sidecarPath)
+    planned = [(recording['path'], recording['nBytes']) for recording in sidecar['recordings']]
+    if not os.path.exists(outPath) or [(r['path'], r['nBytes']) for r in previous.get('recordings', [])] != planned:
+        return 0
+
+    # restart from the last fully copied recording (those were fsync'ed before moving on)
+    written = os.path.getsize(outPath)
+    startByte = 0
+    for recording in sidecar['recordings']:
+        recordingEnd = recording['byteOffset'] + recording['nBytes']
+        if recordingEnd > written:
+            break
+        startByte = recordingEnd
+    return startByte
+
+def _copyRange(path, outFd, firstByte, lastByte, chunkBytes, progress):
+    inFd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        position = _copyZeroCopy(inFd, outFd, firstByte, lastByte, chunkBytes, progress)
+        if position < lastByte:
+            _copyBuffered(inFd, outFd, position, lastByte, chunkBytes, progress)
+    finally:
+        os.close(inFd)
+
+def _copyZeroCopy(inFd, outFd, position, lastByte, chunkBytes, progress):
+
+    # in-kernel copy (Linux), returns the position reached (unchanged if not supported for these files)
+    for copyFunc in (_copyFileRange, _sendFile):
+        if copyFunc is None:
+            continue
+        while position < lastByte:
+            try:
+                nCopied = copyFunc(inFd, outFd, position, min(chunkBytes, lastByte - position))
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    break
+                raise
+            if nCopied == 0:
+                raise IOError('Unexpected end of file while copying.')
+            _dropCache(inFd, position, nCopied)
+            position += nCopied
+            progress.update(nCopied)
+        if position == lastByte:
+            break
+    return position
+
+def _copyFileRange(inFd, outFd, position, count):
+    return os.copy_file_range(inFd, outFd, count, position)
+
+def _sendFile(inFd, outFd, position, count):
+    return os.sendfile(outFd, inFd, position, count)
+
+if not hasattr(os, 'copy_file_range'):
+    _copyFileRange = None
+if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'): # sendfile only takes regular output files on Linux
+    _sendFile = None
+
+def _copyBuffered(inFd, outFd, position, lastByte, chunkBytes, progress):
+
+    # a reader thread fills rotating buffers while this thread writes the previous one
+    # (one buffer being written, one queued, one being read)
+    nBuffers = 3
+    buffers = [bytearray(chunkBytes) for _ in range(nBuffers)]
+    filled = queue.Queue(maxsize=nBuffers - 2)
+    failed = []
+
+    def reader():
+        try:
+            os.lseek(inFd, position, os.SEEK_SET)
+            readPosition, i = position, 0
+            while readPosition < lastByte:
+                view = memoryview(buffers[i % nBuffers])[:min(chunkBytes, lastByte - readPosition)]
+                nRead = os.readv(inFd, [view]) if hasattr(os, 'readv') else _readInto(inFd, view)
+                if nRead == 0:
+                    raise IOError('Unexpected end of file while copying.')
+                filled.put((view, nRead, readPosition))
+                readPosition += nRead
+                i += 1
+        except BaseException as e:
+            failed.append(e)
+        finally:
+            filled.put(None)
+
+    readerThread = threading.Thread(target=reader, daemon=True)
+    readerThread.start()
+    while True:
+        item = filled.get()
+        if item is None:
+            break
+        view, nRead, readPosition = item
+        _writeAll(outFd, view[:nRead])
+        _dropCache(inFd, readPosition, nRead)
+        progress.update(nRead)
+    readerThread.join()
+    if failed:
+        raise failed[0]
+
+def _readInto(fd, view):
+    data = os.read(fd, len(view))
+    view[:len(data)] = data
+    return len(data)
+
+def _writeAll(fd, view):
+    while len(view):
+        view = view[os.write(fd, view):]
+
+def _dropCache(fd, offset=0, length=0):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+class _Progress:
+
+    def __init__(self, totalBytes, doneBytes=0):
+        self.totalBytes = max(totalBytes, 1)
+        self.doneBytes = doneBytes
+        self.lastPercent = -1
+
+    def update(self, nBytes):
+        self.doneBytes += nBytes
+        percent = int(1000*self.doneBytes/self.totalBytes)
+        if percent != self.lastPercent:
+            self.lastPercent = percent
+            print("\rConcatenating: {:.1f}% ({:.2f} of {:.2f} GB)".format(percent/10, self.doneBytes/1e9, self.totalBytes/1e9), end="", flush=True)
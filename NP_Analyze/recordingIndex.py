@@ -0,0 +1,151 @@
+import os
+import re
+import json
+
+# Recording discovery for OpenEphys experiment trees (<root>/<experiment folder>/Record Node 101/experiment*/recording*/
+# continuous/<stream>/continuous.dat, or recording* folders directly below the experiment folder).
+# The tree is walked once with os.scandir and summarized in a manifest (recording_manifest.json in the root) with the
+# path, channel count, sample count, duration and order of every recording. Later scans only re-list directories
+# whose mtime changed and only re-stat recordings, so nothing is read from the .dat files themselves.
+
+manifestName = 'recording_manifest.json'
+recordingPattern = re.compile(r'recording(\d+)$')
+
+def scanExperiment(rootDir, streamName='Neuropix-PXI-100.ProbeA-AP', nChannels=385, sampleRate=30000, useCache=True):
+
+    # find every recording of `streamName` below `rootDir` and return the (cached) manifest
+
+    ### Inputs:
+    #1. `rootDir` - str, session folder (e.g. D:\2024-01-03_ALC4_day1 or its 01-raw folder)
+    #2. `streamName` - str, name of the continuous stream folder
+    #3. `nChannels` - int, channels per sample (used when a recording has no structure.oebin)
+    #4. `sampleRate` - int sample rate in Hz (used when a recording has no structure.oebin)
+    #5. `useCache` - bool, revalidate the saved manifest instead of scanning from scratch
+
+    ### Output: Dict with keys
+    #1. `root` - str, absolute path of `rootDir`
+    #2. `recordings` - list of dicts, in recording order, with `path` (continuous.dat), `experiment` (top-level
+    #   folder), `recording` (recording number), `nChannels`, `sampleRate`, `nSamples`, `duration` (in s) and `order`
+    #3. `dirs` - dict of scanned directories with their mtime and subdirectories (used for revalidation)
+
+    rootDir = os.path.abspath(rootDir)
+    manifestPath = os.path.join(rootDir, manifestName)
+    settings = {'streamName': streamName, 'nChannels': nChannels, 'sampleRate': sampleRate}
+
+    cached = _readManifest(manifestPath) if useCache else {}
+    if any(cached.get(key) != value for key, value in settings.items()):
+        cached = {}
+    cachedDirs = cached.get('dirs', {})
+    cachedRecordings = {recording['path']: recording for recording in cached.get('recordings', [])}
+
+    dirs = {}
+    recordings = []
+    for recordingDir in _findRecordingDirs(rootDir, '', cachedDirs, dirs):
+        recording = _describeRecording(rootDir, recordingDir, settings, cachedRecordings)
+        if recording is not None:
+            recordings.append(recording)
+
+    recordings.sort(key=lambda recording: _naturalKey(recording['path']))
+    for order, recording in enumerate(recordings):
+        recording['order'] = order
+
+    # writing the manifest changes the mtime of the root itself, so the root entry alone does not trigger a rewrite
+    manifest = dict(settings, root=rootDir, dirs=dirs, recordings=recordings)
+    if _withoutRoot(manifest) != _withoutRoot(cached):
+        try:
+            _writeManifest(manifestPath, manifest)
+        except OSError as e:
+            print("Warning: could not save the recording manifest ({}).".format(e))
+    return manifest
+
+def getRecordingPaths(manifest, experiment=None, minDuration=0):
+
+    # absolute continuous.dat paths (in recording order), optionally of one experiment folder and/or a minimum duration
+    return [os.path.join(manifest['root'], recording['path'])
+            for recording in getRecordings(manifest, experiment, minDuration)]
+
+def getRecordings(manifest, experiment=None, minDuration=0):
+    return [recording for recording in manifest['recordings']
+            if (experiment is None or recording['experiment'] == experiment) and recording['duration'] >= minDuration]
+
+def _findRecordingDirs(absRoot, relDir, cachedDirs, dirs):
+
+    # yields the relative paths of recording* folders, re-listing only the directories whose mtime changed
+    absDir = os.path.join(absRoot, relDir)
+    try:
+        mtime = os.stat(absDir).st_mtime_ns
+    except OSError:
+        return
+
+    if relDir in cachedDirs and cachedDirs[relDir][0] == mtime:
+        subdirs = cachedDirs[relDir][1]
+    else:
+        try:
+            with os.scandir(absDir) as entries:
+                subdirs = sorted(entry.name for entry in entries if entry.is_dir())
+        except OSError:
+            return
+    dirs[relDir] = [mtime, subdirs]
+
+    for name in subdirs:
+        relSub = os.path.join(relDir, name)
+        if recordingPattern.match(name):
+            yield relSub
+        elif name not in ('continuous', 'events', 'spikes'):
+            yield from _findRecordingDirs(absRoot, relSub, cachedDirs, dirs)
+
+def _describeRecording(rootDir, recordingDir, settings, cachedRecordings):
+    relPath = os.path.join(recordingDir, 'continuous', settings['streamName'], 'continuous.dat')
+    try:
+        stat = os.stat(os.path.join(rootDir, relPath))
+    except OSError:
+        return None
+
+    cachedRecording = cachedRecordings.get(relPath)
+    if cachedRecording is not None and [cachedRecording['nBytes'], cachedRecording['mtime']] == [stat.st_size, stat.st_mtime_ns]:
+        return dict(cachedRecording)
+
+    channels, rate = _readOebin(os.path.join(rootDir, recordingDir), settings)
+    nSamples = stat.st_size//(2*channels)
+    return {'path': relPath,
+            'experiment': relPath.split(os.sep)[0],
+            'recording': int(recordingPattern.match(os.path.basename(recordingDir)).group(1)),
+            'nBytes': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'nChannels': channels,
+            'sampleRate': rate,
+            'nSamples': nSamples,
+            'duration': nSamples/rate}
+
+def _readOebin(recordingPath, settings):
+
+    # channel count and sample rate of the stream from structure.oebin (falls back to the defaults)
+    try:
+        with open(os.path.join(recordingPath, 'structure.oebin')) as f:
+            streams = json.load(f)['continuous']
+        for stream in streams:
+            if stream.get('folder_name', '').strip('/') == settings['streamName']:
+                return int(stream['num_channels']), float(stream['sample_rate'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return settings['nChannels'], settings['sampleRate']
+
+def _withoutRoot(manifest):
+    return dict(manifest, dirs={relDir: entry for relDir, entry in manifest.get('dirs', {}).items() if relDir})
+
+def _naturalKey(path):
+    return [[int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', component)]
+            for component in path.split(os.sep)]
+
+def _readManifest(manifestPath):
+    try:
+        with open(manifestPath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _writeManifest(manifestPath, manifest):
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmpPath, manifestPath)
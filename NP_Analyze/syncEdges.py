@@ -0,0 +1,83 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from openephysConcat import combinedName, loadConcatOffsets
+
+# Sync-line edge detection on the interleaved int16 binary (combined_trial.DAT or a single continuous.dat).
+# The file is memory-mapped and only the sync channel column is copied out, in fixed-size chunks processed by a
+# thread pool, so memory stays bounded by the chunk size and the other channels are never materialized as arrays.
+# (The OS still reads whole pages, which hold all channels of a few samples; the column read is strided, not sparse.)
+
+def extractSyncEdges(datPath, nChannels=385, syncChannel=384, syncBit=None, segments=None, chunkSamples=2**20, nThreads=4):
+
+    # rising/falling sample indices of the sync line, per recording segment
+
+    ### Inputs:
+    #1. `datPath` - str, path to the int16 binary
+    #2. `nChannels` - int, number of interleaved channels (385 for Neuropixels AP + sync)
+    #3. `syncChannel` - int, index of the channel carrying the sync line
+    #4. `syncBit` - int, bit of the sync channel driven by the DAQ (None: any non-zero value counts as high)
+    #5. `segments` - list of (first sample, number of samples) of each recording; None for the whole file
+    #6. `chunkSamples` - int, samples per chunk
+    #7. `nThreads` - int, number of reader threads
+
+    ### Output: List of dicts (one per segment) with keys
+    #1. `start`, `nSamples` - position of the segment in the file
+    #2. `initialLevel` - bool, sync level at the first sample of the segment
+    #3. `rising` - ndarray (int64) of global sample indices where the line goes high
+    #4. `falling` - ndarray (int64) of global sample indices where the line goes low
+
+    fileSamples = os.path.getsize(datPath)//(2*nChannels)
+    data = np.memmap(datPath, dtype=np.int16, mode='r', shape=(fileSamples, nChannels))
+    if segments is None:
+        segments = [(0, fileSamples)]
+
+    # each chunk also reads the sample before it, so edges on chunk boundaries are found exactly once
+    chunks = [(segmentIdx, first, min(first + chunkSamples, start + nSamples))
+              for segmentIdx, (start, nSamples) in enumerate(segments)
+              for first in range(start, start + nSamples, chunkSamples)]
+
+    def readChunk(chunk):
+        segmentIdx, first, last = chunk
+        readFirst = max(first - 1, segments[segmentIdx][0])
+        level = _syncLevel(np.array(data[readFirst:last, syncChannel]), syncBit)
+        change = np.diff(level.astype(np.int8))
+        return (np.flatnonzero(change > 0) + readFirst + 1,
+                np.flatnonzero(change < 0) + readFirst + 1,
+                bool(level[0]) if readFirst == first else None)
+
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        results = list(executor.map(readChunk, chunks))
+
+    syncEdges = [{'start': start, 'nSamples': nSamples, 'initialLevel': False, 'rising': [], 'falling': []}
+                 for start, nSamples in segments]
+    for (segmentIdx, first, last), (rising, falling, initialLevel) in zip(chunks, results):
+        if initialLevel is not None:
+            syncEdges[segmentIdx]['initialLevel'] = initialLevel
+        syncEdges[segmentIdx]['rising'].append(rising)
+        syncEdges[segmentIdx]['falling'].append(falling)
+
+    for segment in syncEdges:
+        for key in ('rising', 'falling'):
+            segment[key] = np.concatenate(segment[key]).astype(np.int64) if segment[key] else np.zeros(0, dtype=np.int64)
+    return syncEdges
+
+def getSyncEdges(save_path, nChannels=None, **kwargs):
+
+    # sync edges of every recording in `save_path`/combined_trial.DAT, segmented with the concatenation sidecar
+    # (`nChannels` defaults to the channel count in the sidecar; other arguments go to extractSyncEdges)
+    sidecar = loadConcatOffsets(save_path)
+    if not sidecar:
+        raise FileNotFoundError("No concatenation sidecar found in '{}'.".format(save_path))
+    nChannels = sidecar['nChannels'] if nChannels is None else nChannels
+    segments = [(recording['sampleOffset'], recording['nSamples']) for recording in sidecar['recordings']]
+    syncEdges = extractSyncEdges(os.path.join(save_path, combinedName), nChannels=nChannels, segments=segments, **kwargs)
+    for segment, recording in zip(syncEdges, sidecar['recordings']):
+        segment['path'] = recording['path']
+    return syncEdges
+
+def _syncLevel(column, syncBit):
+    if syncBit is None:
+        return column != 0
+    return ((column >> syncBit) & 1) == 1
@@ -0,0 +1,71 @@
+import os
+import json
+import tempfile
+import numpy as np
+
+import openephysConcat
+from openephysConcat import openephys_concat, globalToRecording, combinedName, sidecarName
+
+# Checks that the chunked (zero-copy and buffered) and resumed concatenations are byte-identical to the inputs joined.
+# Usage: python -m pytest test_openephysConcat.py
+
+nChannels = 4
+
+def writeRecordings(folderpath, sampleCounts, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i, nSamples in enumerate(sampleCounts):
+        paths.append(os.path.join(folderpath, 'continuous_{}.dat'.format(i)))
+        rng.integers(-2**15, 2**15, (nSamples, nChannels)).astype(np.int16).tofile(paths[-1])
+    return paths
+
+def joined(paths):
+    data = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data.append(f.read())
+    return b''.join(data)
+
+def combined(folderpath):
+    with open(os.path.join(folderpath, combinedName), 'rb') as f:
+        return f.read()
+
+def test_chunkedConcat():
+    with tempfile.TemporaryDirectory() as folderpath:
+        paths = writeRecordings(folderpath, [1000, 1, 2503])
+        sidecar = openephys_concat(paths, folderpath, nChannels=nChannels, chunkBytes=1000)
+        assert combined(folderpath) == joined(paths)
+        assert [recording['sampleOffset'] for recording in sidecar['recordings']] == [0, 1000, 1001]
+        assert sidecar['complete']
+
+        recordingIdx, samples = globalToRecording(sidecar, [0, 999, 1000, 1001, 3503])
+        assert recordingIdx.tolist() == [0, 0, 1, 2, 2] and samples.tolist() == [0, 999, 0, 0, 2502]
+
+def test_bufferedConcat(monkeypatch):
+    monkeypatch.setattr(openephysConcat, '_copyFileRange', None)
+    monkeypatch.setattr(openephysConcat, '_sendFile', None)
+    with tempfile.TemporaryDirectory() as folderpath:
+        paths = writeRecordings(folderpath, [777, 2048, 5])
+        openephys_concat(paths, folderpath, nChannels=nChannels, chunkBytes=999)
+        assert combined(folderpath) == joined(paths)
+
+def test_resumedConcat():
+    with tempfile.TemporaryDirectory() as folderpath:
+        paths = writeRecordings(folderpath, [1000, 1500, 700])
+        openephys_concat(paths, folderpath, nChannels=nChannels, chunkBytes=1000)
+
+        # interrupted in the middle of the third recording, with garbage after the last finished one
+        frameBytes = nChannels*2
+        with open(os.path.join(folderpath, combinedName), 'r+b') as f:
+            f.truncate((2500 + 300)*frameBytes)
+            f.seek(2600*frameBytes)
+            f.write(b'\xff'*100*frameBytes)
+        sidecarPath = os.path.join(folderpath, sidecarName)
+        with open(sidecarPath) as f:
+            sidecar = json.load(f)
+        sidecar['complete'] = False
+        with open(sidecarPath, 'w') as f:
+            json.dump(sidecar, f)
+
+        openephys_concat(paths, folderpath, nChannels=nChannels, chunkBytes=1000)
+        assert combined(folderpath) == joined(paths)
@@ -2,8 +2,11 @@ import nidaqmx
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
-import threading
-import time
+
+from waveformBuilder import regionSchedule, regionPulses
+from daqStream import RegionSchedule, streamTasks
+from asyncWriter import AsyncWriter
+from sessionTimer import startSession, finishSession
 
 ###Changes to make: don't do multiple recordings (keep sync = 1), but loop within one recording block.
 
@@ -21,7 +24,10 @@ settings = {
 
     'stepV' : .05, # in Volts. Increment of voltage to be stepped for mirror
     'time_per_region' : 0.03, # in seconds. Duration to hold mirrors in place for each region
-    'trial_repeats' : 10 # number of times each region should be sampled (default = 10)
+    'trial_repeats' : 10, # number of times each region should be sampled (default = 10)
+
+    'stream_output' : False, # generate ao/do chunk by chunk during the trial instead of writing it all up front (constant memory)
+    'stream_chunk' : 0.5 # in seconds. Output generated per chunk when stream_output is True
 }
 
 
@@ -58,84 +64,89 @@ def setupTasks(settings):
     return (ao_task, do_task)
 
 
-def runTasks(ao_task, do_task, settings):
+def runTasks(ao_task, do_task, settings, timer):
     # shuffle the combinations to randomize the sequence of pulsed regions
     np.random.seed(seed = 89786)
     np.random.shuffle(all_combinations)
     all_combinations_repeated = np.tile(all_combinations, (settings['trial_repeats'], 1))
 
 
-    # initialize zeroed-out arrays
     numSamples = int(settings['Fs'] * trial_duration)
-    ao_out = np.zeros((2, numSamples))
-    do_out = np.zeros((2, numSamples), dtype=bool)
 
     # generate a train of laser pulses for [laser_duration]seconds at [laser_frequency]Hz
     laser_duration = 0.0001  # seconds
     laser_frequency = settings['Fs']  # Hz (for sustained pulse, equate to settings['Fs'])
     laser_samples = int(settings['Fs'] * laser_duration)
     laser_pulse_indices = np.arange(0, laser_samples, int(settings['Fs'] / laser_frequency))
+    samples_per_region = int(settings['Fs'] * settings['time_per_region'])
+
+    if settings['stream_output']:
+        # generate the outputs chunk by chunk from the shuffled positions while the trial runs (nothing to return)
+        schedule = RegionSchedule(numSamples, all_combinations_repeated, samples_per_region, laser_pulse_indices, laser_samples)
+        with timer.phase('stream'):
+            streamTasks(ao_task, do_task, schedule, settings['Fs'], int(settings['Fs'] * settings['stream_chunk']), timer=timer)
+        with timer.phase('stop', daqErrors=True):
+            do_task.close()
+            ao_task.close()
+        return(None, None)
 
-    # Fill ao_out with the shuffled sequence and do_out with laser pulses
-    for i, (x_val, y_val) in enumerate(all_combinations_repeated):
-        start_index = i * int(settings['Fs'] * settings['time_per_region'])
-        end_index = start_index + int(settings['Fs'] * settings['time_per_region'])
-        ao_out[0, start_index:end_index] = x_val
-        ao_out[1, start_index:end_index] = y_val
+    with timer.phase('build'):
+        # initialize zeroed-out arrays
+        do_out = np.zeros((2, numSamples), dtype=bool)
 
-        # Add laser pulses at the middle of each position's time_per_region
-        do_out[0, laser_pulse_indices + int(end_index-((end_index-start_index)/2)) - laser_samples] = True
+        # Fill ao_out with the shuffled sequence and do_out with laser pulses at the middle of each position's time_per_region
+        ao_out = regionSchedule(all_combinations_repeated, samples_per_region, numSamples)
+        do_out[0] = regionPulses(len(all_combinations_repeated), samples_per_region, laser_pulse_indices, laser_samples, numSamples)
 
-    do_out[1, 1:(numSamples-1)] = True
+        do_out[1, 1:(numSamples-1)] = True
 
     ## writing daq outputs onto device
-    do_task.write(do_out, timeout = trial_duration + 10)
-    ao_task.write(ao_out, timeout = trial_duration + 10)
+    with timer.phase('write', nBytes=do_out.nbytes + ao_out.nbytes):
+        do_task.write(do_out, timeout = trial_duration + 10)
+        ao_task.write(ao_out, timeout = trial_duration + 10)
 
     ## starting tasks (make sure do_task is started last -- it triggers the others)
-    ao_task.start()
-    do_task.start()
-    do_task.wait_until_done(timeout = trial_duration + 10)
+    with timer.phase('start'):
+        ao_task.start()
+        do_task.start()
+    with timer.phase('wait', daqErrors=True):
+        do_task.wait_until_done(timeout = trial_duration + 10)
 
     ## adding data to the outputs
     ao_data = ao_out
     do_data = do_out
 
     ## stopping tasks
-    do_task.stop()
-    ao_task.stop()
+    with timer.phase('stop', daqErrors=True):
+        do_task.stop()
+        ao_task.stop()
 
-    do_task.close()
-    ao_task.close()
+        do_task.close()
+        ao_task.close()
     return(ao_data, do_data)
 
 
-def countdown_timer(duration):
-    start_time = time.time()
-    end_time = start_time + duration
-
-    while time.time() < end_time:
-        remaining_time = end_time - time.time()
-        print("\rRemaining Time: {:.2f} minutes".format(remaining_time/60), end="", flush=True)
-        time.sleep(1)  # Update every 1 second
-
-
-# run a countdown timer for [trial_duration] seconds
-timer_thread = threading.Thread(target=countdown_timer, args=(trial_duration,))
-timer_thread.start()
+current_date = datetime.now()
+date = current_date.strftime('%Y%m%d_%H%M%S')
 
+# log the timing of every phase of the session (see sessionTimer.py); the countdown starts with the output
+timer = startSession(settings['task_name'], "C:/SGL_DATA/acRecField_{}_timing.jsonl".format(date), settings, trial_duration, ('wait', 'stream'), interval = 1)
 
-ao_task, do_task = setupTasks(settings)
-ao_data, do_data = runTasks(ao_task, do_task, settings)
+with timer.phase('setup'):
+    ao_task, do_task = setupTasks(settings)
+ao_data, do_data = runTasks(ao_task, do_task, settings, timer)
 print("\nTrial Complete.")
 
 
 # save all data to numpy arrays
-current_date = datetime.now()
-date = current_date.strftime('%Y%m%d_%H%M%S')
-np.save("C:/SGL_DATA/acRecField_{}_ao_data.npy".format(date), ao_data)
-np.save("C:/SGL_DATA/acRecField_{}_do_data.npy".format(date), do_data)
-np.save("C:/SGL_DATA/acRecField_{}_settings.npy".format(date), settings)
-
-# Wait for the timer thread to complete before exiting the program
-timer_thread.join()
+writer = AsyncWriter() # ao_data/do_data are saved as event lists (.npz, see eventTrace.py)
+if settings['stream_output']:
+    # the outputs were never held in memory; save the shuffled positions they were generated from
+    writer.save("C:/SGL_DATA/acRecField_{}_positions.npy".format(date), np.tile(all_combinations, (settings['trial_repeats'], 1)))
+else:
+    writer.save("C:/SGL_DATA/acRecField_{}_ao_data.npz".format(date), ao_data, pack='events')
+    writer.save("C:/SGL_DATA/acRecField_{}_do_data.npz".format(date), do_data, pack='events')
+writer.save("C:/SGL_DATA/acRecField_{}_settings.npy".format(date), settings)
+
+# Wait for the writes to complete before exiting the program, then log the timing summary
+finishSession(timer, writer)
@@ -0,0 +1,129 @@
+import os
+import time
+import queue
+import atexit
+import threading
+import numpy as np
+
+from eventTrace import encodeTrace, loadEventTrace
+
+# Background writer for the acquisition scripts. Saves are queued and written by one dedicated thread, so the caller
+# (the end of a trial, or the analog input callback of motorControl.py) does not wait on the disk. The queue is
+# bounded: when the disk falls behind, save() blocks until there is room (back-pressure) and the time spent blocked is
+# reported. Files are written to a temporary name, fsync'ed and renamed, and close() (also run at interpreter exit)
+# drains the queue, so every accepted save is on disk when the script ends.
+# Arrays are saved exactly as given unless packing is asked for: pack=True saves bool arrays bit-packed (lossless, 8x
+# smaller; read back with loadOutput), pack='float32' saves float64 arrays as float32 (lossy, for outputs that need no
+# float64 precision) and pack='events' saves an array as an event list (see eventTrace.py), far smaller again for
+# piecewise-constant ao/do traces. Packed bool arrays and event lists are .npz files, so their path must end in .npz.
+
+class AsyncWriter:
+
+    def __init__(self, maxQueued=4, name='asyncWriter'):
+        self.stats = {'items': 0, 'bytes': 0, 'maxLatency': 0., 'totalLatency': 0., 'blockedTime': 0.}
+        self._queue = queue.Queue(maxsize=maxQueued)
+        self._failed = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, path, data, pack=False):
+
+        # queue np.save(`path`, `data`) (or the packed format of `pack`, see above); arrays are written as they are
+        # when the writer gets to them, so they must not be modified after this call. Returns `path`
+        if (pack == 'events' or _isPacked(data, pack)) and not path.endswith('.npz'):
+            raise ValueError("Packed outputs are .npz files, got '{}'.".format(path))
+        self.submit(_saveFile, path, data, pack, nBytes=data.nbytes if isinstance(data, np.ndarray) else 0)
+        return path
+
+    def submit(self, func, *args, nBytes=0, **kwargs):
+
+        # queue any write (e.g. CycleStore.append); blocks while the queue is full
+        if self._failed:
+            raise self._failed[0]
+        if self._closed:
+            raise RuntimeError('AsyncWriter is closed.')
+        item = (func, args, kwargs, nBytes, time.perf_counter())
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            blocked = time.perf_counter()
+            self._queue.put(item)
+            self.stats['blockedTime'] += time.perf_counter() - blocked
+
+    def close(self, verbose=True):
+
+        # wait for every queued write, stop the thread and raise the first write error (if any)
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            atexit.unregister(self.close)
+            if verbose and self.stats['items']:
+                print(self.summary())
+        if self._failed:
+            raise self._failed[0]
+        return self.stats
+
+    def summary(self):
+        stats = self.stats
+        return ("Wrote {} items ({:.1f} MB) in the background; flush latency mean {:.3f} s, max {:.3f} s; "
+                "blocked on a full queue for {:.3f} s.".format(stats['items'], stats['bytes']/1e6,
+                stats['totalLatency']/max(stats['items'], 1), stats['maxLatency'], stats['blockedTime']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            func, args, kwargs, nBytes, queued = item
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self._failed.append(e)
+                print("Warning: background write failed ({}).".format(e))
+                continue
+
+            # latency from submit() to the data being on disk
+            latency = time.perf_counter() - queued
+            self.stats['items'] += 1
+            self.stats['bytes'] += nBytes
+            self.stats['totalLatency'] += latency
+            self.stats['maxLatency'] = max(self.stats['maxLatency'], latency)
+
+def loadOutput(path):
+
+    # load a file saved by AsyncWriter.save (unpacks bit-packed bool arrays and decodes event lists)
+    if path.endswith('.npz'):
+        with np.load(path) as packed:
+            if 'starts' in packed:
+                return loadEventTrace(path).decode()
+            if 'bits' in packed:
+                shape = tuple(packed['shape'])
+                return np.unpackbits(packed['bits'], axis=-1, count=shape[-1]).astype(bool).reshape(shape)
+    return np.load(path, allow_pickle=True)
+
+def _isPacked(data, pack):
+    return pack is True and isinstance(data, np.ndarray) and data.dtype == np.bool_ and data.ndim > 0
+
+def _saveFile(path, data, pack):
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        if pack == 'events':
+            np.savez(f, **encodeTrace(data).toArrays())
+        elif _isPacked(data, pack):
+            np.savez(f, bits=np.packbits(data, axis=-1), shape=np.array(data.shape))
+        elif pack == 'float32' and isinstance(data, np.ndarray) and data.dtype == np.float64:
+            np.save(f, data.astype(np.float32))
+        else:
+            np.save(f, data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
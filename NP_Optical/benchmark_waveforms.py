@@ -0,0 +1,91 @@
+import time
+import numpy as np
+
+from waveformBuilder import getTrainOnsets, pulseTrain, regionSchedule, regionPulses
+
+# Benchmark of the vectorized DAQ buffer builders against the per-pulse loops they replaced (copied below).
+# Runs without hardware; every case also checks that both versions produce identical buffers.
+# Usage: python benchmark_waveforms.py
+
+pulsedSettings = {'Fs': 30000, 'laser_duration': 0.0003, 'laser_frequency': 40, 'train_duration': 0.5,
+                  'rest_duration': 5, 'trial_buffer': 1, 'trial_repeats': 50}
+recFieldSettings = {'Fs': 30000, 'xV': 7.8, 'yV': 3.2, 'stepV': .05, 'time_per_region': 0.03, 'trial_repeats': 10}
+
+def loopPulsed(settings, trial_duration, laser_onsets):
+    numSamples = int(settings['Fs'] * trial_duration)
+    do_out = np.zeros((2, numSamples), dtype=bool)
+    train_onsets = np.arange((settings['trial_buffer']), (trial_duration), ((settings['train_duration'] + settings['rest_duration']))) * settings['Fs']
+    for train_onset in train_onsets:
+        for laser_onset in laser_onsets:
+            start_index = int(train_onset + laser_onset)
+            end_index = int(start_index + (settings['laser_duration'] * settings['Fs']))
+            do_out[0, start_index:end_index] = True
+    return do_out[0]
+
+def vectorPulsed(settings, trial_duration, laser_onsets):
+    numSamples = int(settings['Fs'] * trial_duration)
+    return pulseTrain(numSamples, getTrainOnsets(settings, trial_duration), laser_onsets, settings['laser_duration'], settings['Fs'])
+
+def loopRecField(settings, all_combinations_repeated, numSamples, laser_pulse_indices, laser_samples):
+    ao_out = np.zeros((2, numSamples))
+    do_out = np.zeros((2, numSamples), dtype=bool)
+    for i, (x_val, y_val) in enumerate(all_combinations_repeated):
+        start_index = i * int(settings['Fs'] * settings['time_per_region'])
+        end_index = start_index + int(settings['Fs'] * settings['time_per_region'])
+        ao_out[0, start_index:end_index] = x_val
+        ao_out[1, start_index:end_index] = y_val
+        do_out[0, laser_pulse_indices + int(end_index-((end_index-start_index)/2)) - laser_samples] = True
+    return ao_out, do_out[0]
+
+def vectorRecField(settings, all_combinations_repeated, numSamples, laser_pulse_indices, laser_samples):
+    samplesPerRegion = int(settings['Fs'] * settings['time_per_region'])
+    ao_out = regionSchedule(all_combinations_repeated, samplesPerRegion, numSamples)
+    laser = regionPulses(len(all_combinations_repeated), samplesPerRegion, laser_pulse_indices, laser_samples, numSamples)
+    return ao_out, laser
+
+def timeIt(func, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def compare(name, loopFunc, vectorFunc, *args):
+    loopTime, loopResult = timeIt(loopFunc, *args)
+    vectorTime, vectorResult = timeIt(vectorFunc, *args)
+    if isinstance(loopResult, tuple):
+        identical = all(np.array_equal(a, b) for a, b in zip(loopResult, vectorResult))
+    else:
+        identical = np.array_equal(loopResult, vectorResult)
+    print("{:<40} loop {:8.3f} s   vectorized {:8.4f} s   x{:<8.0f} identical: {}".format(name, loopTime, vectorTime, loopTime/max(vectorTime, 1e-9), identical))
+
+def benchmark():
+    for repeats in (50, 200):
+        settings = dict(pulsedSettings, trial_repeats=repeats)
+        trial_duration = (2 * settings['trial_buffer']) + (settings['trial_repeats'] * (settings['train_duration'] + settings['rest_duration'])) - settings['rest_duration']
+
+        # pulsedLaser.py
+        laser_onsets = (np.arange(0, settings['train_duration'], 1 / settings['laser_frequency']) * settings['Fs']).astype(int)
+        compare('pulsedLaser, {} trains'.format(repeats), loopPulsed, vectorPulsed, settings, trial_duration, laser_onsets)
+
+        # physiologicalLaser.py (a dense 200 Hz stand-in for the SA-LTMR trace)
+        trace_array = np.sort(np.random.default_rng(0).uniform(0, settings['train_duration'], 100))
+        laser_onsets = np.round(trace_array * settings['Fs']).astype(int)
+        compare('physiologicalLaser, {} trains'.format(repeats), loopPulsed, vectorPulsed, settings, trial_duration, laser_onsets)
+
+    # acquireRecField.py
+    settings = recFieldSettings
+    x_out_values = np.arange(settings['xV'] - 0.5, settings['xV'] + 0.5, settings['stepV'])
+    y_out_values = np.arange(settings['yV'] - 0.5, settings['yV'] + 0.5, settings['stepV'])
+    all_combinations = np.array(np.meshgrid(x_out_values, y_out_values)).T.reshape(-1, 2)
+    trial_duration = len(all_combinations**2) * settings['time_per_region'] * settings['trial_repeats']
+    all_combinations_repeated = np.tile(all_combinations, (settings['trial_repeats'], 1))
+    numSamples = int(settings['Fs'] * trial_duration)
+    laser_samples = int(settings['Fs'] * 0.0001)
+    laser_pulse_indices = np.arange(0, laser_samples, 1)
+    compare('acquireRecField, {} regions'.format(len(all_combinations_repeated)), loopRecField, vectorRecField,
+            settings, all_combinations_repeated, numSamples, laser_pulse_indices, laser_samples)
+
+if __name__ == '__main__':
+    benchmark()
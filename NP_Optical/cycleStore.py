@@ -0,0 +1,147 @@
+import os
+import re
+import json
+import time
+import numpy as np
+
+# Append-only store for the analog input of the mechanical trials (motorControl.py). Instead of one .npy per cycle, a
+# session is one folder holding
+#   data.npy   - preallocated (numCycles, nChannels, cycleSamples) array, filled one cycle at a time
+#   index.npy  - one row per cycle: force (mN), voltage (V), timestamp (s since the epoch) and a written flag
+#   header.json - shape, dtype and the acquisition settings
+# Both arrays are plain .npy files, so analysis memory-maps them and reads a cycle, a force condition or a time window
+# by slicing, without listing directories or parsing file names.
+
+dataName = 'data.npy'
+indexName = 'index.npy'
+headerName = 'header.json'
+indexDtype = np.dtype([('force', np.float64), ('voltage', np.float64), ('timestamp', np.float64), ('written', np.bool_)])
+
+class CycleStore:
+
+    # open with createCycleStore (acquisition) or openCycleStore (analysis)
+
+    def __init__(self, path, data, index, header):
+        self.path = path
+        self.data = data
+        self.index = index
+        self.header = header
+        self.nWritten = int(np.argmin(index['written'])) if not np.all(index['written']) else len(index)
+
+    @property
+    def numCycles(self):
+        return self.data.shape[0]
+
+    @property
+    def cycleSamples(self):
+        return self.data.shape[2]
+
+    @property
+    def forces(self):
+        return self.index['force'][:self.nWritten]
+
+    def append(self, cycleData, force, voltage=np.nan, timestamp=None):
+
+        # write the next cycle; the data is flushed before the index marks it as written, so a cycle flagged in the
+        # index is always complete on disk
+        j = self.nWritten
+        if j >= self.numCycles:
+            raise IndexError("Cycle store '{}' is full ({} cycles).".format(self.path, self.numCycles))
+        self.data[j] = cycleData
+        self.data.flush()
+        self.index[j] = (force, voltage, time.time() if timestamp is None else timestamp, True)
+        self.index.flush()
+        self.nWritten = j + 1
+        return j
+
+    def cycle(self, j):
+
+        # (nChannels, cycleSamples) view of cycle `j`
+        if j >= self.nWritten:
+            raise IndexError("Cycle {} has not been written.".format(j))
+        return self.data[j]
+
+    def getCycles(self, force=None):
+
+        # indices of the written cycles (optionally only those at `force` mN)
+        cycles = np.arange(self.nWritten)
+        if force is not None:
+            cycles = cycles[self.forces == force]
+        return cycles
+
+    def trace(self, channel, start=0, stop=None):
+
+        # samples [start, stop) of `channel` as one continuous trace over the written cycles (copies only that window)
+        stop = self.nWritten*self.cycleSamples if stop is None else min(stop, self.nWritten*self.cycleSamples)
+        if stop <= start:
+            return np.zeros(0, dtype=self.data.dtype)
+        first, last = start//self.cycleSamples, (stop - 1)//self.cycleSamples + 1
+        window = self.data[first:last, channel, :].reshape(-1)
+        return window[start - first*self.cycleSamples:stop - first*self.cycleSamples]
+
+    def close(self):
+        if self.data.mode != 'r':
+            self.data.flush()
+            self.index.flush()
+        del self.data, self.index
+
+def createCycleStore(path, numCycles, nChannels, cycleSamples, dtype=np.float64, settings=None):
+
+    # create the store folder with a preallocated data array for `numCycles` cycles
+
+    ### Inputs:
+    #1. `path` - str, folder of the store (e.g. C:/SGL_DATA/mC_ai_data_20240105_093626)
+    #2. `numCycles`, `nChannels`, `cycleSamples` - ints, shape of the data array
+    #3. `dtype` - dtype of the samples
+    #4. `settings` - dict of acquisition settings saved in the header
+
+    ### Output:
+    # CycleStore open for appending
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, indexName)):
+        raise FileExistsError("A cycle store already exists in '{}'.".format(path))
+
+    header = {'numCycles': numCycles, 'nChannels': nChannels, 'cycleSamples': cycleSamples,
+              'dtype': np.dtype(dtype).str, 'settings': settings or {}}
+    with open(os.path.join(path, headerName), 'w') as f:
+        json.dump(header, f, indent=1)
+    data = np.lib.format.open_memmap(os.path.join(path, dataName), mode='w+', dtype=dtype, shape=(numCycles, nChannels, cycleSamples))
+    index = np.lib.format.open_memmap(os.path.join(path, indexName), mode='w+', dtype=indexDtype, shape=(numCycles,))
+    return CycleStore(path, data, index, header)
+
+def openCycleStore(path, mode='r'):
+
+    # open an existing store read-only ('r') or to resume appending ('r+')
+    with open(os.path.join(path, headerName)) as f:
+        header = json.load(f)
+    data = np.load(os.path.join(path, dataName), mmap_mode=mode)
+    index = np.load(os.path.join(path, indexName), mmap_mode=mode)
+    return CycleStore(path, data, index, header)
+
+def fromCycleFiles(npy_path, path, date=None, settings=None):
+
+    # build a store from a folder of per-cycle mC_ai_data_{force}mN_{date}_{cycle}.npy files (sessions recorded
+    # before the store). Only the files of one session `date` are used (default: the session with the most cycles);
+    # cycles are ordered by their number and timestamped with the file mtimes
+    pattern = re.compile(r'mC_ai_data_(\d+)mN_(\d+_\d+)_(\d+)\.npy$')
+    sessions = {}
+    for file in os.listdir(npy_path):
+        match = pattern.match(file)
+        if match:
+            sessions.setdefault(match.group(2), []).append((int(match.group(3)), int(match.group(1)), file))
+    if not sessions:
+        raise FileNotFoundError("No mC_ai_data files found in '{}'.".format(npy_path))
+    if date is None:
+        date = max(sessions, key=lambda session: len(sessions[session]))
+        if len(sessions) > 1:
+            print("Using session {} ({} cycles); ignoring {}.".format(date, len(sessions[date]), sorted(set(sessions) - {date})))
+    cycles = sorted(sessions[date])
+    if [cycle for cycle, _, _ in cycles] != list(range(1, len(cycles) + 1)):
+        print("Warning: session {} has missing cycle files; cycles are stored in the order of their numbers.".format(date))
+
+    first = np.load(os.path.join(npy_path, cycles[0][2]), mmap_mode='r')
+    store = createCycleStore(path, len(cycles), first.shape[0], first.shape[1], dtype=first.dtype, settings=settings)
+    for _, force, file in cycles:
+        filePath = os.path.join(npy_path, file)
+        store.append(np.load(filePath), force, force/50, os.path.getmtime(filePath)) # 1V ~= 50mN
+    return store
@@ -0,0 +1,330 @@
+import threading
+import time
+import numpy as np
+
+try:
+    from nidaqmx.constants import RegenerationMode
+except ImportError: # FakeTask does not need the constants
+    RegenerationMode = None
+
+from waveformBuilder import intervalMask
+
+# Streaming (non-regenerating) DAQ output. Instead of writing the whole session's ao_out/do_out up front, the output
+# buffer holds a few chunks and an every-N-samples callback generates and writes the next chunk from a compact
+# schedule (pulse onsets + mirror coordinates), so memory does not grow with the trial length.
+# FakeTask is a local stand-in for nidaqmx.Task that consumes the buffer like the device, for running without hardware.
+
+class PulseTrainSchedule:
+
+    # fixed mirror position, laser pulses at every train onset + laser onset (pulsedLaser.py / physiologicalLaser.py)
+
+    def __init__(self, numSamples, xV, yV, trainOnsets, laserOnsets, laserDuration, Fs):
+        self.numSamples = numSamples
+        self.position = np.array([xV, yV], dtype=np.float64)
+
+        # same sample indexing as waveformBuilder.pulseTrain, kept as sorted (start, end) pairs
+        starts = (np.asarray(trainOnsets, dtype=np.float64)[:, np.newaxis] + np.asarray(laserOnsets)[np.newaxis, :]).astype(np.int64).reshape(-1)
+        ends = (starts + (laserDuration * Fs)).astype(np.int64)
+        order = np.argsort(starts, kind='stable')
+        self.starts, self.ends = starts[order], ends[order]
+        self.maxLength = int(np.max(self.ends - self.starts, initial=0))
+
+    def aoChunk(self, first, last):
+        return np.repeat(self.position[:, np.newaxis], last - first, axis=1)
+
+    def doChunk(self, first, last):
+        do_out = np.zeros((2, last - first), dtype=bool)
+        lo = np.searchsorted(self.starts, first - self.maxLength, side='left')
+        hi = np.searchsorted(self.starts, last, side='left')
+        do_out[0] = intervalMask(last - first, self.starts[lo:hi] - first, self.ends[lo:hi] - first)
+        do_out[1] = _syncChunk(first, last, self.numSamples)
+        return do_out
+
+class RegionSchedule:
+
+    # mirror held at each (x, y) of `positions` for `samplesPerRegion` samples, laser pulsed mid-dwell (acquireRecField.py)
+
+    def __init__(self, numSamples, positions, samplesPerRegion, laserPulseIndices, laserSamples):
+        self.numSamples = numSamples
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.samplesPerRegion = samplesPerRegion
+        self.laserPulseIndices = np.asarray(laserPulseIndices)
+        self.laserSamples = laserSamples
+
+    def aoChunk(self, first, last):
+
+        # same values as waveformBuilder.regionSchedule (zero after the last region)
+        region = np.arange(first, last)//self.samplesPerRegion
+        ao_out = np.zeros((2, last - first))
+        inSchedule = region < len(self.positions)
+        ao_out[:, inSchedule] = self.positions[region[inSchedule]].T
+        return ao_out
+
+    def doChunk(self, first, last):
+
+        # same pulses as waveformBuilder.regionPulses, for the regions whose pulses can fall in [first, last)
+        do_out = np.zeros((2, last - first), dtype=bool)
+        firstRegion = max(first//self.samplesPerRegion - 1, 0)
+        lastRegion = min(last//self.samplesPerRegion + 1, len(self.positions))
+        regionEnds = (np.arange(firstRegion, lastRegion) + 1) * self.samplesPerRegion
+        onsets = (regionEnds - (self.samplesPerRegion / 2)).astype(np.int64) - self.laserSamples
+        indices = (onsets[:, np.newaxis] + self.laserPulseIndices[np.newaxis, :]).reshape(-1)
+        indices = indices[(indices >= first) & (indices < last)]
+        do_out[0, indices - first] = True
+        do_out[1] = _syncChunk(first, last, self.numSamples)
+        return do_out
+
+class CycleSchedule:
+
+    # `numCycles` back-to-back cycles of `cycleSamples` samples, each built by makeCycle(j) -> (ao_cycle, do_cycle)
+    # (motorControl.py). Cycles are built when first needed and the last `keepCycles` are kept, so the ao and do
+    # callbacks (separate DAQ threads, possibly a cycle apart) share every build instead of rebuilding in turn.
+
+    def __init__(self, numCycles, cycleSamples, makeCycle, keepCycles=3):
+        self.numSamples = numCycles * cycleSamples
+        self.cycleSamples = cycleSamples
+        self.makeCycle = makeCycle
+        self.keepCycles = keepCycles
+        self._cycles = {}
+        self._lock = threading.Lock()
+
+    def aoChunk(self, first, last):
+        return self._chunk(first, last, 0)
+
+    def doChunk(self, first, last):
+        return self._chunk(first, last, 1)
+
+    def _chunk(self, first, last, output):
+        pieces = []
+        for j in range(first//self.cycleSamples, (last - 1)//self.cycleSamples + 1):
+            cycle = self._getCycle(j)
+            cycleStart = j * self.cycleSamples
+            pieces.append(cycle[output][..., max(first - cycleStart, 0):min(last - cycleStart, self.cycleSamples)])
+        return np.concatenate(pieces, axis=-1)
+
+    def _getCycle(self, j):
+
+        # (ao_cycle, do_cycle) of cycle j, built at most once while it is among the kept cycles
+        with self._lock:
+            cycle = self._cycles.get(j)
+            if cycle is None:
+                cycle = self._cycles[j] = tuple(self.makeCycle(j))
+                while len(self._cycles) > self.keepCycles:
+                    del self._cycles[min(self._cycles, key=lambda k: (k == j, k))]
+            return cycle
+
+def _syncChunk(first, last, numSamples):
+
+    # NP sync line, high from sample 1 to numSamples-1 (as do_out[1, 1:(numSamples-1)] = True)
+    samples = np.arange(first, last)
+    return (samples >= 1) & (samples < numSamples - 1)
+
+def streamTasks(ao_task, do_task, schedule, Fs, chunkSamples, nBufferedChunks=4, timeout=10, timer=None, startTasks=()):
+
+    # play `schedule` on ao_task/do_task (already configured with channels and sample clock) chunk by chunk
+
+    ### Inputs:
+    #1. `ao_task`, `do_task` - nidaqmx.Task (or FakeTask) with their channels and cfg_samp_clk_timing set
+    #2. `schedule` - PulseTrainSchedule/RegionSchedule (anything with numSamples, aoChunk and doChunk)
+    #3. `Fs` - int sample rate in Hz
+    #4. `chunkSamples` - int, samples generated per callback
+    #5. `nBufferedChunks` - int, chunks held in the device buffer (latency margin against underruns)
+    #6. `timeout` - float, extra seconds to wait after the nominal end of the output
+    #7. `timer` - sessionTimer.SessionTimer recording every chunk ('chunk' phase) and underruns (optional)
+    #8. `startTasks` - list of other tasks (e.g. the analog input) started right before ao_task/do_task, after the
+    #   prefill, so they stay aligned with the output (stopping them is left to the caller)
+
+    ### Output:
+    # Dict with `chunks` (chunks written by the callbacks of both tasks) and `maxGenerateTime` (slowest chunk
+    # generation + write, in s)
+
+    numSamples = schedule.numSamples
+    bufferSamples = min(nBufferedChunks*chunkSamples, numSamples)
+    stats = {'chunks': 0, 'maxGenerateTime': 0.}
+    failed = []
+
+    for task, makeChunk in ((ao_task, schedule.aoChunk), (do_task, schedule.doChunk)):
+        if RegenerationMode is not None:
+            task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
+        task.out_stream.output_buf_size = bufferSamples
+
+        # write one more chunk every time one has been transferred to the device
+        written = [bufferSamples]
+
+        def callback(task_handle, every_n_samples_event_type, number_of_samples, callback_data, task=task, makeChunk=makeChunk, written=written):
+            if written[0] >= numSamples or failed:
+                return 0
+            try:
+                start = time.perf_counter()
+                first, last = written[0], min(written[0] + chunkSamples, numSamples)
+                task.write(makeChunk(first, last), auto_start=False)
+                written[0] = last
+                stats['chunks'] += 1
+                stats['maxGenerateTime'] = max(stats['maxGenerateTime'], time.perf_counter() - start)
+                if timer is not None:
+                    timer.record('chunk', time.perf_counter() - start, first=first)
+            except Exception as e:
+                if timer is not None:
+                    timer.daqError(e)
+                failed.append(e)
+            return 0
+
+        task.register_every_n_samples_transferred_from_buffer_event(chunkSamples, callback)
+
+        # prefill the buffer
+        for first in range(0, bufferSamples, chunkSamples):
+            task.write(makeChunk(first, min(first + chunkSamples, bufferSamples)), auto_start=False)
+
+    try:
+        ## starting tasks (make sure do_task is started last -- it triggers the others)
+        for task in startTasks:
+            task.start()
+        ao_task.start()
+        do_task.start()
+        do_task.wait_until_done(timeout = numSamples/Fs + timeout)
+        ao_task.wait_until_done(timeout = timeout)
+    except Exception as e: # underruns of the device surface here
+        if timer is not None:
+            timer.daqError(e)
+        raise
+    finally:
+        ## stopping tasks (also after a timeout or underrun, so no callback keeps writing to a running task)
+        try:
+            do_task.stop()
+            ao_task.stop()
+        except Exception as e:
+            if timer is not None:
+                timer.daqError(e)
+            raise
+        for task in (ao_task, do_task):
+            task.register_every_n_samples_transferred_from_buffer_event(chunkSamples, None)
+        if timer is not None:
+            for task in (ao_task, do_task):
+                if getattr(task, 'underruns', 0): # counted by FakeTask (the device raises an error instead)
+                    timer.event('underrun', count=task.underruns)
+    if failed:
+        raise failed[0]
+    return stats
+
+class FakeTask:
+
+    # minimal stand-in for nidaqmx.Task: as an output task it records everything written and, once started,
+    # "transfers" the buffer to a virtual device in every-N-samples steps from a background thread (as fast as
+    # possible, or at the sample clock rate if `realTime`); a transfer that finds the buffer empty counts as an
+    # underrun. With `inputChannels` it is an input task that acquires a sample counter (the same value on every
+    # channel) in every-N-samples blocks, until samps_per_chan (finite) or stop() (continuous sample_mode).
+
+    def __init__(self, realTime=False, inputChannels=0):
+        self.realTime = realTime
+        self.inputChannels = inputChannels
+        self.timing = _FakeTiming()
+        self.out_stream = _FakeOutStream()
+        self.in_stream = _FakeInStream()
+        self.writes = []
+        self.underruns = 0
+        self._written = 0
+        self._transferred = 0
+        self._everyN = None
+        self._callback = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._acquired = []
+        self._stopped = threading.Event()
+
+    def write(self, data, auto_start=True, timeout=10.0):
+        data = np.asarray(data)
+        with self._cond:
+            self.writes.append(data.copy())
+            self._written += data.shape[-1]
+            self._cond.notify_all()
+        return data.shape[-1]
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.0):
+        with self._cond:
+            if not self._cond.wait_for(lambda: sum(block.shape[1] for block in self._acquired) >= number_of_samples_per_channel, timeout=timeout):
+                raise TimeoutError('FakeTask read timed out.')
+            data = np.concatenate(self._acquired, axis=1)
+            self._acquired = [data[:, number_of_samples_per_channel:]]
+        return data[:, :number_of_samples_per_channel]
+
+    def register_every_n_samples_transferred_from_buffer_event(self, sample_interval, callback_method):
+        self._everyN, self._callback = sample_interval, callback_method
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self._everyN, self._callback = sample_interval, callback_method
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._acquire if self.inputChannels else self._transfer, daemon=True)
+        self._thread.start()
+
+    def wait_until_done(self, timeout=10.0):
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError('FakeTask did not finish within the timeout.')
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def close(self):
+        pass
+
+    def data(self):
+
+        # everything written, concatenated along the sample axis
+        return np.concatenate(self.writes, axis=-1)
+
+    def _transfer(self):
+        total = self.timing.samps_per_chan
+        step = self._everyN or total
+        while self._transferred < total:
+            n = min(step, total - self._transferred)
+            with self._cond:
+                if self._written - self._transferred < n and not self._cond.wait_for(lambda: self._written - self._transferred >= n, timeout=1):
+                    self.underruns += 1
+                    return
+                self._transferred += n
+            if self.realTime:
+                time.sleep(n/self.timing.samp_clk_rate)
+            if self._callback is not None and n == step:
+                self._callback(None, None, n, None)
+
+    def _acquire(self):
+        acquired = 0
+        step = self._everyN or self.timing.samps_per_chan
+        while not self._stopped.is_set() and (self.timing.continuous or acquired < self.timing.samps_per_chan):
+            n = step if self.timing.continuous else min(step, self.timing.samps_per_chan - acquired)
+            block = np.repeat(np.arange(acquired, acquired + n, dtype=np.float64)[np.newaxis, :], self.inputChannels, axis=0)
+            if self.realTime:
+                time.sleep(n/self.timing.samp_clk_rate)
+            with self._cond:
+                self._acquired.append(block)
+                self._cond.notify_all()
+            acquired += n
+            if self._callback is not None and n == step:
+                self._callback(None, None, n, None)
+
+class _FakeTiming:
+
+    def __init__(self):
+        self.samp_clk_rate = None
+        self.samps_per_chan = None
+        self.continuous = False
+
+    def cfg_samp_clk_timing(self, rate, sample_mode=None, samps_per_chan=1000, **kwargs):
+        self.samp_clk_rate = rate
+        self.samps_per_chan = samps_per_chan
+        self.continuous = str(sample_mode).endswith('CONTINUOUS')
+
+class _FakeInStream:
+
+    def __init__(self):
+        self.input_buf_size = None
+
+class _FakeOutStream:
+
+    def __init__(self):
+        self.regen_mode = None
+        self.output_buf_size = None
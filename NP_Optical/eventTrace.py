@@ -0,0 +1,109 @@
+import os
+import numpy as np
+
+# Event-list (run-length) encoding of the saved DAQ output traces. ao_data/do_data are dense (rows, numSamples) arrays
+# at 30 kHz, but they only change value a few thousand times per session (laser pulses and sync on do_data, mirror
+# positions on ao_data), so each row is stored as the first sample and value of every constant segment.
+# Any sample window is decoded with two searchsorted calls and one np.repeat, and pulse onsets are read from the
+# segment starts without decoding at all. Traces that change every sample (ramps) gain nothing from this format.
+
+class EventTrace:
+
+    # segments of row r are starts[rowOffsets[r]:rowOffsets[r+1]] (first sample) and values[...] (value), in order
+
+    def __init__(self, starts, values, rowOffsets, numSamples):
+        self.starts = starts
+        self.values = values
+        self.rowOffsets = rowOffsets
+        self.numSamples = int(numSamples)
+
+    @property
+    def shape(self):
+        return (len(self.rowOffsets) - 1, self.numSamples)
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes + self.rowOffsets.nbytes
+
+    def segments(self, row):
+
+        # (starts, ends, values) of the constant segments of `row`; ends are exclusive
+        first, last = self.rowOffsets[row], self.rowOffsets[row + 1]
+        starts = self.starts[first:last]
+        ends = np.append(starts[1:], self.numSamples)
+        return starts, ends, self.values[first:last]
+
+    def window(self, start=0, stop=None, rows=None):
+
+        # dense samples [start, stop) of `rows` (default: all rows), as (len(rows), stop - start)
+        stop = self.numSamples if stop is None else min(stop, self.numSamples)
+        start = min(max(start, 0), stop)
+        rows = range(self.shape[0]) if rows is None else rows
+        out = np.zeros((len(rows), stop - start), dtype=self.values.dtype)
+        for i, row in enumerate(rows):
+            starts, ends, values = self.segments(row)
+            first = max(np.searchsorted(starts, start, side='right') - 1, 0)
+            last = np.searchsorted(starts, stop, side='left')
+            lengths = np.minimum(ends[first:last], stop) - np.maximum(starts[first:last], start)
+            out[i] = np.repeat(values[first:last], lengths)
+        return out
+
+    def decode(self):
+        return self.window()
+
+    def onsets(self, row=0, Fs=None):
+
+        # first sample of every non-zero segment of `row` (laser pulse / sync onsets), in s if `Fs` is given
+        starts, _, values = self.segments(row)
+        onsets = starts[values != 0]
+        return onsets/Fs if Fs else onsets
+
+    def offsets(self, row=0, Fs=None):
+
+        # sample after the end of every non-zero segment of `row`, in s if `Fs` is given
+        _, ends, values = self.segments(row)
+        offsets = ends[values != 0]
+        return offsets/Fs if Fs else offsets
+
+    def toArrays(self):
+        return {'starts': self.starts, 'values': self.values, 'rowOffsets': self.rowOffsets,
+                'numSamples': np.array(self.numSamples)}
+
+def encodeTrace(data):
+
+    # event-list encoding of a 1-D or (rows, numSamples) array
+
+    ### Inputs:
+    #1. `data` - ndarray (bool or numeric), e.g. do_data or ao_data
+
+    ### Output:
+    # EventTrace (a 1-D input is encoded as one row)
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[np.newaxis, :]
+    starts, values, rowOffsets = [], [], [0]
+    for row in data:
+        rowStarts = np.concatenate(([0], np.flatnonzero(row[1:] != row[:-1]) + 1)) if len(row) else np.zeros(0, dtype=np.int64)
+        starts.append(rowStarts.astype(np.int64))
+        values.append(row[rowStarts])
+        rowOffsets.append(rowOffsets[-1] + len(rowStarts))
+    return EventTrace(np.concatenate(starts), np.concatenate(values).astype(data.dtype),
+                      np.array(rowOffsets, dtype=np.int64), data.shape[1])
+
+def loadEventTrace(path):
+
+    # EventTrace from a .npz written by saveEventTrace or AsyncWriter.save(..., pack='events')
+    with np.load(path) as arrays:
+        return EventTrace(arrays['starts'], arrays['values'], arrays['rowOffsets'], arrays['numSamples'])
+
+def saveEventTrace(path, data):
+    trace = data if isinstance(data, EventTrace) else encodeTrace(data)
+    np.savez(path, **trace.toArrays())
+
+def archiveOutput(npyPath, outPath=None):
+
+    # re-save a dense ao_data/do_data .npy (sessions saved before the event format) as an event list next to it;
+    # returns the path of the .npz
+    outPath = outPath or os.path.splitext(npyPath)[0] + '.npz'
+    saveEventTrace(outPath, np.load(npyPath, mmap_mode='r'))
+    return outPath
@@ -5,6 +5,11 @@ from datetime import datetime
 import threading
 import time
 
+from daqStream import CycleSchedule, streamTasks
+from cycleStore import createCycleStore
+from asyncWriter import AsyncWriter
+from sessionTimer import startSession, finishSession
+
 settings = {
     'task_name' : 'motorControl',
 
@@ -20,7 +25,8 @@ settings = {
     'camera_output':'/PXI1Slot2/port0/line3',
     'cycle_duration': 5,  ## in seconds. Time it takes for full wait-press/hold-release cycle takes (default = 5 seconds).
     'num_cycles' : 200, # number of trials to be completed (default = 200)
-    'force_voltage': [1,2,4] ## in V (1V ~= 50mN; default = [1,2,4]).
+    'force_voltage': [1,2,4], ## in V (1V ~= 50mN; default = [1,2,4]).
+    'continuous_mode': True ## configure the tasks once and run all cycles back-to-back (False: new tasks every cycle)
 }
 
 
@@ -50,10 +56,33 @@ def setupTasks(settings):
     return (ai_task, ao_task, do_task)
 
 
-def runTasks(ai_task, ao_task, do_task, settings):
+def setupContinuousTasks(settings):
+
+    # same channels as setupTasks, configured once for the whole session: the outputs play num_cycles cycles
+    # back-to-back and the input acquires continuously (read one cycle at a time by runContinuousTasks)
     numSamples = int(settings['Fs'] * settings['cycle_duration'])
-    trial_voltage = settings['force_voltage'][np.random.randint(0,3)]
-    
+
+    ai_task = nidaqmx.Task()
+    ai_task.ai_channels.add_ai_voltage_chan(settings['lengthChannel_input'],name_to_assign_to_channel='length_in', terminal_config=nidaqmx.constants.TerminalConfiguration(10083))
+    ai_task.ai_channels.add_ai_voltage_chan(settings['forceChannel_input'],name_to_assign_to_channel='force_in',terminal_config=nidaqmx.constants.TerminalConfiguration(10083))
+    ai_task.timing.cfg_samp_clk_timing(settings['Fs'], sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS, samps_per_chan=numSamples)
+    ai_task.in_stream.input_buf_size = 4*numSamples
+
+    ao_task = nidaqmx.Task()
+    ao_task.ao_channels.add_ao_voltage_chan(settings['lengthChannel_output'],name_to_assign_to_channel='length_out')
+    ao_task.ao_channels.add_ao_voltage_chan(settings['forceChannel_output'],name_to_assign_to_channel='force_out')
+    ao_task.timing.cfg_samp_clk_timing(settings['Fs'], samps_per_chan=settings['num_cycles']*numSamples)
+
+    do_task = nidaqmx.Task()
+    do_task.do_channels.add_do_chan(settings['sync'], name_to_assign_to_lines='sync')
+    do_task.timing.cfg_samp_clk_timing(settings['Fs'], samps_per_chan=settings['num_cycles']*numSamples)
+
+    return (ai_task, ao_task, do_task)
+
+
+def makeCycleOutput(settings, trial_voltage):
+    numSamples = int(settings['Fs'] * settings['cycle_duration'])
+
     ## make the length command
     ao_out = np.zeros((2,numSamples))
     do_out = np.zeros((numSamples),dtype=bool)
@@ -69,59 +98,143 @@ def runTasks(ai_task, ao_task, do_task, settings):
     
     do_out[1:-1] = True
 
+    return (ao_out, do_out)
+
+
+def runTasks(ai_task, ao_task, do_task, settings, timer):
+    numSamples = int(settings['Fs'] * settings['cycle_duration'])
+    trial_voltage = settings['force_voltage'][np.random.randint(0,3)]
+    with timer.phase('build'):
+        ao_out, do_out = makeCycleOutput(settings, trial_voltage)
+
     ## writing daq outputs onto device
-    do_task.write(do_out)
-    ao_task.write(ao_out)
+    with timer.phase('write'):
+        do_task.write(do_out)
+        ao_task.write(ao_out)
 
     ## starting tasks (make sure do_task is started last -- it triggers the others)
-    ai_task.start()
-    # di_task.start()
-    ao_task.start()
-    do_task.start()
-    do_task.wait_until_done(timeout = settings['cycle_duration'] + 1)
+    with timer.phase('start'):
+        ai_task.start()
+        # di_task.start()
+        ao_task.start()
+        do_task.start()
+    with timer.phase('wait', daqErrors=True):
+        do_task.wait_until_done(timeout = settings['cycle_duration'] + 1)
 
     ## adding data to the outputs
-    ai_data = np.array(ai_task.read(numSamples))
+    with timer.phase('read', daqErrors=True):
+        ai_data = np.array(ai_task.read(numSamples))
     ao_data = ao_out
     do_data = do_out
 
     ## stopping tasks
-    do_task.stop()
-    ao_task.stop()
-    ai_task.stop()
+    with timer.phase('stop', daqErrors=True):
+        do_task.stop()
+        ao_task.stop()
+        ai_task.stop()
 
-    do_task.close()
-    ao_task.close()
-    ai_task.close()
+        do_task.close()
+        ao_task.close()
+        ai_task.close()
 
     return(ai_data,ao_data,do_data,trial_voltage)
 
-def countdown_timer(duration):
-    start_time = time.time()
-    end_time = start_time + duration
+def runContinuousTasks(ai_task, ao_task, do_task, settings, store, writer, timer):
 
-    while time.time() < end_time:
-        remaining_time = end_time - time.time()
-        print("\rRemaining Time: {:.2f} minutes".format(remaining_time/60), end="", flush=True)
-        time.sleep(5)  # Update every 5 seconds
+    # run all cycles on the tasks from setupContinuousTasks. The output of each cycle is generated when the device
+    # needs it (daqStream.streamTasks) and every cycle of analog input is handed by the acquisition callback to the
+    # background writer, which appends it to the cycle store
 
+    ### Inputs:
+    #1. `ai_task`, `ao_task`, `do_task` - nidaqmx.Task (or daqStream.FakeTask) from setupContinuousTasks
+    #2. `settings` - dict of settings
+    #3. `store` - cycleStore.CycleStore with room for num_cycles cycles
+    #4. `writer` - asyncWriter.AsyncWriter (closed by the caller)
+    #5. `timer` - sessionTimer.SessionTimer (output chunks, reads, cycle gaps and DAQ errors are recorded)
 
-# run a countdown timer for [trial_duration] seconds
-timer_thread = threading.Thread(target=countdown_timer, args=(trial_duration,))
-timer_thread.start()
-
+    ### Output:
+    # List of the trial voltage of every cycle
+    numSamples = int(settings['Fs'] * settings['cycle_duration'])
+    numCycles = settings['num_cycles']
+    trial_voltages = [settings['force_voltage'][np.random.randint(0,3)] for _ in range(numCycles)]
+    schedule = CycleSchedule(numCycles, numSamples, lambda j: makeCycleOutput(settings, trial_voltages[j]))
+
+    ## analog input: one cycle per callback, saved by the writer thread
+    cycles_read = [0]
+    all_read = threading.Event()
+    failed = []
+
+    def ai_callback(task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        j = cycles_read[0]
+        if j >= numCycles:
+            return 0
+        try:
+            start = time.perf_counter()
+            ai_data = np.array(ai_task.read(number_of_samples_per_channel=numSamples))
+            timer.record('read', time.perf_counter() - start, cycle=j)
+            force = trial_voltages[j] * 50 # 1V ~= 50mN
+            writer.submit(store.append, ai_data, force, trial_voltages[j], time.time(), nBytes=ai_data.nbytes)
+            timer.cycle(j, settings['cycle_duration'])
+        except Exception as e:
+            timer.daqError(e)
+            failed.append(e)
+            all_read.set()
+            return 0
+        cycles_read[0] = j + 1
+        if j + 1 == numCycles:
+            all_read.set()
+        return 0
+
+    ai_task.register_every_n_samples_acquired_into_buffer_event(numSamples, ai_callback)
+
+    try:
+        ## starting tasks (streamTasks starts ai_task right before ao/do, after the prefill, and do_task last -- it
+        ## triggers the others), so every block of numSamples read is one output cycle
+        with timer.phase('stream'):
+            streamTasks(ao_task, do_task, schedule, settings['Fs'], numSamples, nBufferedChunks=2, timeout=settings['cycle_duration'] + 1, timer=timer, startTasks=[ai_task])
+            all_read.wait(timeout = settings['cycle_duration'] + 1)
+    finally:
+        ## stopping tasks (input overruns surface here)
+        with timer.phase('stop', daqErrors=True):
+            ai_task.stop()
+            do_task.close()
+            ao_task.close()
+            ai_task.close()
+
+    if failed:
+        raise failed[0]
+    if cycles_read[0] < numCycles:
+        print("\nWarning: only {} of {} cycles of analog input were read.".format(cycles_read[0], numCycles))
+    return trial_voltages
 
 current_date = datetime.now()
 date = current_date.strftime('%Y%m%d_%H%M%S')
-np.save("C:/SGL_DATA/motorControl_{}_settings.npy".format(date), settings)
-
 
-for j in range(settings['num_cycles']):
-    ai_task, ao_task, do_task = setupTasks(settings)
-    ai_data, _, _, trial_voltage = runTasks(ai_task, ao_task, do_task, settings)
-    force = trial_voltage * 50 # 1V ~= 50mN
-    np.save("C:/SGL_DATA/mC_ai_data_{}mN_{}_{}.npy".format(force, date, (j+1)), ai_data)
+# log the timing of every phase and the gap between cycles (see sessionTimer.py); the countdown starts with the output
+timer = startSession(settings['task_name'], "C:/SGL_DATA/motorControl_{}_timing.jsonl".format(date), settings, trial_duration, ('stream', 'cycles'))
+
+writer = AsyncWriter(maxQueued=8) # the analog input callback blocks only if 8 cycles are waiting for the disk
+writer.save("C:/SGL_DATA/motorControl_{}_settings.npy".format(date), settings)
+
+# analog input of every cycle goes to one store (see cycleStore.py) instead of one .npy per cycle
+store = createCycleStore("C:/SGL_DATA/mC_ai_data_{}".format(date), settings['num_cycles'], 2, int(settings['Fs'] * settings['cycle_duration']), settings=settings)
+
+
+if settings['continuous_mode']:
+    with timer.phase('setup'):
+        ai_task, ao_task, do_task = setupContinuousTasks(settings)
+    runContinuousTasks(ai_task, ao_task, do_task, settings, store, writer, timer)
+else:
+    with timer.phase('cycles'):
+        for j in range(settings['num_cycles']):
+            with timer.phase('setup'):
+                ai_task, ao_task, do_task = setupTasks(settings)
+            ai_data, _, _, trial_voltage = runTasks(ai_task, ao_task, do_task, settings, timer)
+            acquired = time.time() # stamped at acquisition like the continuous path, not when the writer runs
+            force = trial_voltage * 50 # 1V ~= 50mN
+            writer.submit(store.append, ai_data, force, trial_voltage, acquired, nBytes=ai_data.nbytes) # written during the next cycle
+            timer.cycle(j, settings['cycle_duration']) # the gap is the per-cycle task overhead
 print("\nTrial Complete.")
 
-# Wait for the timer thread to complete before exiting the program
-timer_thread.join()
\ No newline at end of file
+# Wait for the writes to complete before exiting the program, then log the timing summary
+finishSession(timer, writer, store)
@@ -2,8 +2,11 @@ import nidaqmx
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
-import threading
-import time
+
+from waveformBuilder import getTrainOnsets, pulseTrain
+from daqStream import PulseTrainSchedule, streamTasks
+from asyncWriter import AsyncWriter
+from sessionTimer import startSession, finishSession
 
 
 settings = {
@@ -23,7 +26,10 @@ settings = {
     'train_duration' : 0.5, # seconds
     'rest_duration' : 5, # seconds
     'trial_buffer' : 1, # seconds
-    'trial_repeats' : 50 # number of trains to pass (100 takes ~10 minutes; default = 50)
+    'trial_repeats' : 50, # number of trains to pass (100 takes ~10 minutes; default = 50)
+
+    'stream_output' : False, # generate ao/do chunk by chunk during the trial instead of writing it all up front (constant memory)
+    'stream_chunk' : 0.5 # in seconds. Output generated per chunk when stream_output is True
 }
 
 # calculate trial_duration and load example trace_array
@@ -49,78 +55,83 @@ def setupTasks(settings):
     return (ao_task, do_task)
 
 
-def runTasks(ao_task, do_task, settings):
+def runTasks(ao_task, do_task, settings, timer):
 
-    # initialize zeroed-out arrays
     numSamples = int(settings['Fs'] * trial_duration)
-    ao_out = np.zeros((2, numSamples))
-    do_out = np.zeros((2, int(settings['Fs'] * trial_duration)), dtype=bool)
-    
-    # Fill ao_out with mirror coordinates
-    ao_out[0] = np.full(1, settings["xV"])
-    ao_out[1] = np.full(1, settings["yV"])
 
     # Assign trains of laser pulses in the same firing pattern as the trace_array empirical template
-    train_onsets = np.arange((settings['trial_buffer']), (trial_duration), ((settings['train_duration'] + settings['rest_duration']))) * settings['Fs']
+    train_onsets = getTrainOnsets(settings, trial_duration)
     laser_onsets = np.round(trace_array * settings['Fs']).astype(int)
 
+    if settings['stream_output']:
+        # generate the outputs chunk by chunk from the onsets while the trial runs (nothing to return)
+        schedule = PulseTrainSchedule(numSamples, settings['xV'], settings['yV'], train_onsets, laser_onsets, settings['laser_duration'], settings['Fs'])
+        with timer.phase('stream'):
+            streamTasks(ao_task, do_task, schedule, settings['Fs'], int(settings['Fs'] * settings['stream_chunk']), timer=timer)
+        with timer.phase('stop', daqErrors=True):
+            do_task.close()
+            ao_task.close()
+        return(None, None)
+
+    with timer.phase('build'):
+        # initialize zeroed-out arrays
+        ao_out = np.zeros((2, numSamples))
+        do_out = np.zeros((2, int(settings['Fs'] * trial_duration)), dtype=bool)
+    
+        # Fill ao_out with mirror coordinates
+        ao_out[0] = np.full(1, settings["xV"])
+        ao_out[1] = np.full(1, settings["yV"])
+
+        # place every pulse of every train in one vectorized pass
+        do_out[0] = pulseTrain(numSamples, train_onsets, laser_onsets, settings['laser_duration'], settings['Fs'])
 
-    for train_onset in train_onsets:
-        for laser_onset in laser_onsets:
-            start_index = int(train_onset + laser_onset)
-            end_index = int(start_index + (settings['laser_duration'] * settings['Fs']))
-            do_out[0, start_index:end_index] = True
-        
 
-    #turn NP sync signal on during trial
-    do_out[1, 1:(numSamples-1)] = True
+        #turn NP sync signal on during trial
+        do_out[1, 1:(numSamples-1)] = True
 
     ## writing daq outputs onto device
-    do_task.write(do_out, timeout = trial_duration + 10)
-    ao_task.write(ao_out, timeout = trial_duration + 10)
+    with timer.phase('write', nBytes=do_out.nbytes + ao_out.nbytes):
+        do_task.write(do_out, timeout = trial_duration + 10)
+        ao_task.write(ao_out, timeout = trial_duration + 10)
 
     ## starting tasks (make sure do_task is started last -- it triggers the others)
-    ao_task.start()
-    do_task.start()
-    do_task.wait_until_done(timeout = trial_duration + 10)
+    with timer.phase('start'):
+        ao_task.start()
+        do_task.start()
+    with timer.phase('wait', daqErrors=True):
+        do_task.wait_until_done(timeout = trial_duration + 10)
 
     ## adding data to the outputs
     ao_data = ao_out
     do_data = do_out
 
     ## stopping tasks
-    do_task.stop()
-    ao_task.stop()
+    with timer.phase('stop', daqErrors=True):
+        do_task.stop()
+        ao_task.stop()
 
-    do_task.close()
-    ao_task.close()
+        do_task.close()
+        ao_task.close()
     return(ao_data,do_data)
 
-def countdown_timer(duration):
-    start_time = time.time()
-    end_time = start_time + duration
-
-    while time.time() < end_time:
-        remaining_time = end_time - time.time()
-        print("\rRemaining Time: {:.2f} minutes".format(remaining_time/60), end="", flush=True)
-        time.sleep(5)  # Update every 5 seconds
-
+current_date = datetime.now()
+date = current_date.strftime('%Y%m%d_%H%M%S')
 
-# run a countdown timer for [trial_duration] seconds
-timer_thread = threading.Thread(target=countdown_timer, args=(trial_duration,))
-timer_thread.start()
+# log the timing of every phase of the session (see sessionTimer.py); the countdown starts with the output
+timer = startSession(settings['task_name'], "C:/SGL_DATA/physioLaser_{}_timing.jsonl".format(date), settings, trial_duration, ('wait', 'stream'))
 
-ao_task, do_task = setupTasks(settings)
-ao_data, do_data, = runTasks(ao_task, do_task, settings)
+with timer.phase('setup'):
+    ao_task, do_task = setupTasks(settings)
+ao_data, do_data, = runTasks(ao_task, do_task, settings, timer)
 print("\nTrial Complete.")
 
 
 # save all data to numpy arrays
-current_date = datetime.now()
-date = current_date.strftime('%Y%m%d_%H%M%S')
-np.save("C:/SGL_DATA/physioLaser_{}_ao_data.npy".format(date), ao_data)
-np.save("C:/SGL_DATA/physioLaser_{}_do_data.npy".format(date), do_data)
-np.save("C:/SGL_DATA/physioLaser_{}_settings.npy".format(date), settings)
-
-# Wait for the timer thread to complete before exiting the program
-timer_thread.join()
\ No newline at end of file
+writer = AsyncWriter() # ao_data/do_data are saved as event lists (.npz, see eventTrace.py)
+if not settings['stream_output']: # streamed outputs are reproducible from the settings and trace_oi
+    writer.save("C:/SGL_DATA/physioLaser_{}_ao_data.npz".format(date), ao_data, pack='events')
+    writer.save("C:/SGL_DATA/physioLaser_{}_do_data.npz".format(date), do_data, pack='events')
+writer.save("C:/SGL_DATA/physioLaser_{}_settings.npy".format(date), settings)
+
+# Wait for the writes to complete before exiting the program, then log the timing summary
+finishSession(timer, writer)
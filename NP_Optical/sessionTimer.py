@@ -0,0 +1,259 @@
+import sys
+import json
+import time
+import atexit
+import builtins
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Timing instrumentation for the acquisition scripts. A SessionTimer records how long every phase of a session takes
+# (task setup, buffer build, task.write, start, wait_until_done, save, ...), counts DAQ buffer underruns/overruns and
+# measures the gaps between consecutive cycles. Every record is appended to a structured log (one JSON object per
+# line, e.g. C:/SGL_DATA/<session>_timing.jsonl) as it happens, so a crashed session still leaves its timings, and
+# close() prints and logs a per-phase summary. Its countdown starts when the output actually starts playing, instead
+# of a fixed trial_duration from the launch of the script. The scripts open a session with startSession and end it
+# with finishSession; a session that fails is closed (and its error logged) by the exit and exception hooks.
+
+# nidaqmx error codes of output underruns and input overruns
+underrunCodes = (-200290, -200621, -200018, -200016)
+overrunCodes = (-200279, -200019, -200010)
+
+class SessionTimer:
+
+    # per-phase timings, DAQ buffer errors and cycle gaps of one acquisition session
+
+    ### Inputs:
+    #1. `name` - str, session name (e.g. settings['task_name'])
+    #2. `logPath` - str, path of the JSON-lines log (None: keep the records in memory only)
+    #3. `settings` - dict of the session settings, written to the first log record
+
+    ### Usage:
+    # timer = SessionTimer('pulsedLaser', 'C:/SGL_DATA/pulsedLaser_<date>_timing.jsonl', settings)
+    # with timer.phase('write'): do_task.write(do_out)
+    # with timer.phase('wait', daqErrors=True): do_task.wait_until_done() # underruns/overruns raised here are counted
+    # timer.startCountdown(trial_duration, 'wait') # prints the remaining time once the 'wait' phase starts
+    # timer.close() # summary report (also on an exception when used as `with SessionTimer(...) as timer:`)
+
+    def __init__(self, name, logPath=None, settings=None):
+        self.name = name
+        self.logPath = logPath
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.counters = {'underrun': 0, 'overrun': 0}
+        self.gaps = []
+        self.active = {}
+        self._lastCycle = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._countdown = None
+        self._log = open(logPath, 'a', buffering=1) if logPath else None
+        self.note('start', session=name, time=datetime.now().isoformat(timespec='seconds'), settings=settings)
+
+    @contextmanager
+    def phase(self, name, daqErrors=False, **fields):
+
+        # time the enclosed block as phase `name` (extra fields go to its log record); with `daqErrors` an exception
+        # raised in the block is logged by daqError before it propagates (for DAQ calls that report underruns/overruns)
+        start = time.perf_counter()
+        with self._lock:
+            self.active[name] = start
+        try:
+            yield
+        except Exception as e:
+            if daqErrors:
+                self.daqError(e)
+            raise
+        finally:
+            with self._lock:
+                self.active.pop(name, None)
+            self.record(name, time.perf_counter() - start, start=start - self.start, **fields)
+
+    def record(self, name, duration, **fields):
+
+        # add a phase duration measured elsewhere (e.g. one chunk of daqStream.streamTasks)
+        with self._lock:
+            phase = self.phases.setdefault(name, {'count': 0, 'total': 0., 'max': 0.})
+            phase['count'] += 1
+            phase['total'] += duration
+            phase['max'] = max(phase['max'], duration)
+        self.note('phase', phase=name, duration=duration, **fields)
+
+    def event(self, kind, count=1, **fields):
+
+        # count an event (e.g. 'underrun', 'overrun') and log it
+        with self._lock:
+            self.counters[kind] = self.counters.get(kind, 0) + count
+        self.note('event', kind=kind, count=count, **fields)
+
+    def daqError(self, error):
+
+        # log a DAQ exception as an underrun/overrun if it is one; returns the kind (or None)
+        code = getattr(error, 'error_code', None)
+        kind = 'underrun' if code in underrunCodes else 'overrun' if code in overrunCodes else None
+        if kind is not None:
+            self.event(kind, code=code, message=str(error).splitlines()[0] if str(error) else '')
+        return kind
+
+    def cycle(self, index, nominal=None):
+
+        # mark the end of cycle `index`; the interval since the previous mark minus `nominal` (s) is its gap
+        now = time.perf_counter()
+        interval = None if self._lastCycle is None else now - self._lastCycle
+        self._lastCycle = now
+        gap = None if interval is None or nominal is None else interval - nominal
+        if gap is not None:
+            self.gaps.append(gap)
+        self.note('cycle', cycle=index, interval=interval, gap=gap)
+
+    def note(self, record, **fields):
+
+        # append a record to the log (time in s since the timer started)
+        if self._log is None:
+            return
+        line = json.dumps(dict(record=record, t=round(time.perf_counter() - self.start, 6), **fields), default=_jsonValue)
+        with self._lock:
+            if not self._log.closed:
+                self._log.write(line + '\n')
+
+    def startCountdown(self, duration, phases=('wait',), interval=5.):
+
+        # print the remaining time of the first of `phases` to start (duration in s from its start) in a thread
+        phases = (phases,) if isinstance(phases, str) else tuple(phases)
+
+        def countdown():
+            started = None
+            while not self._stopped.is_set():
+                # the main thread enters and leaves phases meanwhile: read a copy taken under the lock
+                with self._lock:
+                    active = dict(self.active)
+                running = [active[phase] for phase in phases if phase in active]
+                if running:
+                    started = running[0]
+                    remaining = max(duration - (time.perf_counter() - started), 0.)
+                    print("\rRemaining Time: {:.2f} minutes".format(remaining/60), end="", flush=True)
+                elif started is not None:
+                    return
+                else:
+                    current = ', '.join(active) or 'idle'
+                    print("\rPreparing ({}): {:.1f} s".format(current, time.perf_counter() - self.start), end="", flush=True)
+                self._stopped.wait(interval)
+
+        self._countdown = threading.Thread(target=countdown, daemon=True)
+        self._countdown.start()
+        return self._countdown
+
+    def summary(self):
+
+        # per-phase report and the DAQ counters of the session
+        elapsed = time.perf_counter() - self.start
+        lines = ["Session '{}': {:.1f} s".format(self.name, elapsed)]
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]['total']):
+            lines.append("  {:<12} {:>5} x  total {:9.3f} s ({:5.1f}%)  mean {:8.4f} s  max {:8.4f} s".format(
+                name, phase['count'], phase['total'], 100*phase['total']/max(elapsed, 1e-9),
+                phase['total']/phase['count'], phase['max']))
+        lines.append("  underruns: {}, overruns: {}".format(self.counters['underrun'], self.counters['overrun']))
+        if self.gaps:
+            lines.append("  inter-cycle gaps: {} cycles, mean {:.4f} s, max {:.4f} s".format(
+                len(self.gaps), sum(self.gaps)/len(self.gaps), max(self.gaps)))
+        return '\n'.join(lines)
+
+    def close(self, verbose=True):
+
+        # stop the countdown, log the summary and close the log
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._countdown is not None:
+            self._countdown.join()
+        gapStats = {'count': len(self.gaps), 'mean': sum(self.gaps)/len(self.gaps), 'max': max(self.gaps)} if self.gaps else None
+        self.note('summary', elapsed=time.perf_counter() - self.start, phases=self.phases, counters=self.counters, gaps=gapStats)
+        if self._log is not None:
+            with self._lock:
+                self._log.close()
+        if verbose:
+            print("\n" + self.summary())
+
+    def abort(self, excType, exc):
+
+        # log the exception that ended the session (with the phases it interrupted) and close
+        if self._stopped.is_set():
+            return
+        with self._lock:
+            phases = list(self.active)
+        self.note('error', phases=phases, error='{}: {}'.format(excType.__name__, exc))
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        if exc is not None:
+            self.abort(excType, exc)
+        self.close()
+
+def startSession(name, logPath, settings, duration, phases=('wait',), interval=5.):
+
+    # SessionTimer of an acquisition script, with its countdown started (see SessionTimer.startCountdown). An uncaught
+    # exception (or Ctrl+C) is logged and the timer closed by the exception hook of python or of an IPython/Spyder
+    # console, and the timer is closed at exit otherwise, so the script body needs no `with` block
+
+    ### Inputs:
+    #1. `name` - str, session name (e.g. settings['task_name'])
+    #2. `logPath` - str, path of the JSON-lines log
+    #3. `settings` - dict of the session settings
+    #4. `duration` - float, s of output played by the session (e.g. trial_duration)
+    #5. `phases` - phase name(s) whose start starts the countdown
+    #6. `interval` - float, s between countdown updates
+
+    ### Output:
+    # SessionTimer (end the session with finishSession)
+    timer = SessionTimer(name, logPath, settings)
+    timer.startCountdown(duration, phases, interval)
+
+    previousHook = sys.excepthook
+    def excepthook(excType, exc, traceback):
+        timer.abort(excType, exc)
+        previousHook(excType, exc, traceback)
+    sys.excepthook = excepthook
+
+    shell = getattr(builtins, 'get_ipython', lambda: None)()
+    if shell is not None:
+        # consoles (IPython, Spyder) neither call sys.excepthook nor exit after the script: a session still open when
+        # the cell that ran the script ends has failed (the exception the console showed is sys.last_value)
+        def postRunCell(result):
+            shell.events.unregister('post_run_cell', postRunCell)
+            exc = result.error_in_exec or getattr(sys, 'last_value', None)
+            if exc is None:
+                exc = RuntimeError("the script ended before finishSession")
+            timer.abort(type(exc), exc)
+        shell.events.register('post_run_cell', postRunCell)
+
+    atexit.register(timer.close)
+    return timer
+
+def finishSession(timer, writer, *stores):
+
+    # wait for the writes of the session ('save' phase), log the writer statistics and close the timer (summary)
+
+    ### Inputs:
+    #1. `timer` - SessionTimer from startSession
+    #2. `writer` - asyncWriter.AsyncWriter of the session
+    #3. `stores` - objects closed after the writer (e.g. a cycleStore.CycleStore)
+    with timer.phase('save'):
+        writer.close()
+        for store in stores:
+            store.close()
+    timer.note('writer', **writer.stats)
+    timer.close()
+
+def loadTimingLog(logPath):
+
+    # list of the records of a timing log
+    with open(logPath) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _jsonValue(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
@@ -0,0 +1,98 @@
+import numpy as np
+
+from waveformBuilder import getTrainOnsets, pulseTrain, regionSchedule, regionPulses
+from daqStream import PulseTrainSchedule, RegionSchedule, CycleSchedule, streamTasks, FakeTask
+
+# Checks that the outputs streamed chunk by chunk through FakeTask are identical to the buffers built up front by
+# waveformBuilder (pulsedLaser.py / physiologicalLaser.py / acquireRecField.py) and, for the continuous motorControl
+# path, to the concatenated cycles.
+# Usage: python -m pytest test_daqStream.py
+
+Fs = 30000
+
+def fakeTasks(numSamples):
+    ao_task, do_task = FakeTask(), FakeTask()
+    for task in (ao_task, do_task):
+        task.timing.cfg_samp_clk_timing(Fs, samps_per_chan=numSamples)
+    return ao_task, do_task
+
+def syncLine(numSamples):
+    sync = np.zeros(numSamples, dtype=bool)
+    sync[1:(numSamples - 1)] = True
+    return sync
+
+def test_pulseTrainStream():
+    settings = {'Fs': Fs, 'laser_duration': 0.0003, 'laser_frequency': 40, 'train_duration': 0.5, 'rest_duration': 0.2, 'trial_buffer': 0.1}
+    trial_duration = 2.37
+    numSamples = int(Fs * trial_duration)
+    train_onsets = getTrainOnsets(settings, trial_duration)
+    laser_onsets = (np.arange(0, settings['train_duration'], 1 / settings['laser_frequency']) * Fs).astype(int)
+
+    schedule = PulseTrainSchedule(numSamples, 1.5, -0.5, train_onsets, laser_onsets, settings['laser_duration'], Fs)
+    ao_task, do_task = fakeTasks(numSamples)
+    streamTasks(ao_task, do_task, schedule, Fs, 7919, nBufferedChunks=3)
+
+    assert ao_task.underruns == 0 and do_task.underruns == 0
+    assert np.array_equal(ao_task.data(), np.repeat([[1.5], [-0.5]], numSamples, axis=1))
+    do_data = do_task.data()
+    assert np.array_equal(do_data[0], pulseTrain(numSamples, train_onsets, laser_onsets, settings['laser_duration'], Fs))
+    assert np.array_equal(do_data[1], syncLine(numSamples))
+
+def test_regionStream():
+    rng = np.random.default_rng(0)
+    positions = np.tile(rng.uniform(-2, 2, (37, 2)), (3, 1))
+    samplesPerRegion = int(Fs * 0.03)
+    laserSamples = int(Fs * 0.0001)
+    laserPulseIndices = np.arange(0, laserSamples, 1)
+    numSamples = len(positions) * samplesPerRegion
+
+    schedule = RegionSchedule(numSamples, positions, samplesPerRegion, laserPulseIndices, laserSamples)
+    ao_task, do_task = fakeTasks(numSamples)
+    streamTasks(ao_task, do_task, schedule, Fs, 1237, nBufferedChunks=2)
+
+    assert np.array_equal(ao_task.data(), regionSchedule(positions, samplesPerRegion, numSamples))
+    do_data = do_task.data()
+    assert np.array_equal(do_data[0], regionPulses(len(positions), samplesPerRegion, laserPulseIndices, laserSamples, numSamples))
+    assert np.array_equal(do_data[1], syncLine(numSamples))
+
+def test_cycleStream():
+    numCycles, cycleSamples = 9, 3001
+    voltages = np.random.default_rng(1).choice([1., 2., 4.], numCycles)
+
+    def makeCycle(j):
+        ao_cycle = np.zeros((2, cycleSamples))
+        ao_cycle[0] = np.linspace(0, 5, cycleSamples)
+        ao_cycle[1, 1000:2000] = voltages[j]
+        do_cycle = np.zeros(cycleSamples, dtype=bool)
+        do_cycle[1:-1] = True
+        return ao_cycle, do_cycle
+
+    # the analog input must start after both output buffers are prefilled, right before the outputs (user-010)
+    events = []
+    class RecordingTask(FakeTask):
+        def __init__(self, name, **kwargs):
+            super().__init__(**kwargs)
+            self.name = name
+        def write(self, data, auto_start=True, timeout=10.0):
+            events.append(('write', self.name))
+            return super().write(data, auto_start, timeout)
+        def start(self):
+            events.append(('start', self.name))
+            super().start()
+
+    ao_task, do_task = RecordingTask('ao'), RecordingTask('do')
+    for task in (ao_task, do_task):
+        task.timing.cfg_samp_clk_timing(Fs, samps_per_chan=numCycles*cycleSamples)
+    ai_task = RecordingTask('ai', inputChannels=2)
+    ai_task.timing.cfg_samp_clk_timing(Fs, sample_mode='CONTINUOUS', samps_per_chan=cycleSamples)
+
+    schedule = CycleSchedule(numCycles, cycleSamples, makeCycle)
+    streamTasks(ao_task, do_task, schedule, Fs, cycleSamples, nBufferedChunks=2, startTasks=[ai_task])
+    ai_task.stop()
+
+    cycles = [makeCycle(j) for j in range(numCycles)]
+    assert np.array_equal(ao_task.data(), np.concatenate([cycle[0] for cycle in cycles], axis=-1))
+    assert np.array_equal(do_task.data(), np.concatenate([cycle[1] for cycle in cycles], axis=-1))
+    starts = [name for kind, name in events if kind == 'start']
+    assert starts == ['ai', 'ao', 'do']
+    assert events.index(('start', 'ai')) == 4 # after the 2 + 2 prefill writes
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Vectorized construction of the DAQ output buffers used by pulsedLaser.py, physiologicalLaser.py and acquireRecField.py.
+# Every function reproduces the sample indexing (including the int() truncation) of the original per-pulse loops,
+# so the buffers are identical; see benchmark_waveforms.py.
+
+def getTrainOnsets(settings, trial_duration):
+
+    # onset (in samples, float) of every laser train: one per train_duration + rest_duration, after trial_buffer
+    return np.arange((settings['trial_buffer']), (trial_duration), ((settings['train_duration'] + settings['rest_duration']))) * settings['Fs']
+
+def pulseTrain(numSamples, trainOnsets, laserOnsets, laserDuration, Fs):
+
+    # laser line with a pulse of `laserDuration` s at every train onset + laser onset
+
+    ### Inputs:
+    #1. `numSamples` - int, length of the output
+    #2. `trainOnsets` - ndarray of train onsets (in samples)
+    #3. `laserOnsets` - ndarray of pulse onsets within a train (in samples)
+    #4. `laserDuration` - float, pulse duration in s
+    #5. `Fs` - int sample rate in Hz
+
+    ### Output:
+    # bool ndarray of length `numSamples`
+
+    starts = (np.asarray(trainOnsets, dtype=np.float64)[:, np.newaxis] + np.asarray(laserOnsets)[np.newaxis, :]).astype(np.int64).reshape(-1)
+    ends = (starts + (laserDuration * Fs)).astype(np.int64)
+    return intervalMask(numSamples, starts, ends)
+
+def intervalMask(numSamples, starts, ends):
+
+    # bool ndarray of length `numSamples` that is True on every [starts[i], ends[i]) (overlaps are merged)
+    starts = np.clip(starts, 0, numSamples)
+    lengths = np.maximum(np.clip(ends, 0, numSamples) - starts, 0)
+
+    # index of every covered sample: each interval's start repeated over its length, plus a running offset
+    firstIndex = np.cumsum(lengths) - lengths
+    indices = np.repeat(starts - firstIndex, lengths) + np.arange(lengths.sum())
+
+    mask = np.zeros(numSamples, dtype=bool)
+    mask[indices] = True
+    return mask
+
+def regionSchedule(positions, samplesPerRegion, numSamples):
+
+    # mirror command holding each (x, y) of `positions` for `samplesPerRegion` samples, zero-padded to `numSamples`
+    ao_out = np.zeros((2, numSamples))
+    held = np.repeat(np.asarray(positions, dtype=np.float64).T, samplesPerRegion, axis=1)[:, :numSamples]
+    ao_out[:, :held.shape[1]] = held
+    return ao_out
+
+def regionPulses(numRegions, samplesPerRegion, laserPulseIndices, laserSamples, numSamples):
+
+    # laser line with `laserPulseIndices` fired `laserSamples` before the middle of each region's dwell
+    regionEnds = (np.arange(numRegions) + 1) * samplesPerRegion
+    onsets = (regionEnds - (samplesPerRegion / 2)).astype(np.int64) - laserSamples
+    indices = (onsets[:, np.newaxis] + np.asarray(laserPulseIndices)[np.newaxis, :]).reshape(-1)
+
+    laser = np.zeros(numSamples, dtype=bool)
+    laser[indices] = True
+    return laser